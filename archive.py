@@ -0,0 +1,147 @@
+import os
+import json
+import uuid
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from datetime import datetime
+from config import config
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SCHEMAS = {
+    'prediction_history': pa.schema([
+        ('id', pa.int64()),
+        ('user_id', pa.int64()),
+        ('timestamp', pa.timestamp('us')),
+        ('predicted_digit', pa.int64()),
+        ('confidence', pa.float64()),
+        ('image_path', pa.string()),
+        ('user_input_type', pa.string()),
+        ('file_name', pa.string()),
+        ('processing_time', pa.float64()),
+        ('image_size', pa.string()),
+        ('model_version', pa.string())
+    ]),
+    'user_feedback': pa.schema([
+        ('id', pa.int64()),
+        ('prediction_id', pa.int64()),
+        ('user_id', pa.int64()),
+        ('timestamp', pa.timestamp('us')),
+        ('actual_digit', pa.int64()),
+        ('correct_prediction', pa.bool_()),
+        ('confidence_rating', pa.int64()),
+        ('comments', pa.string()),
+        ('suggested_improvement', pa.string()),
+        ('labeler_id', pa.int64())
+    ])
+}
+
+class ArchiveStore:
+    """Monthly Parquet partitions of archived history: <root>/<table>/<YYYY-MM>/part-<start>-s<shard>-<id>.parquet.
+
+    manifest.json holds, per table, the cutoff below which rows live only in the archive and the parts written so
+    far. A part only counts once set_cutoff registers it, so a run that crashes in between leaves no duplicates.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or config.ARCHIVE_PATH
+        self.manifest_path = os.path.join(self.root, 'manifest.json')
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def cutoff(self, table):
+        value = self._read_manifest().get(table, {}).get('cutoff')
+        return datetime.fromisoformat(value) if value else None
+
+    def set_cutoff(self, table, cutoff, parts=()):
+        """Advance the table's cutoff and register the parts holding the newly archived range in one manifest write."""
+        manifest = self._read_manifest()
+        entry = manifest.setdefault(table, {})
+        entry['cutoff'] = cutoff.isoformat()
+        entry['parts'] = entry.get('parts', []) + list(parts)
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def files(self, table):
+        # Registered parts in the order they were archived, which is oldest range first
+        return [os.path.join(self.root, table, part) for part in self._read_manifest().get(table, {}).get('parts', [])]
+
+    def remove_unregistered(self, table):
+        """Delete parts left behind by a run that stopped before registering them; returns how many were removed."""
+        table_dir = os.path.join(self.root, table)
+        if not os.path.isdir(table_dir):
+            return 0
+        registered = set(self._read_manifest().get(table, {}).get('parts', []))
+        removed = 0
+        for month in os.listdir(table_dir):
+            for name in os.listdir(os.path.join(table_dir, month)):
+                part = f'{month}/{name}'
+                if name.endswith(('.parquet', '.tmp')) and part not in registered:
+                    os.remove(os.path.join(table_dir, part))
+                    removed += 1
+        return removed
+
+    def write_month(self, table, month, chunks, start, shard=0):
+        """Write row-dict chunks as one Parquet file in the month's partition.
+
+        Returns (rows, part); part is the path to pass to set_cutoff, or None when there were no rows.
+        """
+        schema = ARCHIVE_SCHEMAS[table]
+        month_dir = os.path.join(self.root, table, month)
+        os.makedirs(month_dir, exist_ok=True)
+        part = f"{month}/part-{start.strftime('%Y%m%dT%H%M%S')}-s{shard}-{uuid.uuid4().hex[:8]}.parquet"
+        path = os.path.join(self.root, table, part)
+        tmp_path = path + '.tmp'
+        rows = 0
+        with pq.ParquetWriter(tmp_path, schema, compression=config.ARCHIVE_COMPRESSION) as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                rows += len(chunk)
+        if not rows:
+            os.remove(tmp_path)
+            return 0, None
+        os.replace(tmp_path, path)
+        return rows, part
+
+    def read_rows(self, table, columns, filter_expression=None):
+        """All archived rows matching a pyarrow filter expression, as a list of dicts."""
+        files = self.files(table)
+        if not files:
+            return []
+        dataset = ds.dataset(files, format='parquet', schema=ARCHIVE_SCHEMAS[table])
+        return dataset.to_table(columns=columns, filter=filter_expression).to_pylist()
+
+    def iter_batches(self, table, columns, user_id=None, batch_size=None):
+        """Yield archived rows oldest first as lists of dicts, reading one record batch at a time."""
+        files = self.files(table)
+        if not files:
+            return
+        dataset = ds.dataset(files, format='parquet', schema=ARCHIVE_SCHEMAS[table])
+        filter_expression = ds.field('user_id') == user_id if user_id is not None else None
+        for batch in dataset.to_batches(columns=columns, filter=filter_expression,
+                                        batch_size=batch_size or config.EXPORT_CHUNK_SIZE):
+            if batch.num_rows:
+                yield batch.to_pylist()
+
+    def aggregate_by_day(self, table, keys, sums):
+        """Per-file GROUP BY (keys, day) with a row count and column sums, for rebuilding rollups."""
+        for path in self.files(table):
+            data = pq.read_table(path, columns=keys + ['timestamp'] + sums)
+            data = data.append_column('day', pc.strftime(data['timestamp'], format='%Y-%m-%d'))
+            for name in sums:
+                data = data.set_column(data.schema.get_field_index(name), name, pc.cast(data[name], pa.float64()))
+            grouped = data.group_by(keys + ['day']).aggregate([('timestamp', 'count')] + [(name, 'sum') for name in sums])
+            for row in grouped.to_pylist():
+                yield row
+
+archive_store = ArchiveStore()
@@ -0,0 +1,312 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+import numpy as np
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import (
+    db_manager, AdvancedDatabaseManager, User, PredictionHistory, UserFeedback, AnalyticsRollup,
+    EXPORT_TABLES, EXPORT_COLUMNS, set_sqlite_pragmas, _export_query, _json_export_row, encode_history_cursor, _new_rollup_deltas,
+    _add_prediction_deltas, _add_feedback_deltas, _apply_rollup_deltas, _insert_feedback_batch, _user_digit_query,
+    _format_user_stats, _user_counts_query, _digit_rollup_query, _format_system_analytics
+)
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class AsyncDatabaseManager:
+    """Async counterpart of AdvancedDatabaseManager for the request path.
+
+    Schema creation, migrations and the prediction write-behind buffer stay with the sync manager.
+    """
+
+    def __init__(self, sync_manager=None, db_url=None):
+        self.sync_manager = sync_manager or db_manager
+        self.db_url = db_url or config.async_database_url(self.sync_manager.db_url)
+        is_sqlite = self.db_url.startswith('sqlite')
+        self.engine = create_async_engine(
+            self.db_url,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_pre_ping=True,
+            connect_args={'timeout': config.SQLITE_BUSY_TIMEOUT_MS / 1000} if is_sqlite else {}
+        )
+        if is_sqlite:
+            event.listen(self.engine.sync_engine, 'connect', set_sqlite_pragmas)
+        self.Session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    @asynccontextmanager
+    async def session_scope(self):
+        session = self.Session()
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def add_user(self, username, email=None):
+        async with self.session_scope() as session:
+            user = User(username=username, email=email)
+            session.add(user)
+            await session.flush()
+            return user.id
+
+    async def get_user(self, user_id):
+        async with self.session_scope() as session:
+            user = await session.get(User, user_id)
+            if user is None:
+                return None
+            return {
+                'id': user.id,
+                'username': user.username,
+                'email': user.email,
+                'created_at': user.created_at.isoformat(),
+                'is_active': user.is_active
+            }
+
+    async def _prediction_id(self):
+        # Ids from this process's current block cost nothing; reserving the next block is a main-database transaction
+        prediction_id = self.sync_manager.cached_id(PredictionHistory)
+        if prediction_id is None:
+            prediction_id = await asyncio.to_thread(self.sync_manager.allocate_id, PredictionHistory)
+        return prediction_id
+
+    async def add_prediction(self, user_id, predicted_digit, confidence, image_path, user_input_type, file_name, processing_time, image_size, model_version):
+        buffer = self.sync_manager.prediction_buffer
+        if buffer is not None:
+            record = {
+                'user_id': user_id,
+                'predicted_digit': predicted_digit,
+                'confidence': confidence,
+                'image_path': image_path,
+                'user_input_type': user_input_type,
+                'file_name': file_name,
+                'processing_time': processing_time,
+                'image_size': image_size,
+                'model_version': model_version
+            }
+            record['id'] = await self._prediction_id()
+            try:
+                return buffer.submit(record, block=False)
+            except queue.Full:
+                # A full queue blocks until the flusher catches up, so wait for it off the event loop
+                return await asyncio.to_thread(buffer.submit, record)
+        timestamp = datetime.utcnow()
+        async with self.session_scope() as session:
+            prediction = PredictionHistory(
+                id=await self._prediction_id(),
+                user_id=user_id,
+                timestamp=timestamp,
+                predicted_digit=predicted_digit,
+                confidence=confidence,
+                image_path=image_path,
+                user_input_type=user_input_type,
+                file_name=file_name,
+                processing_time=processing_time,
+                image_size=image_size,
+                model_version=model_version
+            )
+            session.add(prediction)
+            await session.flush()
+            deltas = _new_rollup_deltas()
+            _add_prediction_deltas(
+                deltas, user_id, predicted_digit, timestamp.strftime('%Y-%m-%d'),
+                confidence_sum=confidence, processing_time_sum=processing_time
+            )
+            await session.run_sync(lambda sync_session: _apply_rollup_deltas(sync_session.connection(), deltas))
+            return prediction.id
+
+    async def add_feedback(self, prediction_id, user_id, actual_digit, correct_prediction=None, confidence_rating=None, comments="", suggested_improvement=""):
+        timestamp = datetime.utcnow()
+        query = select(PredictionHistory.user_id, PredictionHistory.predicted_digit).filter_by(id=prediction_id)
+        async with self.session_scope() as session:
+            found = (await session.execute(query)).first()
+        if found is None and self.sync_manager.prediction_buffer is not None:
+            await asyncio.to_thread(self.sync_manager.flush_predictions)
+            async with self.session_scope() as session:
+                found = (await session.execute(query)).first()
+        if found is None:
+            return None
+        owner_id, predicted_digit = found
+        if correct_prediction is None:
+            correct_prediction = predicted_digit == actual_digit
+        async with self.session_scope() as session:
+            # Stored under the prediction's owner, like the sync manager
+            feedback = UserFeedback(
+                prediction_id=prediction_id,
+                user_id=owner_id,
+                labeler_id=user_id,
+                timestamp=timestamp,
+                actual_digit=actual_digit,
+                correct_prediction=correct_prediction,
+                confidence_rating=confidence_rating,
+                comments=comments,
+                suggested_improvement=suggested_improvement
+            )
+            session.add(feedback)
+            deltas = _new_rollup_deltas()
+            _add_feedback_deltas(deltas, owner_id, actual_digit, timestamp.strftime('%Y-%m-%d'), correct=int(bool(correct_prediction)))
+            await session.run_sync(lambda sync_session: _apply_rollup_deltas(sync_session.connection(), deltas))
+            await session.flush()
+            return feedback.id
+
+    async def add_feedback_batch(self, items, promote_to_dataset=False, dataset_type='training'):
+        await asyncio.to_thread(self.sync_manager.flush_predictions)
+        rows = [{
+            'position': position,
+            'prediction_id': item['prediction_id'],
+            'user_id': item['user_id'],
+            'actual_digit': item['actual_digit'],
+            'confidence_rating': item.get('confidence_rating'),
+            'comments': item.get('comments', ''),
+            'suggested_improvement': item.get('suggested_improvement', '')
+        } for position, item in enumerate(items)]
+        timestamp = datetime.utcnow()
+        async with self.session_scope() as session:
+            accepted, promoted, rejected = await session.run_sync(
+                lambda sync_session: _insert_feedback_batch(sync_session.connection(), rows, timestamp, promote_to_dataset, dataset_type)
+            )
+        return {'accepted': accepted, 'promoted': promoted, 'rejected': list(rejected)}
+
+    async def get_user_stats(self, user_id):
+        async with self.session_scope() as session:
+            totals = await session.get(AnalyticsRollup, ('user', str(user_id)))
+            most_common_key = (await session.execute(_user_digit_query(user_id))).scalar()
+            return _format_user_stats(totals, most_common_key)
+
+    async def get_system_analytics(self):
+        async with self.session_scope() as session:
+            return _format_system_analytics(
+                (await session.execute(_user_counts_query())).one(),
+                await session.get(AnalyticsRollup, ('total', 'all')),
+                await session.get(AnalyticsRollup, ('day', datetime.utcnow().strftime('%Y-%m-%d'))),
+                (await session.execute(_digit_rollup_query())).all()
+            )
+
+    async def get_prediction_page(self, limit=100, cursor=None, **filters):
+        limit = max(1, min(limit, config.HISTORY_PAGE_MAX))
+        async with self.session_scope() as session:
+            rows = (await session.execute(AdvancedDatabaseManager._history_query(cursor, **filters).limit(limit))).all()
+        page = [AdvancedDatabaseManager._history_row(row) for row in rows]
+        next_cursor = encode_history_cursor(rows[-1].timestamp, rows[-1].id) if len(rows) == limit else None
+        return page, next_cursor
+
+    async def iter_prediction_history(self, cursor=None, limit=None, chunk_size=None, **filters):
+        chunk_size = chunk_size or config.HISTORY_STREAM_CHUNK_SIZE
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            async with self.session_scope() as session:
+                rows = (await session.execute(AdvancedDatabaseManager._history_query(cursor, **filters).limit(size))).all()
+            for row in rows:
+                yield AdvancedDatabaseManager._history_row(row)
+            if len(rows) < size:
+                return
+            cursor = encode_history_cursor(rows[-1].timestamp, rows[-1].id)
+            if remaining is not None:
+                remaining -= len(rows)
+
+    async def iter_user_export(self, user_id, table='predictions', chunk_size=None):
+        model = EXPORT_TABLES[table]
+        chunk_size = chunk_size or config.EXPORT_CHUNK_SIZE
+        await asyncio.to_thread(self.sync_manager.flush_predictions)
+        archive = self.sync_manager.archive
+        cutoff = archive.cutoff(model.__tablename__)
+        if cutoff is not None:
+            # Parquet reads are blocking, so pull each archived batch in a worker thread
+            batches = archive.iter_batches(model.__tablename__, EXPORT_COLUMNS[table], user_id, chunk_size)
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                yield batch
+        last = None
+        while True:
+            async with self.session_scope() as session:
+                rows = (await session.execute(_export_query(model, user_id, chunk_size, last, cutoff))).all()
+            if not rows:
+                return
+            yield [dict(row._mapping) for row in rows]
+            if len(rows) < chunk_size:
+                return
+            last = rows[-1]
+
+    async def export_user_data(self, user_id, format='json'):
+        return {
+            'predictions': [_json_export_row('predictions', row) async for chunk in self.iter_user_export(user_id, 'predictions') for row in chunk],
+            'feedbacks': [_json_export_row('feedback', row) async for chunk in self.iter_user_export(user_id, 'feedback') for row in chunk]
+        }
+
+async def _run_mixed_load(operation, concurrency, operations):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await operation(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(i) for i in range(operations)))
+    elapsed = time.perf_counter() - start
+    return {
+        'ops_per_sec': operations / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p95_ms': float(np.percentile(latencies, 95) * 1000)
+    }
+
+async def benchmark_async_database(concurrency=200, operations=5000, write_ratio=0.2, db_path='data/benchmark_async.db'):
+    """Mixed read/write load at fixed concurrency: async manager vs the sync manager behind a thread hop."""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    sync_manager = AdvancedDatabaseManager(f'sqlite:///{db_path}')
+    async_manager = AsyncDatabaseManager(sync_manager)
+    user_id = sync_manager.add_user('bench_user')
+    rng = np.random.default_rng(0)
+    kinds = rng.random(operations)
+    prediction = dict(user_id=user_id, predicted_digit=3, confidence=0.9, image_path=None, user_input_type='benchmark',
+                      file_name=None, processing_time=0.01, image_size='28x28', model_version='benchmark')
+
+    async def async_operation(i):
+        if kinds[i] < write_ratio:
+            await async_manager.add_prediction(**prediction)
+        elif i % 2:
+            await async_manager.get_user_stats(user_id)
+        else:
+            await async_manager.get_prediction_page(limit=20, user_id=user_id)
+
+    async def sync_operation(i):
+        if kinds[i] < write_ratio:
+            await asyncio.to_thread(sync_manager.add_prediction, **prediction)
+        elif i % 2:
+            await asyncio.to_thread(sync_manager.get_user_stats, user_id)
+        else:
+            await asyncio.to_thread(sync_manager.get_prediction_page, limit=20, user_id=user_id)
+
+    results = {
+        'async': await _run_mixed_load(async_operation, concurrency, operations),
+        'sync': await _run_mixed_load(sync_operation, concurrency, operations)
+    }
+    await async_manager.close()
+    sync_manager.engine.dispose()
+    os.remove(db_path)
+    for name, result in results.items():
+        print(f"{name}: {result['ops_per_sec']:.0f} ops/s, p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms")
+    return results
+
+# Only built in async mode; the async manager talks to a single database, so sharded storage stays on the sync router
+async_db_manager = AsyncDatabaseManager() if config.DB_ACCESS_MODE == 'async' and not db_manager.sharded else None
+
+if __name__ == "__main__":
+    asyncio.run(benchmark_async_database())
@@ -2,14 +2,94 @@ import os
 from datetime import datetime
 class Config:
     DATABASE_URL = 'sqlite:///db.db'
+    # Async driver per dialect; the async manager's URL is always DATABASE_URL with this driver swapped in
+    ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg', 'mysql': 'aiomysql'}
+    DB_ACCESS_MODE = 'sync'
+    DB_POOL_SIZE = 10
+    DB_MAX_OVERFLOW = 20
+    DB_POOL_TIMEOUT = 30
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_BUSY_TIMEOUT_MS = 5000
+    STORAGE_MODE = 'single'
+    SHARD_COUNT = 4
+    SHARD_URL_TEMPLATE = 'sqlite:///data/shards/shard_{index}.db'
+    PREDICTION_WRITE_MODE = 'buffered'
+    WRITE_BEHIND_BATCH_SIZE = 200
+    WRITE_BEHIND_FLUSH_INTERVAL_MS = 250
+    WRITE_BEHIND_MAX_QUEUE = 10000
+    WRITE_BEHIND_PUT_TIMEOUT = 5
+    WRITE_BEHIND_MAX_ATTEMPTS = 3
+    WRITE_BEHIND_SPILL_PATH = 'data/prediction_spill.jsonl'
+    # Ids each process reserves at a time; feedback and custom dataset ids drive the training watermarks, so they
+    # stay at one to keep them in commit order across processes
+    ID_BLOCK_SIZES = {'prediction_history': 1000}
+    HISTORY_PAGE_MAX = 1000
+    HISTORY_STREAM_CHUNK_SIZE = 500
+    EXPORT_CHUNK_SIZE = 5000
+    FEEDBACK_BATCH_MAX = 10000
+    ARCHIVE_PATH = 'data/archive'
+    HOT_RETENTION_DAYS = 180
+    ARCHIVE_BATCH_SIZE = 5000
+    ARCHIVE_COMPRESSION = 'zstd'
+    EVENT_SINK_BACKEND = 'database'
+    EVENT_BATCH_SIZE = 500
+    EVENT_FLUSH_INTERVAL_MS = 1000
+    EVENT_QUEUE_MAX = 50000
+    EVENT_SAMPLE_RATES = {'request': 0.1, 'preprocess': 0.01}
+    EVENT_LOG_PATH = 'logs/events'
+    EVENT_FILE_MAX_BYTES = 50 * 1024 * 1024
+    EVENT_RETENTION_DAYS = 30
+    EVENT_RETENTION_CHECK_SECONDS = 3600
     MODEL_PATH = 'models/handwriting_model.h5'
     UPLOAD_FOLDER = 'data/uploaded'
     CUSTOM_DATASET_PATH = 'data/custom_dataset'
+    PACKED_DATASET_PATH = 'data/custom_dataset/packed'
+    PACKED_SHARD_SIZE = 8192
+    MIX_CUSTOM_DATASET_IN_TRAINING = False
     STATIC_FOLDER = 'static'
     IMG_HEIGHT = 28
     IMG_WIDTH = 28
     BATCH_SIZE = 32
     EPOCHS = 1
+    AUGMENTATION_COPIES = 2
+    AUGMENTATION_SEED = None  # materialised augmented data is only cached when this is set
+    AUGMENTATION_WORKERS = os.cpu_count() or 1
+    TRAINING_INPUT_PIPELINE = 'tf_data'
+    SHUFFLE_BUFFER_SIZE = 10000
+    DATASET_CACHE_PATH = 'data/cache'
+    DATASET_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+    TRAINING_CANCEL_GRACE_PERIOD = 30
+    MODEL_HISTORY_PATH = 'models/model_history'
+    FINE_TUNE_EPOCHS = 3
+    FINE_TUNE_LEARNING_RATE = 1e-4
+    FINE_TUNE_REPLAY_RATIO = 4
+    FINE_TUNE_MIN_REPLAY = 1000
+    TUNING_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+    TUNING_SUBSAMPLE = 0.2
+    TUNING_SEED = 42
+    TUNING_MAX_EPOCHS = 50
+    TUNING_ORACLE_HOST = '127.0.0.1'
+    TUNING_ORACLE_PORT = 8008
+    LATENCY_BUDGETS_MS = {1: 2.0, 32: 8.0}
+    LATENCY_SEARCH_TRIALS = 30
+    LATENCY_SEARCH_EPOCHS = 5
+    LATENCY_ACCURACY_BAR = 0.98
+    DISTILLATION_TEMPERATURE = 4.0
+    DISTILLATION_ALPHA = 0.1
+    DISTILLATION_EPOCHS = 10
+    CASCADE_ENABLED = False
+    CASCADE_FAST_MODEL_PATH = None
+    CASCADE_CONFIDENCE_THRESHOLD = 0.9
+    CASCADE_MARGIN_THRESHOLD = 0.3
+    TRAINING_INSTRUMENTATION = 'basic'
+    INTRA_OP_THREADS = None
+    INTER_OP_THREADS = None
+    THREADING_AUTOTUNE_PATH = 'models/threading_autotune.json'
+    THREADING_AUTOTUNE_STEPS = 50
+    USE_AUTOTUNED_BATCH_SIZE = False
+    CHECKPOINT_PATH = 'models/checkpoints'
+    CHECKPOINT_EVERY_EPOCHS = 1
     MAX_FILE_SIZE = 50 * 1024 * 1024  
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp', 'pdf', 'txt'}
     ENABLE_REAL_TIME_TRAINING = True
@@ -20,6 +100,16 @@ class Config:
     def get_timestamp():
         return datetime.now().strftime("%Y%m%d_%H%M%S")
     
+    @classmethod
+    def async_database_url(cls, url=None):
+        scheme, rest = (url or cls.DATABASE_URL).split('://', 1)
+        dialect = scheme.split('+', 1)[0]
+        return f"{dialect}+{cls.ASYNC_DRIVERS[dialect]}://{rest}"
+    
+    @classmethod
+    def shard_urls(cls, count=None):
+        return [cls.SHARD_URL_TEMPLATE.format(index=i) for i in range(count or cls.SHARD_COUNT)]
+    
     @staticmethod
     def create_directories():
         """Create necessary directories"""
@@ -29,6 +119,10 @@ class Config:
             'data/uploaded/documents',
             'data/uploaded/drawings',
             'data/custom_dataset',
+            'data/custom_dataset/packed',
+            'data/cache',
+            'data/shards',
+            'logs/events',
             'static/css',
             'static/images'
         ]
@@ -0,0 +1,166 @@
+import io
+import csv
+import json
+import zlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from database import EXPORT_COLUMNS
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
+
+PARQUET_SCHEMAS = {
+    'predictions': pa.schema([
+        ('id', pa.int64()),
+        ('timestamp', pa.timestamp('us')),
+        ('predicted_digit', pa.int64()),
+        ('confidence', pa.float64()),
+        ('user_input_type', pa.string()),
+        ('processing_time', pa.float64()),
+        ('model_version', pa.string())
+    ]),
+    'feedback': pa.schema([
+        ('id', pa.int64()),
+        ('prediction_id', pa.int64()),
+        ('timestamp', pa.timestamp('us')),
+        ('actual_digit', pa.int64()),
+        ('correct_prediction', pa.bool_()),
+        ('confidence_rating', pa.int64()),
+        ('comments', pa.string())
+    ])
+}
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object whose buffered bytes are drained by the caller after each row group."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+def export_filename(user_id, table, format, compress=False):
+    extension = EXPORT_FORMATS[format][1]
+    return f"{table}_{user_id}.{extension}" + ('.gz' if compress else '')
+
+class _CsvEncoder:
+    def __init__(self, table):
+        self.buffer = io.StringIO()
+        self.writer = csv.DictWriter(self.buffer, fieldnames=EXPORT_COLUMNS[table])
+
+    def _drain(self):
+        data = self.buffer.getvalue().encode('utf-8')
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def start(self):
+        self.writer.writeheader()
+        return self._drain()
+
+    def encode(self, rows):
+        self.writer.writerows(rows)
+        return self._drain()
+
+    def finish(self):
+        return b''
+
+class _NdjsonEncoder:
+    def __init__(self, table):
+        pass
+
+    def start(self):
+        return b''
+
+    def encode(self, rows):
+        return ''.join(json.dumps(row, default=str) + '\n' for row in rows).encode('utf-8')
+
+    def finish(self):
+        return b''
+
+class _ParquetEncoder:
+    # Each DB chunk becomes one row group, flushed to the client before the next chunk is read
+    def __init__(self, table):
+        self.schema = PARQUET_SCHEMAS[table]
+        self.sink = _ChunkSink()
+        self.writer = None
+
+    def start(self):
+        self.writer = pq.ParquetWriter(self.sink, self.schema)
+        return self.sink.drain()
+
+    def encode(self, rows):
+        self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+        return self.sink.drain()
+
+    def finish(self):
+        self.writer.close()
+        return self.sink.drain()
+
+ENCODERS = {'csv': _CsvEncoder, 'ndjson': _NdjsonEncoder, 'parquet': _ParquetEncoder}
+
+class _GzipEncoder:
+    def __init__(self, inner):
+        self.inner = inner
+        self.compressor = zlib.compressobj(wbits=31)
+
+    def start(self):
+        return self.compressor.compress(self.inner.start())
+
+    def encode(self, rows):
+        return self.compressor.compress(self.inner.encode(rows))
+
+    def finish(self):
+        return self.compressor.compress(self.inner.finish()) + self.compressor.flush()
+
+def _make_encoder(table, format, compress):
+    if table not in EXPORT_COLUMNS:
+        raise ValueError(f"Unknown export table: {table}")
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {format}")
+    encoder = ENCODERS[format](table)
+    return _GzipEncoder(encoder) if compress else encoder
+
+def stream_user_export(db_manager, user_id, table='predictions', format='csv', compress=False):
+    """Generate the bytes of a user export without materialising it in memory or on disk."""
+    encoder = _make_encoder(table, format, compress)
+
+    def generate():
+        yield encoder.start()
+        for rows in db_manager.iter_user_export(user_id, table):
+            data = encoder.encode(rows)
+            if data:
+                yield data
+        yield encoder.finish()
+    return generate()
+
+def astream_user_export(async_db_manager, user_id, table='predictions', format='csv', compress=False):
+    """Async counterpart of stream_user_export, reading chunks through the async database manager."""
+    encoder = _make_encoder(table, format, compress)
+
+    async def generate():
+        yield encoder.start()
+        async for rows in async_db_manager.iter_user_export(user_id, table):
+            data = encoder.encode(rows)
+            if data:
+                yield data
+        yield encoder.finish()
+    return generate()
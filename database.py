@@ -1,13 +1,33 @@
 import sqlite3
-import pandas as pd
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, Text, Boolean, JSON, func
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, Text, Boolean, JSON, Index, MetaData, Table, and_, case, func, inspect, literal, or_, select, text, event, desc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from collections import defaultdict
+from contextlib import contextmanager
+import base64
+import itertools
+import logging
+import queue
+import threading
+import time
+import zlib
 from sqlalchemy import ForeignKey
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pyarrow.dataset as ds
 from config import config
+from archive import ArchiveStore, archive_store
+from event_sink import event_sink
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 class User(Base):
@@ -41,6 +61,7 @@ class UserFeedback(Base):
     
     id = Column(Integer, primary_key=True)
     prediction_id = Column(Integer, ForeignKey('prediction_history.id'))
+    # Owner of the labelled prediction, so feedback lives on the prediction's shard; labeler_id is who sent the label
     user_id = Column(Integer, ForeignKey('users.id'))
     timestamp = Column(DateTime, default=datetime.utcnow)
     actual_digit = Column(Integer)
@@ -48,6 +69,7 @@ class UserFeedback(Base):
     confidence_rating = Column(Integer)  
     comments = Column(Text)
     suggested_improvement = Column(Text)
+    labeler_id = Column(Integer)
 
 class ModelPerformance(Base):
     __tablename__ = 'model_performance'
@@ -61,6 +83,8 @@ class ModelPerformance(Base):
     training_time = Column(Float)
     model_architecture = Column(Text)
     hyperparameters = Column(JSON)
+    model_version = Column(String(100), index=True)
+    evaluation = Column(JSON)
 
 class CustomDataset(Base):
     __tablename__ = 'custom_dataset'
@@ -74,6 +98,20 @@ class CustomDataset(Base):
     dataset_type = Column(String(50))  
     meta_data = Column(JSON)
 
+class ModelVersion(Base):
+    __tablename__ = 'model_versions'
+    
+    id = Column(Integer, primary_key=True)
+    version = Column(String(100), unique=True, nullable=False)
+    model_path = Column(String(500))
+    parent_version = Column(String(100))
+    training_type = Column(String(50))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    feedback_watermark = Column(Integer, default=0)
+    custom_dataset_watermark = Column(Integer, default=0)
+    metrics = Column(JSON)
+    is_active = Column(Boolean, default=False)
+
 class SystemLog(Base):
     __tablename__ = 'system_logs'
     
@@ -83,165 +121,1463 @@ class SystemLog(Base):
     module = Column(String(100))
     message = Column(Text)
     user_id = Column(Integer, ForeignKey('users.id'))
+    event_type = Column(String(50))
+    data = Column(JSON)
+
+class AnalyticsRollup(Base):
+    __tablename__ = 'analytics_rollups'
+    
+    # scope is one of 'total', 'day', 'digit', 'user', 'user_digit'; key identifies the bucket within it
+    scope = Column(String(20), primary_key=True)
+    key = Column(String(100), primary_key=True)
+    predictions = Column(Integer, default=0, nullable=False)
+    confidence_sum = Column(Float, default=0.0, nullable=False)
+    processing_time_sum = Column(Float, default=0.0, nullable=False)
+    feedback = Column(Integer, default=0, nullable=False)
+    correct_feedback = Column(Integer, default=0, nullable=False)
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(200))
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+class IdBlock(Base):
+    __tablename__ = 'id_blocks'
+    
+    # Next id no process has reserved yet, per sharded table
+    table_name = Column(String(50), primary_key=True)
+    next_id = Column(Integer, nullable=False)
 
 User.predictions = relationship("PredictionHistory", order_by=PredictionHistory.id, back_populates="user")
 
+# Hot query paths: per-user history ordered by time, today's counts, feedback lookups by prediction
+prediction_user_timestamp_index = Index('ix_prediction_history_user_timestamp', PredictionHistory.user_id, PredictionHistory.timestamp)
+prediction_timestamp_index = Index('ix_prediction_history_timestamp', PredictionHistory.timestamp)
+feedback_user_timestamp_index = Index('ix_user_feedback_user_timestamp', UserFeedback.user_id, UserFeedback.timestamp)
+feedback_prediction_index = Index('ix_user_feedback_prediction_id', UserFeedback.prediction_id)
+# Retention purges of old system events
+system_log_timestamp_index = Index('ix_system_logs_timestamp', SystemLog.timestamp)
+
+ROLLUP_COUNTERS = ('predictions', 'confidence_sum', 'processing_time_sum', 'feedback', 'correct_feedback')
+
+def _new_rollup_deltas():
+    return defaultdict(lambda: dict.fromkeys(ROLLUP_COUNTERS, 0))
+
+def _rollup_keys(user_id, digit, day):
+    keys = [('total', 'all'), ('day', day)]
+    if digit is not None:
+        keys.append(('digit', str(digit)))
+    if user_id is not None:
+        keys.append(('user', str(user_id)))
+        if digit is not None:
+            keys.append(('user_digit', f'{user_id}:{digit}'))
+    return keys
+
+def _add_prediction_deltas(deltas, user_id, digit, day, count=1, confidence_sum=0.0, processing_time_sum=0.0):
+    for key in _rollup_keys(user_id, digit, day):
+        deltas[key]['predictions'] += count
+        deltas[key]['confidence_sum'] += confidence_sum or 0.0
+        deltas[key]['processing_time_sum'] += processing_time_sum or 0.0
+
+def _add_feedback_deltas(deltas, user_id, actual_digit, day, count=1, correct=0):
+    # Feedback is bucketed by the digit the user says was drawn, predictions by the digit predicted
+    for key in _rollup_keys(user_id, actual_digit, day):
+        deltas[key]['feedback'] += count
+        deltas[key]['correct_feedback'] += correct or 0
+
+def _apply_rollup_deltas(conn, deltas):
+    if not deltas:
+        return
+    table = AnalyticsRollup.__table__
+    rows = [{'scope': scope, 'key': key, **counters} for (scope, key), counters in deltas.items()]
+    dialect = conn.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        stmt = (sqlite_insert if dialect == 'sqlite' else postgresql_insert)(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['scope', 'key'],
+            set_={name: table.c[name] + stmt.excluded[name] for name in ROLLUP_COUNTERS}
+        )
+        conn.execute(stmt, rows)
+        return
+    for row in rows:
+        updated = conn.execute(
+            table.update().where((table.c.scope == row['scope']) & (table.c.key == row['key'])).values(
+                {name: table.c[name] + row[name] for name in ROLLUP_COUNTERS}
+            )
+        )
+        if updated.rowcount == 0:
+            conn.execute(table.insert().values(row))
+
+# Per-connection scratch table for bulk feedback, so correctness and rejects are computed by joins in the database
+FEEDBACK_STAGING = Table(
+    'feedback_staging', MetaData(),
+    Column('position', Integer, primary_key=True),
+    Column('feedback_id', Integer),
+    Column('dataset_id', Integer),
+    Column('prediction_id', Integer),
+    Column('user_id', Integer),
+    Column('actual_digit', Integer),
+    Column('confidence_rating', Integer),
+    Column('comments', Text),
+    Column('suggested_improvement', Text),
+    prefixes=['TEMPORARY']
+)
+
+def _insert_feedback_batch(conn, rows, timestamp, promote=False, dataset_type='training', explicit_ids=False):
+    """Insert staged feedback rows whose prediction exists, in the caller's transaction.
+
+    A staged row's user_id is the labeler; the feedback and any promoted image are stored under the prediction's owner.
+
+    Returns (accepted, promoted, rejected positions); rollups are updated for the accepted rows.
+    """
+    staging = FEEDBACK_STAGING
+    prediction = PredictionHistory.__table__
+    staging.create(conn, checkfirst=True)
+    conn.execute(staging.delete())
+    conn.execute(staging.insert(), rows)
+    on_prediction = prediction.c.id == staging.c.prediction_id
+    matched = staging.join(prediction, on_prediction)
+    is_correct = prediction.c.predicted_digit == staging.c.actual_digit
+    stamp = literal(timestamp, DateTime)
+    
+    feedback_columns = {
+        'prediction_id': staging.c.prediction_id,
+        'user_id': prediction.c.user_id,
+        'labeler_id': staging.c.user_id,
+        'timestamp': stamp,
+        'actual_digit': staging.c.actual_digit,
+        'correct_prediction': is_correct,
+        'confidence_rating': staging.c.confidence_rating,
+        'comments': staging.c.comments,
+        'suggested_improvement': staging.c.suggested_improvement
+    }
+    if explicit_ids:
+        feedback_columns['id'] = staging.c.feedback_id
+    conn.execute(UserFeedback.__table__.insert().from_select(
+        list(feedback_columns), select(*feedback_columns.values()).select_from(matched).order_by(staging.c.position)
+    ))
+    
+    deltas = _new_rollup_deltas()
+    accepted = 0
+    day = timestamp.strftime('%Y-%m-%d')
+    for user_id, digit, count, correct in conn.execute(
+        select(prediction.c.user_id, staging.c.actual_digit, func.count(), func.sum(case((is_correct, 1), else_=0)))
+        .select_from(matched).group_by(prediction.c.user_id, staging.c.actual_digit)
+    ):
+        _add_feedback_deltas(deltas, user_id, digit, day, count, correct)
+        accepted += count
+    _apply_rollup_deltas(conn, deltas)
+    
+    promoted = 0
+    if promote:
+        # Labels from feedback are human-reviewed, so promoted images go straight into the verified training set
+        dataset_columns = {
+            'user_id': prediction.c.user_id,
+            'timestamp': stamp,
+            'image_path': prediction.c.image_path,
+            'actual_digit': staging.c.actual_digit,
+            'is_verified': literal(True),
+            'dataset_type': literal(dataset_type),
+            'meta_data': literal({'source': 'feedback'}, JSON)
+        }
+        if explicit_ids:
+            dataset_columns['id'] = staging.c.dataset_id
+        promoted = conn.execute(CustomDataset.__table__.insert().from_select(
+            list(dataset_columns),
+            select(*dataset_columns.values()).select_from(matched)
+            .where(prediction.c.image_path.isnot(None)).order_by(staging.c.position)
+        )).rowcount
+    
+    rejected = conn.execute(
+        select(staging.c.position).select_from(staging.outerjoin(prediction, on_prediction))
+        .where(prediction.c.id.is_(None)).order_by(staging.c.position)
+    ).scalars().all()
+    conn.execute(staging.delete())
+    return accepted, promoted, rejected
+
+def _rebuild_rollups(conn, archive=None, owns_user=None):
+    conn.execute(AnalyticsRollup.__table__.delete())
+    deltas = _new_rollup_deltas()
+    prediction_cutoff = archive.cutoff('prediction_history') if archive else None
+    feedback_cutoff = archive.cutoff('user_feedback') if archive else None
+    
+    prediction_query = select(
+        PredictionHistory.user_id,
+        PredictionHistory.predicted_digit,
+        func.date(PredictionHistory.timestamp),
+        func.count(PredictionHistory.id),
+        func.sum(PredictionHistory.confidence),
+        func.sum(PredictionHistory.processing_time)
+    ).group_by(PredictionHistory.user_id, PredictionHistory.predicted_digit, func.date(PredictionHistory.timestamp))
+    if prediction_cutoff:
+        prediction_query = prediction_query.where(PredictionHistory.timestamp >= prediction_cutoff)
+    for user_id, digit, day, count, confidence_sum, processing_time_sum in conn.execute(prediction_query):
+        _add_prediction_deltas(deltas, user_id, digit, str(day), count, confidence_sum, processing_time_sum)
+    
+    feedback_query = select(
+        UserFeedback.user_id,
+        UserFeedback.actual_digit,
+        func.date(UserFeedback.timestamp),
+        func.count(UserFeedback.id),
+        func.sum(case((UserFeedback.correct_prediction == True, 1), else_=0))
+    ).group_by(UserFeedback.user_id, UserFeedback.actual_digit, func.date(UserFeedback.timestamp))
+    if feedback_cutoff:
+        feedback_query = feedback_query.where(UserFeedback.timestamp >= feedback_cutoff)
+    for user_id, digit, day, count, correct in conn.execute(feedback_query):
+        _add_feedback_deltas(deltas, user_id, digit, str(day), count, correct)
+    
+    if archive:
+        owns_user = owns_user or (lambda user_id: True)
+        for row in archive.aggregate_by_day('prediction_history', ['user_id', 'predicted_digit'], ['confidence', 'processing_time']):
+            if not owns_user(row['user_id']):
+                continue
+            _add_prediction_deltas(deltas, row['user_id'], row['predicted_digit'], row['day'], row['timestamp_count'],
+                                   row['confidence_sum'], row['processing_time_sum'])
+        for row in archive.aggregate_by_day('user_feedback', ['user_id', 'actual_digit'], ['correct_prediction']):
+            if not owns_user(row['user_id']):
+                continue
+            _add_feedback_deltas(deltas, row['user_id'], row['actual_digit'], row['day'], row['timestamp_count'],
+                                 int(row['correct_prediction_sum'] or 0))
+    _apply_rollup_deltas(conn, deltas)
+
+ARCHIVE_TABLES = {'prediction_history': PredictionHistory, 'user_feedback': UserFeedback}
+EXPORT_TABLES = {'predictions': PredictionHistory, 'feedback': UserFeedback}
+EXPORT_COLUMNS = {
+    'predictions': ['id', 'timestamp', 'predicted_digit', 'confidence', 'user_input_type', 'processing_time', 'model_version'],
+    'feedback': ['id', 'prediction_id', 'timestamp', 'actual_digit', 'correct_prediction', 'confidence_rating', 'comments']
+}
+EXPORT_COLUMNS_BY_TABLE = {EXPORT_TABLES[name].__tablename__: columns for name, columns in EXPORT_COLUMNS.items()}
+# format=json keeps its original field names and fields; the streamed formats carry EXPORT_COLUMNS
+JSON_EXPORT_FIELDS = {
+    'predictions': {'timestamp': 'timestamp', 'predicted_digit': 'predicted_digit', 'confidence': 'confidence',
+                    'input_type': 'user_input_type', 'processing_time': 'processing_time'},
+    'feedback': {'timestamp': 'timestamp', 'actual_digit': 'actual_digit', 'correct_prediction': 'correct_prediction',
+                 'confidence_rating': 'confidence_rating', 'comments': 'comments'}
+}
+
+def _json_export_row(table, row):
+    return {field: row[column] for field, column in JSON_EXPORT_FIELDS[table].items()}
+
+def encode_history_cursor(timestamp, prediction_id):
+    return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{prediction_id}'.encode()).decode()
+
+def _export_query(model, user_id, chunk_size, last=None, since=None):
+    query = select(*[getattr(model, name) for name in EXPORT_COLUMNS_BY_TABLE[model.__tablename__]]).where(model.user_id == user_id)
+    if since is not None:
+        query = query.where(model.timestamp >= since)
+    if last is not None:
+        query = query.where(or_(
+            model.timestamp > last.timestamp,
+            and_(model.timestamp == last.timestamp, model.id > last.id)
+        ))
+    return query.order_by(model.timestamp, model.id).limit(chunk_size)
+
+def decode_history_cursor(cursor):
+    try:
+        timestamp, prediction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(prediction_id)
+    except Exception:
+        raise ValueError(f"Invalid history cursor: {cursor}")
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a writer commits; NORMAL only syncs at checkpoints under WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT_MS)}")
+    cursor.close()
+
+def _user_digit_query(user_id):
+    # Keys are '<user_id>:<digit>', so the range below stays on the primary key
+    return select(AnalyticsRollup.key).where(
+        AnalyticsRollup.scope == 'user_digit',
+        AnalyticsRollup.key >= f'{user_id}:',
+        AnalyticsRollup.key < f'{user_id};',
+        AnalyticsRollup.predictions > 0
+    ).order_by(AnalyticsRollup.predictions.desc(), AnalyticsRollup.key).limit(1)
+
+def _format_user_stats(totals, most_common_key):
+    if totals is None or not totals.predictions:
+        return None
+    return {
+        'total_predictions': totals.predictions,
+        'user_accuracy': totals.correct_feedback / totals.feedback if totals.feedback else 0,
+        'average_confidence': totals.confidence_sum / totals.predictions,
+        'average_processing_time': totals.processing_time_sum / totals.predictions,
+        'most_common_digit': int(most_common_key.split(':')[1]) if most_common_key else None,
+        'feedback_count': totals.feedback
+    }
+
+def _user_counts_query():
+    return select(func.count(User.id), func.sum(case((User.is_active == True, 1), else_=0)))
+
+def _digit_rollup_query():
+    return select(AnalyticsRollup.key, AnalyticsRollup.predictions).where(
+        AnalyticsRollup.scope == 'digit', AnalyticsRollup.predictions > 0
+    )
+
+def _format_system_analytics(user_counts, totals, today, digit_rows):
+    total_users, active_users = user_counts
+    return {
+        'total_users': total_users,
+        'active_users': active_users or 0,
+        'total_predictions': totals.predictions if totals else 0,
+        'today_predictions': today.predictions if today else 0,
+        'system_accuracy': totals.correct_feedback / totals.feedback if totals and totals.feedback else 0,
+        'digit_distribution': {int(key): count for key, count in digit_rows}
+    }
+
+def _create_indexes(*indexes):
+    def migrate(conn):
+        for index in indexes:
+            if inspect(conn).has_table(index.table.name):
+                index.create(conn, checkfirst=True)
+    return migrate
+
+def _add_columns(table, *column_names):
+    # Fresh databases already have these from create_all; older ones get them with ALTER TABLE
+    def migrate(conn):
+        inspector = inspect(conn)
+        if not inspector.has_table(table.name):
+            return
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for name in column_names:
+            if name not in existing:
+                column_type = table.c[name].type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}'))
+    return migrate
+
+# Tables that live on the shard databases when STORAGE_MODE is 'sharded'; everything else stays on DATABASE_URL
+SHARD_TABLES = ('prediction_history', 'user_feedback', 'custom_dataset', 'analytics_rollups', 'schema_migrations')
+SHARDED_MODELS = (PredictionHistory, UserFeedback, CustomDataset)
+
+def shard_for_user(user_id, shard_count):
+    if shard_count <= 1 or user_id is None:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+def _merge_rollups(rows):
+    rows = [row for row in rows if row is not None]
+    if not rows:
+        return None
+    return AnalyticsRollup(scope=rows[0].scope, key=rows[0].key,
+                           **{name: sum(getattr(row, name) or 0 for row in rows) for name in ROLLUP_COUNTERS})
+
+# Applied in order at startup; append new entries, never edit or renumber applied ones
+MIGRATIONS = [
+    (1, 'prediction_and_feedback_indexes', _create_indexes(
+        prediction_user_timestamp_index,
+        prediction_timestamp_index,
+        feedback_user_timestamp_index,
+        feedback_prediction_index
+    )),
+    (2, 'analytics_rollups', _rebuild_rollups),
+    (3, 'system_log_timestamp_index', _create_indexes(system_log_timestamp_index)),
+    (4, 'model_performance_version_columns', _add_columns(ModelPerformance.__table__, 'model_version', 'evaluation')),
+    (5, 'system_log_event_columns', _add_columns(SystemLog.__table__, 'event_type', 'data')),
+    (6, 'feedback_labeler_column', _add_columns(UserFeedback.__table__, 'labeler_id')),
+]
+
+class PredictionWriteBuffer:
+    """Write-behind queue for prediction rows: ids are handed out up front and rows are inserted in batched transactions.
+
+    Ids come from blocks each process reserves in the main database's id_blocks table, so several processes can write
+    through their own buffers at once.
+
+    A batch that still fails after WRITE_BEHIND_MAX_ATTEMPTS is appended to the spill file and replayed on the next
+    start(); flush() and stop() raise once for rows spilled since the last report.
+    """
+    
+    def __init__(self, db_manager, batch_size=None, flush_interval_ms=None, max_queue=None, spill_path=None):
+        self.db_manager = db_manager
+        self.batch_size = batch_size or config.WRITE_BEHIND_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms or config.WRITE_BEHIND_FLUSH_INTERVAL_MS) / 1000
+        self.queue = queue.Queue(maxsize=max_queue or config.WRITE_BEHIND_MAX_QUEUE)
+        self.spill_path = spill_path or config.WRITE_BEHIND_SPILL_PATH
+        self.id_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.flushed = threading.Condition()
+        self.submitted = 0
+        self.written = 0
+        self.spilled = 0
+        self.reported_spilled = 0
+        self.worker = None
+    
+    def start(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.replay_spilled()
+            self.stopping.clear()
+            self.worker = threading.Thread(target=self._run, name='prediction-write-behind', daemon=True)
+            self.worker.start()
+    
+    def submit(self, record, block=True):
+        # A record that already holds an id is being resubmitted after a non-blocking attempt found the queue full
+        if 'id' not in record:
+            with self.id_lock:
+                record['id'] = self.db_manager.allocate_id(PredictionHistory)
+        record.setdefault('timestamp', datetime.utcnow())
+        if not block:
+            self.queue.put_nowait(record)
+        else:
+            try:
+                # Blocks callers while the queue is full instead of growing without bound
+                self.queue.put(record, timeout=config.WRITE_BEHIND_PUT_TIMEOUT)
+            except queue.Full:
+                raise RuntimeError("Prediction write queue is full")
+        # Counted only once queued; flush() waits for written + spilled to reach this, and a rejected record never will
+        with self.id_lock:
+            self.submitted += 1
+        return record['id']
+    
+    def flush(self, timeout=None):
+        # Waits until everything submitted so far has been written or spilled
+        with self.id_lock:
+            target = self.submitted
+        deadline = time.time() + (timeout or config.WRITE_BEHIND_PUT_TIMEOUT)
+        with self.flushed:
+            while self.written + self.spilled < target and time.time() < deadline:
+                self.flushed.wait(timeout=self.flush_interval)
+            done = self.written + self.spilled >= target
+        self._raise_for_spilled()
+        return done
+    
+    def stop(self):
+        self.stopping.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        self._raise_for_spilled()
+    
+    def pending(self):
+        return self.queue.qsize()
+    
+    def _raise_for_spilled(self):
+        with self.flushed:
+            lost = self.spilled - self.reported_spilled
+            self.reported_spilled = self.spilled
+        if lost:
+            raise RuntimeError(f"{lost} prediction rows could not be written and were saved to {self.spill_path} for replay")
+    
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+    
+    def _write(self, batch):
+        by_shard = defaultdict(list)
+        for record in batch:
+            by_shard[self.db_manager.shard_for(record['user_id'])].append(record)
+        written = spilled = 0
+        for shard, records in by_shard.items():
+            if self._write_shard(shard, records):
+                written += len(records)
+            else:
+                self._spill(records)
+                spilled += len(records)
+        with self.flushed:
+            self.written += written
+            self.spilled += spilled
+            self.flushed.notify_all()
+    
+    def _write_shard(self, shard, records):
+        for attempt in range(config.WRITE_BEHIND_MAX_ATTEMPTS):
+            try:
+                deltas = _new_rollup_deltas()
+                for record in records:
+                    _add_prediction_deltas(
+                        deltas, record['user_id'], record['predicted_digit'], record['timestamp'].strftime('%Y-%m-%d'),
+                        confidence_sum=record['confidence'], processing_time_sum=record['processing_time']
+                    )
+                with self.db_manager.session_scope(shard) as session:
+                    session.bulk_insert_mappings(PredictionHistory, records)
+                    _apply_rollup_deltas(session.connection(), deltas)
+                return True
+            except Exception as e:
+                logger.error(f"Prediction batch write to shard {shard} failed (attempt {attempt + 1}): {str(e)}")
+                time.sleep(self.flush_interval)
+        return False
+    
+    def _spill(self, records):
+        os.makedirs(os.path.dirname(self.spill_path) or '.', exist_ok=True)
+        with open(self.spill_path, 'a') as f:
+            for record in records:
+                f.write(json.dumps({**record, 'timestamp': record['timestamp'].isoformat()}) + '\n')
+        logger.error(f"Spilled {len(records)} prediction rows to {self.spill_path}")
+    
+    def replay_spilled(self):
+        """Insert rows left in the spill file by earlier failed writes; rows that fail again are spilled again."""
+        replay_path = f"{self.spill_path}.replay"
+        # A replay file left behind by a crash mid-replay is finished first; the spill file is picked up next start
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.spill_path):
+                return 0
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        by_shard = defaultdict(list)
+        for record in records:
+            record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+            by_shard[self.db_manager.shard_for(record['user_id'])].append(record)
+        replayed = 0
+        for shard, shard_records in by_shard.items():
+            if self._write_shard(shard, shard_records):
+                replayed += len(shard_records)
+            else:
+                self._spill(shard_records)
+        os.remove(replay_path)
+        logger.info(f"Replayed {replayed} of {len(records)} spilled prediction rows")
+        return replayed
+
 class AdvancedDatabaseManager:
-    def __init__(self, db_url=None):
+    def __init__(self, db_url=None, archive=None, shard_urls=None):
         self.db_url = db_url or config.DATABASE_URL
-        self.engine = create_engine(self.db_url)
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
-        
-    def add_user(self, username, email=None):
-        user = User(username=username, email=email)
-        self.session.add(user)
-        self.session.commit()
-        return user.id
+        self.archive = archive or archive_store
+        if shard_urls is None:
+            shard_urls = config.shard_urls() if config.STORAGE_MODE == 'sharded' else []
+        self.shard_urls = list(shard_urls)
+        self.sharded = bool(self.shard_urls)
+        self.engine = self._create_engine(self.db_url)
+        self._init_schema(self.engine)
+        # Unsharded, the single database doubles as shard 0 so routing code has one shape
+        self.shard_engines = [self._create_engine(url) for url in self.shard_urls] or [self.engine]
+        if self.sharded:
+            for engine in self.shard_engines:
+                self._init_schema(engine, SHARD_TABLES)
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.shard_sessions = [sessionmaker(bind=engine, expire_on_commit=False) for engine in self.shard_engines]
+        self.id_blocks = {}
+        self.id_lock = threading.RLock()
+        self.prediction_buffer = None
     
-    def add_prediction(self, user_id, predicted_digit, confidence, image_path, user_input_type, file_name, processing_time, image_size, model_version):
-        prediction = PredictionHistory(
-            user_id=user_id,
-            predicted_digit=predicted_digit,
-            confidence=confidence,
-            image_path=image_path,
-            user_input_type=user_input_type,
-            file_name=file_name,
-            processing_time=processing_time,
-            image_size=image_size,
-            model_version=model_version
-        )
-        self.session.add(prediction)
-        self.session.commit()
-        return prediction.id
-    
-    def add_feedback(self, prediction_id, user_id, actual_digit, correct_prediction,confidence_rating=None, comments="", suggested_improvement=""):
-        feedback = UserFeedback(
-            prediction_id=prediction_id,
-            user_id=user_id,
-            actual_digit=actual_digit,
-            correct_prediction=correct_prediction,
-            confidence_rating=confidence_rating,
-            comments=comments,
-            suggested_improvement=suggested_improvement
+    @staticmethod
+    def _create_engine(db_url):
+        is_sqlite = db_url.startswith('sqlite')
+        engine = create_engine(
+            db_url,
+            poolclass=QueuePool,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_pre_ping=True,
+            connect_args={'check_same_thread': False, 'timeout': config.SQLITE_BUSY_TIMEOUT_MS / 1000} if is_sqlite else {}
         )
-        self.session.add(feedback)
-        self.session.commit()
+        if is_sqlite:
+            event.listen(engine, 'connect', set_sqlite_pragmas)
+        return engine
     
-    def add_custom_dataset_entry(self, user_id, image_path, actual_digit,dataset_type='training', meta_data=None):
-        entry = CustomDataset(
-            user_id=user_id,
-            image_path=image_path,
-            actual_digit=actual_digit,
-            dataset_type=dataset_type,
-            meta_data=meta_data or {}
-        )
-        self.session.add(entry)
-        self.session.commit()
-        return entry.id
+    @contextmanager
+    def session_scope(self, shard=None):
+        # One short-lived session per unit of work, checked out of the pool; rolled back on any error.
+        # shard=None is the main database, an index is one of the shards holding per-user rows
+        session = self.Session() if shard is None else self.shard_sessions[shard]()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
     
-    def get_user_stats(self, user_id):
-        predictions = self.session.query(PredictionHistory).filter_by(user_id=user_id).all()
-        feedbacks = self.session.query(UserFeedback).filter_by(user_id=user_id).all()
-        
-        if not predictions:
-            return None
+    def _init_schema(self, engine, table_names=None):
+        tables = [Base.metadata.tables[name] for name in table_names] if table_names else None
+        Base.metadata.create_all(engine, tables=tables)
+        self._apply_migrations(engine)
+    
+    @staticmethod
+    def _apply_migrations(engine):
+        for version, name, migrate in MIGRATIONS:
+            with engine.begin() as conn:
+                applied = conn.execute(
+                    text('SELECT 1 FROM schema_migrations WHERE version = :version'), {'version': version}
+                ).first()
+                if applied:
+                    continue
+                logger.info(f"Applying schema migration {version}: {name}")
+                migrate(conn)
+                conn.execute(
+                    SchemaMigration.__table__.insert().values(version=version, name=name, applied_at=datetime.utcnow())
+                )
+    
+    def schema_version(self):
+        with self.session_scope() as session:
+            return session.query(func.max(SchemaMigration.version)).scalar() or 0
+    
+    def shard_for(self, user_id):
+        return shard_for_user(user_id, len(self.shard_engines))
+    
+    def allocate_id(self, model):
+        """Next id for a per-user table, unique across shards and across processes sharing the main database.
 
-        total_predictions = len(predictions)
-        avg_confidence = np.mean([p.confidence for p in predictions])
-        avg_processing_time = np.mean([p.processing_time for p in predictions])
-        if feedbacks:
-            correct_predictions = sum(1 for f in feedbacks if f.correct_prediction)
-            user_accuracy = correct_predictions / len(feedbacks)
+        Each process takes ID_BLOCK_SIZES[table] ids at a time from id_blocks; with blocks larger than one, ids from
+        different processes interleave out of order and a restart leaves a gap.
+        """
+        name = model.__tablename__
+        with self.id_lock:
+            block = self.id_blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                block = self.id_blocks[name] = self._reserve_id_block(model, config.ID_BLOCK_SIZES.get(name, 1))
+            block[0] += 1
+            return block[0] - 1
+    
+    def cached_id(self, model):
+        """Next id from this process's current block without touching the database; None if that would need a reservation."""
+        # Never waits on the lock, since a holder may be reserving a block; callers on an event loop rely on that
+        if not self.id_lock.acquire(blocking=False):
+            return None
+        try:
+            block = self.id_blocks.get(model.__tablename__)
+            if block is None or block[0] >= block[1]:
+                return None
+            block[0] += 1
+            return block[0] - 1
+        finally:
+            self.id_lock.release()
+    
+    def allocate_ids(self, model, count):
+        """count consecutive ids for a per-user table, reserved from id_blocks in one transaction."""
+        if count <= 0:
+            return range(0)
+        with self.id_lock:
+            start, end = self._reserve_id_block(model, count)
+        return range(start, end)
+    
+    def _explicit_ids(self, model, count):
+        # Batch counterpart of _explicit_id: one reservation for the whole batch, or Nones for autoincrement
+        return iter(self.allocate_ids(model, count)) if self.sharded else itertools.repeat(None)
+    
+    def _reserve_id_block(self, model, size):
+        name = model.__tablename__
+        while True:
+            with self.session_scope() as session:
+                # The update takes the write lock first, so concurrent reservations get disjoint ranges
+                reserved = session.query(IdBlock).filter(IdBlock.table_name == name).update(
+                    {IdBlock.next_id: IdBlock.next_id + size}, synchronize_session=False
+                )
+                if reserved:
+                    end = session.query(IdBlock.next_id).filter(IdBlock.table_name == name).scalar()
+                    return [end - size, end]
+            # First reservation for this table: start past every id already stored on any shard
+            start = 1
+            for shard in range(len(self.shard_engines)):
+                with self.session_scope(shard) as session:
+                    start = max(start, (session.query(func.max(model.id)).scalar() or 0) + 1)
+            try:
+                with self.session_scope() as session:
+                    session.add(IdBlock(table_name=name, next_id=start + size))
+                return [start, start + size]
+            except IntegrityError:
+                # Another process seeded the row first; reserve from it on the next pass
+                continue
+    
+    def _explicit_id(self, model):
+        # Autoincrement is per file, so sharded rows take ids from the shared allocator instead. Predictions always
+        # do, because write-behind buffers hand ids out before their rows reach the database
+        return self.allocate_id(model) if self.sharded or model is PredictionHistory else None
+    
+    def explain_query_plan(self, statement, params=None):
+        # SQLite only: returns the planner's detail lines, e.g. 'SEARCH prediction_history USING INDEX ...'
+        engine = self.shard_engines[0]
+        if not isinstance(statement, str):
+            # Compile the query the app actually runs, with named placeholders so its bound values can be passed back in
+            compiled = statement.compile(dialect=type(engine.dialect)(paramstyle='named'))
+            statement, params = str(compiled), {**compiled.params, **(params or {})}
+        with engine.connect() as conn:
+            rows = conn.execute(text(f'EXPLAIN QUERY PLAN {statement}'), params or {}).fetchall()
+        return [row[-1] for row in rows]
+    
+    def add_user(self, username, email=None):
+        with self.session_scope() as session:
+            user = User(username=username, email=email)
+            session.add(user)
+            session.flush()
+            return user.id
+    
+    def get_user(self, user_id):
+        with self.session_scope() as session:
+            user = session.query(User).filter(User.id == user_id).first()
+            if user is None:
+                return None
+            return {
+                'id': user.id,
+                'username': user.username,
+                'email': user.email,
+                'created_at': user.created_at.isoformat(),
+                'is_active': user.is_active
+            }
+    
+    def get_prediction_history(self, limit=100, user_id=None):
+        rows, _ = self.get_prediction_page(limit=limit, user_id=user_id)
+        return rows
+    
+    def get_prediction_page(self, limit=100, cursor=None, **filters):
+        """One page of history, newest first, plus the cursor for the next page (None on the last page)."""
+        limit = max(1, min(limit, config.HISTORY_PAGE_MAX))
+        rows = self._fetch_history(cursor, limit, filters)
+        page = [self._history_row(row) for row in rows]
+        next_cursor = encode_history_cursor(rows[-1].timestamp, rows[-1].id) if len(rows) == limit else None
+        return page, next_cursor
+    
+    def iter_prediction_history(self, cursor=None, limit=None, chunk_size=None, **filters):
+        # Walks the history in keyset chunks, each in its own short session, so memory stays bounded
+        chunk_size = chunk_size or config.HISTORY_STREAM_CHUNK_SIZE
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            rows = self._fetch_history(cursor, size, filters)
+            for row in rows:
+                yield self._history_row(row)
+            if len(rows) < size:
+                return
+            cursor = encode_history_cursor(rows[-1].timestamp, rows[-1].id)
+            if remaining is not None:
+                remaining -= len(rows)
+    
+    def _fetch_history(self, cursor, size, filters):
+        # A user's rows live on one shard; otherwise every shard contributes its newest rows and the merge keeps the top
+        if filters.get('user_id') is not None:
+            shards = [self.shard_for(filters['user_id'])]
         else:
-            user_accuracy = 0
-        
-        digit_counts = {}
-        for p in predictions:
-            digit_counts[p.predicted_digit] = digit_counts.get(p.predicted_digit, 0) + 1
-        most_common_digit = max(digit_counts.items(), key=lambda x: x[1])[0] if digit_counts else None
-        
+            shards = range(len(self.shard_engines))
+        rows = []
+        for shard in shards:
+            with self.session_scope(shard) as session:
+                rows.extend(session.execute(self._history_query(cursor, **filters).limit(size)).all())
+        if len(shards) > 1:
+            rows.sort(key=lambda row: (row.timestamp, row.id), reverse=True)
+        return rows[:size]
+    
+    @staticmethod
+    def _history_query(cursor=None, user_id=None, digit=None, input_type=None, model_version=None, since=None, until=None):
+        query = select(
+            PredictionHistory.id,
+            PredictionHistory.user_id,
+            PredictionHistory.timestamp,
+            PredictionHistory.predicted_digit,
+            PredictionHistory.confidence,
+            PredictionHistory.user_input_type,
+            PredictionHistory.processing_time,
+            PredictionHistory.model_version
+        )
+        if user_id is not None:
+            query = query.where(PredictionHistory.user_id == user_id)
+        if digit is not None:
+            query = query.where(PredictionHistory.predicted_digit == digit)
+        if input_type:
+            query = query.where(PredictionHistory.user_input_type == input_type)
+        if model_version:
+            query = query.where(PredictionHistory.model_version == model_version)
+        if since is not None:
+            query = query.where(PredictionHistory.timestamp >= since)
+        if until is not None:
+            query = query.where(PredictionHistory.timestamp < until)
+        if cursor:
+            timestamp, last_id = decode_history_cursor(cursor)
+            query = query.where(or_(
+                PredictionHistory.timestamp < timestamp,
+                and_(PredictionHistory.timestamp == timestamp, PredictionHistory.id < last_id)
+            ))
+        return query.order_by(PredictionHistory.timestamp.desc(), PredictionHistory.id.desc())
+    
+    @staticmethod
+    def _history_row(row):
         return {
-            'total_predictions': total_predictions,
-            'user_accuracy': user_accuracy,
-            'average_confidence': avg_confidence,
-            'average_processing_time': avg_processing_time,
-            'most_common_digit': most_common_digit,
-            'feedback_count': len(feedbacks)
+            'id': row.id,
+            'user_id': row.user_id,
+            'timestamp': row.timestamp.isoformat() if row.timestamp else None,
+            'predicted_digit': row.predicted_digit,
+            'confidence': row.confidence,
+            'user_input_type': row.user_input_type,
+            'processing_time': row.processing_time,
+            'model_version': row.model_version
         }
+    
+    def start_write_behind(self):
+        if config.PREDICTION_WRITE_MODE != 'buffered':
+            return
+        if self.prediction_buffer is None:
+            self.prediction_buffer = PredictionWriteBuffer(self)
+        self.prediction_buffer.start()
+    
+    def stop_write_behind(self):
+        buffer, self.prediction_buffer = self.prediction_buffer, None
+        if buffer is not None:
+            buffer.stop()
+    
+    def flush_predictions(self, timeout=None):
+        if self.prediction_buffer is not None:
+            return self.prediction_buffer.flush(timeout)
+        return True
+    
+    def add_prediction(self, user_id, predicted_digit, confidence, image_path, user_input_type, file_name, processing_time, image_size, model_version):
+        if self.prediction_buffer is not None:
+            return self.prediction_buffer.submit({
+                'user_id': user_id,
+                'predicted_digit': predicted_digit,
+                'confidence': confidence,
+                'image_path': image_path,
+                'user_input_type': user_input_type,
+                'file_name': file_name,
+                'processing_time': processing_time,
+                'image_size': image_size,
+                'model_version': model_version
+            })
+        timestamp = datetime.utcnow()
+        with self.session_scope(self.shard_for(user_id)) as session:
+            prediction = PredictionHistory(
+                id=self._explicit_id(PredictionHistory),
+                user_id=user_id,
+                timestamp=timestamp,
+                predicted_digit=predicted_digit,
+                confidence=confidence,
+                image_path=image_path,
+                user_input_type=user_input_type,
+                file_name=file_name,
+                processing_time=processing_time,
+                image_size=image_size,
+                model_version=model_version
+            )
+            session.add(prediction)
+            session.flush()
+            deltas = _new_rollup_deltas()
+            _add_prediction_deltas(
+                deltas, user_id, predicted_digit, timestamp.strftime('%Y-%m-%d'),
+                confidence_sum=confidence, processing_time_sum=processing_time
+            )
+            _apply_rollup_deltas(session.connection(), deltas)
+            return prediction.id
+    
+    def _find_prediction(self, prediction_id, user_id=None):
+        """(shard, owner user_id, predicted_digit) of a stored prediction, or None; user_id's shard is tried first."""
+        first = self.shard_for(user_id)
+        for shard in [first] + [shard for shard in range(len(self.shard_engines)) if shard != first]:
+            with self.session_scope(shard) as session:
+                row = session.query(PredictionHistory.user_id, PredictionHistory.predicted_digit).filter_by(id=prediction_id).first()
+            if row is not None:
+                return shard, row.user_id, row.predicted_digit
+        return None
+    
+    def add_feedback(self, prediction_id, user_id, actual_digit, correct_prediction=None, confidence_rating=None, comments="", suggested_improvement=""):
+        """Record one label from user_id; without correct_prediction it is taken from the stored prediction.
+
+        The feedback is stored under the prediction's owner, so anyone may label it. Returns None if the prediction is missing.
+        """
+        timestamp = datetime.utcnow()
+        found = self._find_prediction(prediction_id, user_id)
+        if found is None and self.prediction_buffer is not None:
+            self.flush_predictions()
+            found = self._find_prediction(prediction_id, user_id)
+        if found is None:
+            return None
+        shard, owner_id, predicted_digit = found
+        if correct_prediction is None:
+            correct_prediction = predicted_digit == actual_digit
+        with self.session_scope(shard) as session:
+            feedback = UserFeedback(
+                id=self._explicit_id(UserFeedback),
+                prediction_id=prediction_id,
+                user_id=owner_id,
+                labeler_id=user_id,
+                timestamp=timestamp,
+                actual_digit=actual_digit,
+                correct_prediction=correct_prediction,
+                confidence_rating=confidence_rating,
+                comments=comments,
+                suggested_improvement=suggested_improvement
+            )
+            session.add(feedback)
+            deltas = _new_rollup_deltas()
+            _add_feedback_deltas(deltas, owner_id, actual_digit, timestamp.strftime('%Y-%m-%d'), correct=int(bool(correct_prediction)))
+            _apply_rollup_deltas(session.connection(), deltas)
+            session.flush()
+            return feedback.id
+    
+    def _prediction_shards(self, prediction_ids):
+        # Shard holding each prediction id; ids found nowhere are left out
+        ids = sorted(set(prediction_ids))
+        shards = {}
+        for shard in range(len(self.shard_engines)):
+            with self.session_scope(shard) as session:
+                for offset in range(0, len(ids), config.ARCHIVE_BATCH_SIZE):
+                    for row in session.query(PredictionHistory.id).filter(PredictionHistory.id.in_(ids[offset:offset + config.ARCHIVE_BATCH_SIZE])):
+                        shards[row.id] = shard
+        return shards
+    
+    def add_feedback_batch(self, items, promote_to_dataset=False, dataset_type='training'):
+        """Record many labels in one transaction per shard, each stored with its prediction; items whose prediction is missing are rejected."""
+        self.flush_predictions()
+        timestamp = datetime.utcnow()
+        prediction_shards = self._prediction_shards(item['prediction_id'] for item in items) if self.sharded else {}
+        feedback_ids = self._explicit_ids(UserFeedback, len(items))
+        dataset_ids = self._explicit_ids(CustomDataset, len(items) if promote_to_dataset else 0)
+        by_shard = defaultdict(list)
+        for position, item in enumerate(items):
+            # Unknown predictions go to the labeler's shard, where the batch insert rejects them
+            shard = prediction_shards.get(item['prediction_id'], self.shard_for(item['user_id']))
+            by_shard[shard].append({
+                'position': position,
+                'feedback_id': next(feedback_ids),
+                'dataset_id': next(dataset_ids) if promote_to_dataset else None,
+                'prediction_id': item['prediction_id'],
+                'user_id': item['user_id'],
+                'actual_digit': item['actual_digit'],
+                'confidence_rating': item.get('confidence_rating'),
+                'comments': item.get('comments', ''),
+                'suggested_improvement': item.get('suggested_improvement', '')
+            })
+        result = {'accepted': 0, 'promoted': 0, 'rejected': []}
+        for shard, rows in by_shard.items():
+            with self.session_scope(shard) as session:
+                accepted, promoted, rejected = _insert_feedback_batch(
+                    session.connection(), rows, timestamp, promote_to_dataset, dataset_type, explicit_ids=self.sharded
+                )
+            result['accepted'] += accepted
+            result['promoted'] += promoted
+            result['rejected'].extend(rejected)
+        result['rejected'].sort()
+        return result
+    
+    def add_custom_dataset_entry(self, user_id, image_path, actual_digit,dataset_type='training', meta_data=None):
+        with self.session_scope(self.shard_for(user_id)) as session:
+            entry = CustomDataset(
+                id=self._explicit_id(CustomDataset),
+                user_id=user_id,
+                image_path=image_path,
+                actual_digit=actual_digit,
+                dataset_type=dataset_type,
+                meta_data=meta_data or {}
+            )
+            session.add(entry)
+            session.flush()
+            return entry.id
+    
+    def get_user_stats(self, user_id):
+        with self.session_scope(self.shard_for(user_id)) as session:
+            totals = session.get(AnalyticsRollup, ('user', str(user_id)))
+            most_common_key = session.execute(_user_digit_query(user_id)).scalar()
+            return _format_user_stats(totals, most_common_key)
+    
+    def get_user_stats_from_history(self, user_id):
+        with self.session_scope(self.shard_for(user_id)) as session:
+            total_predictions, avg_confidence, avg_processing_time = session.query(
+                func.count(PredictionHistory.id),
+                func.avg(PredictionHistory.confidence),
+                func.avg(PredictionHistory.processing_time)
+            ).filter(PredictionHistory.user_id == user_id).one()
+            
+            if not total_predictions:
+                return None
+            
+            feedback_count, correct_predictions = session.query(
+                func.count(UserFeedback.id),
+                func.sum(case((UserFeedback.correct_prediction == True, 1), else_=0))
+            ).filter(UserFeedback.user_id == user_id).one()
+            user_accuracy = (correct_predictions or 0) / feedback_count if feedback_count else 0
+            
+            most_common = session.query(PredictionHistory.predicted_digit).filter(
+                PredictionHistory.user_id == user_id
+            ).group_by(PredictionHistory.predicted_digit).order_by(
+                func.count(PredictionHistory.id).desc(), PredictionHistory.predicted_digit
+            ).first()
+            
+            return {
+                'total_predictions': total_predictions,
+                'user_accuracy': user_accuracy,
+                'average_confidence': avg_confidence,
+                'average_processing_time': avg_processing_time,
+                'most_common_digit': most_common[0] if most_common else None,
+                'feedback_count': feedback_count
+            }
         
     
     def get_system_analytics(self):
-        total_users = self.session.query(User).count()
-        active_users = self.session.query(User).filter_by(is_active=True).count()
-        total_predictions = self.session.query(PredictionHistory).count()
-        recent_predictions = self.session.query(PredictionHistory).filter(
-            PredictionHistory.timestamp >= datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        ).count()
-        feedbacks = self.session.query(UserFeedback).all()
-        if feedbacks:
-            system_accuracy = sum(1 for f in feedbacks if f.correct_prediction) / len(feedbacks)
-        else:
-            system_accuracy = 0
-        digit_stats = self.session.query(
-            PredictionHistory.predicted_digit,
-            func.count(PredictionHistory.id)
-        ).group_by(PredictionHistory.predicted_digit).all()
+        today_key = ('day', datetime.utcnow().strftime('%Y-%m-%d'))
+        with self.session_scope() as session:
+            user_counts = session.execute(_user_counts_query()).one()
+        # Every shard holds partial totals; summing them is one primary-key read per shard
+        totals, today, digit_counts = [], [], defaultdict(int)
+        for shard in range(len(self.shard_engines)):
+            with self.session_scope(shard) as session:
+                totals.append(session.get(AnalyticsRollup, ('total', 'all')))
+                today.append(session.get(AnalyticsRollup, today_key))
+                for key, count in session.execute(_digit_rollup_query()).all():
+                    digit_counts[key] += count
+        return _format_system_analytics(user_counts, _merge_rollups(totals), _merge_rollups(today), sorted(digit_counts.items()))
+    
+    def rebuild_rollups(self):
+        """Recompute every analytics rollup from the raw prediction and feedback history, archives included."""
+        self.flush_predictions()
+        for shard, engine in enumerate(self.shard_engines):
+            with engine.begin() as conn:
+                _rebuild_rollups(conn, self.archive, lambda user_id, shard=shard: self.shard_for(user_id) == shard)
         
+    
+    def export_user_data(self, user_id, format='json'):
         return {
-            'total_users': total_users,
-            'active_users': active_users,
-            'total_predictions': total_predictions,
-            'today_predictions': recent_predictions,
-            'system_accuracy': system_accuracy,
-            'digit_distribution': dict(digit_stats)
+            'predictions': [_json_export_row('predictions', row) for chunk in self.iter_user_export(user_id, 'predictions') for row in chunk],
+            'feedbacks': [_json_export_row('feedback', row) for chunk in self.iter_user_export(user_id, 'feedback') for row in chunk]
         }
-        
     
-    def export_user_data(self, user_id, format='csv'):
-        predictions = self.session.query(PredictionHistory).filter_by(user_id=user_id).all()
-        feedbacks = self.session.query(UserFeedback).filter_by(user_id=user_id).all()
+    def iter_user_export(self, user_id, table='predictions', chunk_size=None):
+        """Yield a user's predictions or feedback as lists of row dicts, oldest first, archived rows before hot ones."""
+        model = EXPORT_TABLES[table]
+        chunk_size = chunk_size or config.EXPORT_CHUNK_SIZE
+        self.flush_predictions()
+        cutoff = self.archive.cutoff(model.__tablename__)
+        if cutoff is not None:
+            yield from self.archive.iter_batches(model.__tablename__, EXPORT_COLUMNS[table], user_id, chunk_size)
+        last = None
+        while True:
+            with self.session_scope(self.shard_for(user_id)) as session:
+                rows = session.execute(_export_query(model, user_id, chunk_size, last, cutoff)).all()
+            if not rows:
+                return
+            yield [dict(row._mapping) for row in rows]
+            if len(rows) < chunk_size:
+                return
+            last = rows[-1]
+    
+    def archive_history(self, older_than_days=None, vacuum=False):
+        """Move rows older than the retention window into monthly Parquet archives, then delete them in batches."""
+        self.flush_predictions()
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days or config.HOT_RETENTION_DAYS)
+        archived = {}
+        for table_name, model in ARCHIVE_TABLES.items():
+            shards = range(len(self.shard_engines))
+            removed = self.archive.remove_unregistered(table_name)
+            if removed:
+                logger.warning(f"Removed {removed} unregistered {table_name} archive parts left by an interrupted run")
+            previous = self.archive.cutoff(table_name)
+            if previous is not None:
+                # Rows below the old cutoff are already in the archive; only a crash mid-delete leaves them here
+                for shard in shards:
+                    self._delete_batched(model, None, previous, shard)
+                if cutoff <= previous:
+                    continue
+            oldest = None
+            for shard in shards:
+                with self.session_scope(shard) as session:
+                    shard_oldest = session.query(func.min(model.timestamp)).filter(model.timestamp < cutoff).scalar()
+                if shard_oldest is not None and (oldest is None or shard_oldest < oldest):
+                    oldest = shard_oldest
+            archived[table_name] = 0
+            if oldest is None:
+                self.archive.set_cutoff(table_name, cutoff)
+                continue
+            month_start = oldest.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            while month_start < cutoff:
+                month_end = (month_start + timedelta(days=32)).replace(day=1)
+                lower = max(month_start, previous) if previous else month_start
+                upper = min(month_end, cutoff)
+                parts = []
+                for shard in shards:
+                    rows, part = self.archive.write_month(
+                        table_name, month_start.strftime('%Y-%m'), self._iter_archive_rows(model, lower, upper, shard), lower, shard
+                    )
+                    archived[table_name] += rows
+                    if part:
+                        parts.append(part)
+                # Readers switch to the archive for this range before the hot rows are deleted
+                self.archive.set_cutoff(table_name, upper, parts)
+                for shard in shards:
+                    self._delete_batched(model, lower, upper, shard)
+                month_start = month_end
+            logger.info(f"Archived {archived[table_name]} rows from {table_name} older than {cutoff.isoformat()}")
+        if vacuum and self.db_url.startswith('sqlite'):
+            for engine in self.shard_engines:
+                with engine.connect() as conn:
+                    conn.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+        return archived
+    
+    def _iter_archive_rows(self, model, lower, upper, shard=0):
+        table = model.__table__
+        last = None
+        while True:
+            query = select(table).where(table.c.timestamp >= lower, table.c.timestamp < upper)
+            if last is not None:
+                query = query.where(or_(
+                    table.c.timestamp > last.timestamp,
+                    and_(table.c.timestamp == last.timestamp, table.c.id > last.id)
+                ))
+            with self.session_scope(shard) as session:
+                rows = session.execute(query.order_by(table.c.timestamp, table.c.id).limit(config.ARCHIVE_BATCH_SIZE)).all()
+            if not rows:
+                return
+            yield [dict(row._mapping) for row in rows]
+            last = rows[-1]
+    
+    def _delete_batched(self, model, lower, upper, shard=0):
+        # Short delete transactions keep the write lock free for request traffic between batches
+        while True:
+            with self.session_scope(shard) as session:
+                query = session.query(model.id).filter(model.timestamp < upper)
+                if lower is not None:
+                    query = query.filter(model.timestamp >= lower)
+                ids = [row.id for row in query.limit(config.ARCHIVE_BATCH_SIZE)]
+                if not ids:
+                    return
+                session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+    
+    def register_model_version(self, version, model_path, training_type, parent_version=None,
+                               feedback_watermark=0, custom_dataset_watermark=0, metrics=None, activate=True):
+        with self.session_scope() as session:
+            if activate:
+                session.query(ModelVersion).update({ModelVersion.is_active: False})
+            entry = ModelVersion(
+                version=version,
+                model_path=model_path,
+                parent_version=parent_version,
+                training_type=training_type,
+                feedback_watermark=feedback_watermark,
+                custom_dataset_watermark=custom_dataset_watermark,
+                metrics=metrics or {},
+                is_active=activate
+            )
+            session.add(entry)
+            session.flush()
+            return entry.id
+    
+    def get_active_model_version(self):
+        with self.session_scope() as session:
+            return session.query(ModelVersion).filter_by(is_active=True).order_by(ModelVersion.id.desc()).first()
+    
+    def save_model_performance(self, model_version, accuracy, loss, validation_accuracy=None, validation_loss=None,
+                               training_time=None, model_architecture=None, hyperparameters=None, evaluation=None):
+        with self.session_scope() as session:
+            performance = session.query(ModelPerformance).filter_by(model_version=model_version).first()
+            if performance is None:
+                performance = ModelPerformance(model_version=model_version)
+                session.add(performance)
+            performance.timestamp = datetime.utcnow()
+            performance.accuracy = accuracy
+            performance.loss = loss
+            performance.validation_accuracy = validation_accuracy
+            performance.validation_loss = validation_loss
+            performance.training_time = training_time
+            performance.model_architecture = model_architecture
+            performance.hyperparameters = hyperparameters or {}
+            performance.evaluation = evaluation or {}
+            session.flush()
+            return performance.id
+    
+    def get_model_performance(self, model_version):
+        with self.session_scope() as session:
+            performance = session.query(ModelPerformance).filter_by(model_version=model_version).first()
+            if performance is None:
+                return None
+            return {
+                'model_version': performance.model_version,
+                'timestamp': performance.timestamp.isoformat() if performance.timestamp else None,
+                'accuracy': performance.accuracy,
+                'loss': performance.loss,
+                'validation_accuracy': performance.validation_accuracy,
+                'validation_loss': performance.validation_loss,
+                'training_time': performance.training_time,
+                'hyperparameters': performance.hyperparameters,
+                **(performance.evaluation or {})
+            }
+    
+    def list_model_versions(self):
+        with self.session_scope() as session:
+            versions = session.query(ModelVersion).order_by(ModelVersion.id.desc()).all()
+            return [{
+                'version': v.version,
+                'model_path': v.model_path,
+                'parent_version': v.parent_version,
+                'training_type': v.training_type,
+                'created_at': v.created_at.isoformat() if v.created_at else None,
+                'metrics': v.metrics,
+                'is_active': v.is_active
+            } for v in versions]
+    
+    def activate_model_version(self, version):
+        with self.session_scope() as session:
+            entry = session.query(ModelVersion).filter_by(version=version).first()
+            if entry is None:
+                return None
+            session.query(ModelVersion).update({ModelVersion.is_active: False})
+            entry.is_active = True
+            return entry
+    
+    def get_latest_model_version(self, training_type=None):
+        with self.session_scope() as session:
+            query = session.query(ModelVersion)
+            if training_type:
+                query = query.filter_by(training_type=training_type)
+            return query.order_by(ModelVersion.id.desc()).first()
+    
+    def get_new_training_samples(self, feedback_after=0, custom_dataset_after=0):
+        self.flush_predictions()
+        feedback = {}
+        for shard in range(len(self.shard_engines)):
+            with self.session_scope(shard) as session:
+                # Feedback and the prediction it labels belong to the same user, so the join stays on one shard
+                for row in session.query(
+                    UserFeedback.id, UserFeedback.prediction_id, UserFeedback.actual_digit,
+                    PredictionHistory.id.label('found'), PredictionHistory.image_path
+                ).outerjoin(PredictionHistory, UserFeedback.prediction_id == PredictionHistory.id).filter(
+                    UserFeedback.id > feedback_after,
+                    UserFeedback.actual_digit.isnot(None)
+                ):
+                    feedback[row.id] = {'id': row.id, 'digit': row.actual_digit, 'prediction_id': row.prediction_id,
+                                        'image_path': row.image_path, 'found': row.found is not None}
         
-        prediction_data = []
-        for p in predictions:
-            prediction_data.append({
-                'timestamp': p.timestamp,
-                'predicted_digit': p.predicted_digit,
-                'confidence': p.confidence,
-                'input_type': p.user_input_type,
-                'processing_time': p.processing_time
-            })
+        # Feedback newer than the watermark may already have been archived, and so may the predictions it labels
+        if self.archive.cutoff('user_feedback') is not None:
+            for row in self.archive.read_rows('user_feedback', ['id', 'prediction_id', 'actual_digit'],
+                                              (ds.field('id') > feedback_after) & ds.field('actual_digit').is_valid()):
+                feedback.setdefault(row['id'], {'id': row['id'], 'digit': row['actual_digit'], 'prediction_id': row['prediction_id'],
+                                                'image_path': None, 'found': False})
+        missing = {item['prediction_id'] for item in feedback.values() if not item['found']}
+        if missing and self.archive.cutoff('prediction_history') is not None:
+            paths = {row['id']: row['image_path'] for row in self.archive.read_rows(
+                'prediction_history', ['id', 'image_path'], ds.field('id').isin(list(missing))
+            )}
+            for item in feedback.values():
+                if not item['found']:
+                    item['image_path'] = paths.get(item['prediction_id'])
         
-        feedback_data = []
-        for f in feedbacks:
-            feedback_data.append({
-                'timestamp': f.timestamp,
-                'actual_digit': f.actual_digit,
-                'correct_prediction': f.correct_prediction,
-                'confidence_rating': f.confidence_rating,
-                'comments': f.comments
-            })
+        # Feedback promoted into the custom dataset is trained on from there, so it is left out here
+        paths = sorted({item['image_path'] for item in feedback.values() if item['image_path'] is not None})
+        promoted = set()
+        for shard in range(len(self.shard_engines)):
+            with self.session_scope(shard) as session:
+                for offset in range(0, len(paths), config.ARCHIVE_BATCH_SIZE):
+                    promoted.update(row.image_path for row in session.query(CustomDataset.image_path).filter(
+                        CustomDataset.image_path.in_(paths[offset:offset + config.ARCHIVE_BATCH_SIZE])
+                    ))
         
-        if format == 'csv':
-            pred_df = pd.DataFrame(prediction_data)
-            feedback_df = pd.DataFrame(feedback_data)
-            return pred_df, feedback_df
-        elif format == 'json':
-            return {
-                'predictions': prediction_data,
-                'feedbacks': feedback_data
-            }
+        return {
+            'feedback': [{'id': item['id'], 'digit': item['digit'], 'image_path': item['image_path']}
+                         for _, item in sorted(feedback.items())
+                         if item['image_path'] is not None and item['image_path'] not in promoted],
+            'custom_dataset': self.get_custom_dataset_samples(custom_dataset_after)
+        }
+    
+    def get_custom_dataset_samples(self, after_id=0):
+        """Verified custom dataset samples with ids above after_id, oldest first."""
+        rows = []
+        for shard in range(len(self.shard_engines)):
+            with self.session_scope(shard) as session:
+                rows.extend(session.query(
+                    CustomDataset.id, CustomDataset.actual_digit, CustomDataset.image_path
+                ).filter(
+                    CustomDataset.id > after_id,
+                    CustomDataset.is_verified == True,
+                    CustomDataset.actual_digit.isnot(None)
+                ).all())
+        return [{'id': r.id, 'digit': r.actual_digit, 'image_path': r.image_path} for r in sorted(rows, key=lambda r: r.id)]
+    
+    def reshard(self, shard_urls, batch_size=None):
+        """Copy per-user rows into a new, empty set of shard databases routed by user_id, then rebuild their rollups.
+
+        The current tables are left untouched; point STORAGE_MODE/SHARD_COUNT at the new layout once this returns.
+        """
+        if set(shard_urls) & set(self.shard_urls + [self.db_url]):
+            raise ValueError("Target shards must be new databases")
+        self.flush_predictions()
+        target = AdvancedDatabaseManager(self.db_url, archive=self.archive, shard_urls=shard_urls)
+        batch_size = batch_size or config.ARCHIVE_BATCH_SIZE
+        copied = {}
+        for model in SHARDED_MODELS:
+            table = model.__table__
+            for shard in range(len(target.shard_engines)):
+                with target.session_scope(shard) as session:
+                    if session.query(model.id).first() is not None:
+                        raise ValueError(f"Target shard {shard} already has {table.name} rows")
+            copied[table.name] = 0
+            for engine in self.shard_engines:
+                last_id = 0
+                while True:
+                    with engine.connect() as conn:
+                        rows = conn.execute(select(table).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)).all()
+                    if not rows:
+                        break
+                    by_shard = defaultdict(list)
+                    for row in rows:
+                        by_shard[target.shard_for(row.user_id)].append(dict(row._mapping))
+                    for shard, records in by_shard.items():
+                        with target.shard_engines[shard].begin() as conn:
+                            conn.execute(table.insert(), records)
+                    copied[table.name] += len(rows)
+                    last_id = rows[-1].id
+        target.rebuild_rollups()
+        logger.info(f"Resharded into {len(shard_urls)} shards: {copied}")
+        return copied
     
     def log_system_event(self, log_level, module, message, user_id=None):
-        log = SystemLog(
-            log_level=log_level,
-            module=module,
-            message=message,
-            user_id=user_id
-        )
-        self.session.add(log)
-        self.session.commit()
+        # Batched through the event sink; only processes that never start the sink (scripts, tests) write directly
+        if event_sink.running:
+            event_sink.emit('system_log', message=message, level=log_level, module=module, user_id=user_id)
+        else:
+            self.log_system_events([{'log_level': log_level, 'module': module, 'message': message, 'user_id': user_id}])
+    
+    def log_system_events(self, events):
+        with self.session_scope() as session:
+            session.bulk_insert_mappings(SystemLog, events)
+    
+    def purge_system_logs(self, before):
+        with self.session_scope() as session:
+            return session.query(SystemLog).filter(SystemLog.timestamp < before).delete(synchronize_session=False)
+
+def benchmark_user_stats(num_predictions=1_000_000, num_users=10, db_path='data/benchmark_user_stats.db', chunk_size=50_000):
+    """Fill a throwaway SQLite database with synthetic predictions and time user stats on the heaviest user."""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    manager = AdvancedDatabaseManager(f'sqlite:///{db_path}', archive=ArchiveStore(f'{db_path}.archive'), shard_urls=[])
+    rng = np.random.default_rng(0)
+    
+    with manager.engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [{'id': i, 'username': f'bench_user_{i}'} for i in range(1, num_users + 1)])
+    
+    start = time.time()
+    now = datetime.utcnow()
+    for offset in range(0, num_predictions, chunk_size):
+        size = min(chunk_size, num_predictions - offset)
+        # Half of all rows belong to user 1 so the per-user query has real work to do
+        users = np.where(rng.random(size) < 0.5, 1, rng.integers(2, num_users + 1, size))
+        rows = [{
+            'user_id': int(u), 'timestamp': now, 'predicted_digit': int(d),
+            'confidence': float(c), 'processing_time': float(t), 'user_input_type': 'benchmark'
+        } for u, d, c, t in zip(users, rng.integers(0, 10, size), rng.random(size), rng.random(size))]
+        with manager.engine.begin() as conn:
+            conn.execute(PredictionHistory.__table__.insert(), rows)
+            conn.execute(UserFeedback.__table__.insert(), [
+                {'user_id': r['user_id'], 'timestamp': now, 'correct_prediction': r['confidence'] > 0.2}
+                for r in rows[::10]
+            ])
+    populate_time = time.time() - start
+    manager.rebuild_rollups()
+    
+    start = time.time()
+    stats = manager.get_user_stats_from_history(1)
+    sql_time = time.time() - start
+    
+    start = time.time()
+    manager.get_user_stats(1)
+    rollup_time = time.time() - start
+    
+    # Baseline: materialising every row the way the old implementation did
+    start = time.time()
+    with manager.session_scope() as session:
+        loaded = len(session.query(PredictionHistory).filter_by(user_id=1).all())
+        loaded += len(session.query(UserFeedback).filter_by(user_id=1).all())
+    orm_time = time.time() - start
+    
+    manager.engine.dispose()
+    os.remove(db_path)
+    print(f"{num_predictions} rows populated in {populate_time:.1f}s; "
+          f"rollups {rollup_time * 1000:.1f} ms, SQL aggregates {sql_time * 1000:.1f} ms, "
+          f"loading {loaded} rows {orm_time * 1000:.1f} ms")
+    return {
+        'rows': num_predictions,
+        'stats': stats,
+        'rollup_ms': rollup_time * 1000,
+        'sql_aggregate_ms': sql_time * 1000,
+        'orm_load_ms': orm_time * 1000
+    }
+
+def _benchmark_writer_process(db_dir, shard_urls, users, timings):
+    # One buffered writer process; spawned so each builds its own engines and reserves its own id blocks
+    manager = AdvancedDatabaseManager(f'sqlite:///{db_dir}/main.db', archive=ArchiveStore(f'{db_dir}/archive'), shard_urls=shard_urls)
+    manager.start_write_behind()
+    start = time.time()
+    for user_id in users:
+        manager.add_prediction(int(user_id), 3, 0.9, None, 'benchmark', None, 0.01, '28x28', 'benchmark')
+    manager.stop_write_behind()
+    timings.put((start, time.time()))
+
+def benchmark_sharded_writes(shard_counts=(1, 4), writers=32, operations=4000, num_users=1000, processes=4, db_dir='data/benchmark_shards'):
+    """Prediction writes from many users per shard count: concurrent sync add_prediction calls, the write-behind buffer,
+    then several processes writing through their own buffers, checking that no id was handed out twice."""
+    import multiprocessing
+    results = {}
+    rng = np.random.default_rng(0)
+    users = rng.integers(1, num_users + 1, operations)
+    for count in shard_counts:
+        shutil.rmtree(db_dir, ignore_errors=True)
+        os.makedirs(db_dir)
+        shard_urls = [f'sqlite:///{db_dir}/shard_{i}.db' for i in range(count)] if count > 1 else []
+        manager = AdvancedDatabaseManager(f'sqlite:///{db_dir}/main.db', archive=ArchiveStore(f'{db_dir}/archive'), shard_urls=shard_urls)
+        
+        def write(user_id):
+            manager.add_prediction(int(user_id), 3, 0.9, None, 'benchmark', None, 0.01, '28x28', 'benchmark')
+        
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=writers) as pool:
+            list(pool.map(write, users))
+        sync_rate = operations / (time.time() - start)
+        
+        manager.start_write_behind()
+        start = time.time()
+        for user_id in users:
+            write(user_id)
+        manager.flush_predictions()
+        buffered_rate = operations / (time.time() - start)
+        manager.stop_write_behind()
+        
+        context = multiprocessing.get_context('spawn')
+        timings = context.Queue()
+        workers = [context.Process(target=_benchmark_writer_process, args=(db_dir, shard_urls, part, timings))
+                   for part in np.array_split(users, processes)]
+        for worker in workers:
+            worker.start()
+        spans = [timings.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        # Timed from the first process starting to write to the last one finishing, leaving out interpreter startup
+        process_rate = operations / (max(end for _, end in spans) - min(start for start, _ in spans))
+        
+        ids = []
+        for shard in range(len(manager.shard_engines)):
+            with manager.session_scope(shard) as session:
+                ids.extend(row.id for row in session.query(PredictionHistory.id))
+        if len(ids) != 3 * operations or len(set(ids)) != len(ids):
+            raise RuntimeError(f"Expected {3 * operations} distinct prediction ids, found {len(set(ids))} of {len(ids)} rows")
+        for engine in set(manager.shard_engines + [manager.engine]):
+            engine.dispose()
+        results[count] = {'sync': sync_rate, 'buffered': buffered_rate, 'processes': process_rate}
+        print(f"{count} shard(s): {sync_rate:.0f} sync writes/s with {writers} writers, {buffered_rate:.0f} buffered writes/s, "
+              f"{process_rate:.0f} buffered writes/s across {processes} processes")
+    shutil.rmtree(db_dir, ignore_errors=True)
+    return results
 
 db_manager = AdvancedDatabaseManager()
-    
\ No newline at end of file
+    
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Database maintenance commands")
+    parser.add_argument('command', choices=['rebuild-rollups', 'benchmark-user-stats', 'archive-history', 'reshard', 'benchmark-sharded-writes'])
+    parser.add_argument('--older-than-days', type=int, default=None)
+    parser.add_argument('--vacuum', action='store_true')
+    parser.add_argument('--shards', type=int, default=None)
+    parser.add_argument('--shard-url-template', default=None,
+                        help="Target URLs for reshard, e.g. 'sqlite:///data/shards_v2/shard_{index}.db'")
+    args = parser.parse_args()
+    
+    if args.command == 'rebuild-rollups':
+        db_manager.rebuild_rollups()
+        print("Analytics rollups rebuilt from prediction history")
+    elif args.command == 'benchmark-user-stats':
+        benchmark_user_stats()
+    elif args.command == 'archive-history':
+        print(db_manager.archive_history(args.older_than_days, vacuum=args.vacuum))
+    elif args.command == 'reshard':
+        template = args.shard_url_template or config.SHARD_URL_TEMPLATE
+        print(db_manager.reshard([template.format(index=i) for i in range(args.shards or config.SHARD_COUNT)]))
+    elif args.command == 'benchmark-sharded-writes':
+        benchmark_sharded_writes()
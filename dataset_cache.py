@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import numpy as np
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class DatasetCache:
+    ARRAY_NAMES = ('x_train', 'y_train', 'x_test', 'y_test')
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or config.DATASET_CACHE_PATH
+        self.max_bytes = max_bytes if max_bytes is not None else config.DATASET_CACHE_MAX_BYTES
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(params):
+        encoded = json.dumps(params, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha1(encoded).hexdigest()[:16]
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, params):
+        """((x_train, y_train), (x_test, y_test)) as memory-mapped arrays; arrays the entry was stored without are None."""
+        key = self.make_key(params)
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path) as f:
+                stored = json.load(f).get('arrays', self.ARRAY_NAMES)
+            arrays = [np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode='r') if name in stored else None
+                      for name in self.ARRAY_NAMES]
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable dataset cache entry {key}: {str(e)}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        os.utime(meta_path, None)
+        logger.info(f"Dataset cache hit for {key}")
+        x_train, y_train, x_test, y_test = arrays
+        return (x_train, y_train), (x_test, y_test)
+
+    def store(self, params, x_train, y_train, x_test=None, y_test=None):
+        """Write an entry under a private temp dir and rename it into place; if another process won, use its entry."""
+        key = self.make_key(params)
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(tmp_dir)
+        stored = []
+        for name, array in zip(self.ARRAY_NAMES, (x_train, y_train, x_test, y_test)):
+            if array is not None:
+                np.save(os.path.join(tmp_dir, f'{name}.npy'), np.ascontiguousarray(array))
+                stored.append(name)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'params': params, 'arrays': stored, 'created_at': time.time()}, f, default=str)
+        
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            if not os.path.exists(os.path.join(entry_dir, 'meta.json')):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logger.info(f"Dataset cache entry {key} was written concurrently; using the existing entry")
+        self.evict(keep=key)
+        return self.load(params)
+
+    def entries(self):
+        result = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            meta_path = os.path.join(entry_dir, 'meta.json')
+            if not os.path.exists(meta_path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+            result.append({'key': key, 'size': size, 'last_used': os.path.getmtime(meta_path)})
+        return result
+
+    def evict(self, keep=None):
+        entries = sorted(self.entries(), key=lambda e: e['last_used'])
+        total = sum(e['size'] for e in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry['key'] == keep:
+                continue
+            shutil.rmtree(self._entry_dir(entry['key']), ignore_errors=True)
+            total -= entry['size']
+            logger.info(f"Evicted dataset cache entry {entry['key']}")
+
+    def clear(self):
+        for entry in self.entries():
+            shutil.rmtree(self._entry_dir(entry['key']), ignore_errors=True)
+
+dataset_cache = DatasetCache()
@@ -0,0 +1,168 @@
+import os
+import gzip
+import json
+import time
+import random
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class RotatingNdjsonWriter:
+    """Appends event batches to gzip NDJSON files, starting a new file per day or once max_bytes is reached."""
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or config.EVENT_LOG_PATH
+        self.max_bytes = max_bytes or config.EVENT_FILE_MAX_BYTES
+        self.current_path = None
+        self.current_day = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _rotate_if_needed(self):
+        today = datetime.utcnow().strftime('%Y%m%d')
+        if (self.current_path is None or today != self.current_day
+                or os.path.getsize(self.current_path) >= self.max_bytes):
+            self.current_day = today
+            self.current_path = os.path.join(self.directory, f"events-{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}.ndjson.gz")
+            open(self.current_path, 'ab').close()
+
+    def write(self, events):
+        self._rotate_if_needed()
+        # Each batch is its own gzip member, so a file stays readable even if the process dies mid-way
+        with gzip.open(self.current_path, 'at', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(event, default=str) + '\n' for event in events))
+
+    def purge(self, before):
+        removed = 0
+        cutoff = before.timestamp()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.ndjson.gz') and path != self.current_path and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+class DatabaseEventWriter:
+    """Writes event batches to the system_logs table in one transaction per batch."""
+
+    def __init__(self, db_manager=None):
+        if db_manager is None:
+            from database import db_manager
+        self.db_manager = db_manager
+
+    def write(self, events):
+        self.db_manager.log_system_events([{
+            'timestamp': event['timestamp'],
+            'log_level': event['level'],
+            'module': event['module'],
+            'message': event['message'],
+            'user_id': event['user_id'],
+            'event_type': event['event_type'],
+            'data': event['data']
+        } for event in events])
+
+    def purge(self, before):
+        return self.db_manager.purge_system_logs(before)
+
+class EventSink:
+    """In-memory event buffer drained by a background thread that writes batches and enforces retention.
+
+    emit() only samples and appends to a deque; events emitted before start() are dropped.
+    """
+
+    def __init__(self, backend=None, batch_size=None, flush_interval_ms=None, max_queue=None,
+                 sample_rates=None, retention_days=None):
+        self.backend = backend or config.EVENT_SINK_BACKEND
+        self.batch_size = batch_size or config.EVENT_BATCH_SIZE
+        self.flush_interval = (flush_interval_ms or config.EVENT_FLUSH_INTERVAL_MS) / 1000
+        self.max_queue = max_queue or config.EVENT_QUEUE_MAX
+        self.sample_rates = sample_rates if sample_rates is not None else config.EVENT_SAMPLE_RATES
+        self.retention_days = retention_days if retention_days is not None else config.EVENT_RETENTION_DAYS
+        self.events = deque()
+        self.dropped = 0
+        self.writer = None
+        self.worker = None
+        self.running = False
+        self.stopping = threading.Event()
+        self.last_retention_check = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.writer = RotatingNdjsonWriter() if self.backend == 'file' else DatabaseEventWriter()
+        self.stopping.clear()
+        self.running = True
+        self.worker = threading.Thread(target=self._run, name='event-sink', daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.stopping.set()
+        self.worker.join()
+        self.worker = None
+
+    def emit(self, event_type, message=None, level='INFO', module=None, user_id=None, **data):
+        if not self.running:
+            return
+        rate = self.sample_rates.get(event_type, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return
+        if len(self.events) >= self.max_queue:
+            self.dropped += 1
+            return
+        if rate < 1.0:
+            data['sample_rate'] = rate
+        self.events.append({
+            'timestamp': datetime.utcnow(),
+            'event_type': event_type,
+            'level': level,
+            'module': module,
+            'message': message,
+            'user_id': user_id,
+            'data': data
+        })
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'running': self.running,
+            'pending': len(self.events),
+            'dropped': self.dropped
+        }
+
+    def _drain(self):
+        batch = []
+        while self.events and len(batch) < self.batch_size:
+            batch.append(self.events.popleft())
+        return batch
+
+    def _run(self):
+        while True:
+            stopping = self.stopping.wait(self.flush_interval)
+            while self.events:
+                batch = self._drain()
+                try:
+                    self.writer.write(batch)
+                except Exception as e:
+                    self.dropped += len(batch)
+                    logger.error(f"Event batch write failed: {str(e)}")
+            if time.time() - self.last_retention_check >= config.EVENT_RETENTION_CHECK_SECONDS:
+                self._enforce_retention()
+            if stopping:
+                return
+
+    def _enforce_retention(self):
+        self.last_retention_check = time.time()
+        try:
+            removed = self.writer.purge(datetime.utcnow() - timedelta(days=self.retention_days))
+            if removed:
+                logger.info(f"Event retention removed {removed} {'files' if self.backend == 'file' else 'rows'}")
+        except Exception as e:
+            logger.error(f"Event retention failed: {str(e)}")
+
+event_sink = EventSink()
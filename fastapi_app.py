@@ -1,7 +1,8 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, List
 import numpy as np
@@ -9,15 +10,20 @@ import cv2
 from PIL import Image
 import io
 import base64
+import json
 import os
 import time
 from datetime import datetime
 import logging
 from contextlib import asynccontextmanager
 
-from database import db_manager, AdvancedDatabaseManager
+from database import db_manager, AdvancedDatabaseManager, decode_history_cursor
 from utils import AdvancedImagePreprocessor, AdvancedModelManager, OCRProcessor, DataAugmentor
 from model_trainer import AdvancedModelTrainer
+from training_jobs import training_jobs
+from data_export import stream_user_export, astream_user_export, export_filename, EXPORT_FORMATS
+from async_database import async_db_manager
+from event_sink import event_sink
 from config import config
 
 logging.basicConfig(level=logging.INFO)
@@ -34,21 +40,59 @@ async def lifespan(app: FastAPI):
     logger.info("Starting Handwriting Recognition API...")
     config.create_directories()
     os.makedirs("templates", exist_ok=True)
-    os.makedirs("data/exports", exist_ok=True)
     
     # Initialize managers
     image_preprocessor = AdvancedImagePreprocessor()
-    model_manager = AdvancedModelManager(config.MODEL_PATH)
+    active_version = db_manager.get_active_model_version()
+    if active_version is not None and os.path.exists(active_version.model_path):
+        model_manager = AdvancedModelManager(active_version.model_path)
+        model_manager.model_version = active_version.version
+    else:
+        model_manager = AdvancedModelManager(config.MODEL_PATH)
     ocr_processor = OCRProcessor()
     
+    if config.CASCADE_ENABLED:
+        load_cascade_fast_model()
+    training_jobs.on_complete.append(reload_trained_model)
+    training_jobs.start()
+    
     if model_manager.model is None:
         logger.warning("No model loaded. Please train a model or provide a pre-trained model.")
     else:
         logger.info(f"Model loaded successfully: {model_manager.model_version}")
     
+    db_manager.start_write_behind()
+    event_sink.start()
+    
     logger.info("API ready to accept requests")
     yield
-    # Shutdown code if needed
+    event_sink.stop()
+    db_manager.stop_write_behind()
+    if async_db_manager is not None:
+        await async_db_manager.close()
+
+def use_async_db():
+    return async_db_manager is not None
+
+async def db_call(method, *args, **kwargs):
+    # Same operation on either manager; the sync one runs in the threadpool so the event loop never blocks
+    if use_async_db():
+        return await getattr(async_db_manager, method)(*args, **kwargs)
+    return await run_in_threadpool(getattr(db_manager, method), *args, **kwargs)
+
+def load_cascade_fast_model():
+    if config.CASCADE_FAST_MODEL_PATH:
+        model_manager.load_fast_model(config.CASCADE_FAST_MODEL_PATH)
+        return
+    student = db_manager.get_latest_model_version(training_type='distillation')
+    if student is not None:
+        model_manager.load_fast_model(student.model_path, version=student.version)
+
+def reload_trained_model(job):
+    result = job['result'] or {}
+    if result.get('skipped') or result.get('activated') is False:
+        return
+    model_manager.load_model(result.get('model_path'), version=result.get('version'))
 
 app = FastAPI(
     title="Advanced Handwriting Recognition API",
@@ -65,6 +109,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_timing(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    event_sink.emit('request', module='api', method=request.method, path=request.url.path,
+                    status=response.status_code, duration_ms=(time.perf_counter() - start) * 1000)
+    return response
+
 os.makedirs("static", exist_ok=True)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -80,16 +132,37 @@ class FeedbackRequest(BaseModel):
     confidence_rating: Optional[int] = None
     comments: Optional[str] = ""
 
+class FeedbackBatchRequest(BaseModel):
+    items: List[FeedbackRequest]
+    promote_to_dataset: bool = False
+
 class UserCreate(BaseModel):
     username: str
     email: Optional[str] = None
 
 class TrainingConfig(BaseModel):
     use_hyperparameter_tuning: bool = False
+    tuning_objective: str = "accuracy"
     use_augmentation: bool = True
+    input_pipeline: str = "tf_data"
     epochs: int = 50
     batch_size: int = 32
     
+class CascadeConfig(BaseModel):
+    enabled: Optional[bool] = None
+    confidence_threshold: Optional[float] = None
+    margin_threshold: Optional[float] = None
+    reset_stats: bool = False
+
+class FineTuneConfig(BaseModel):
+    epochs: int = 3
+    batch_size: int = 32
+
+class DistillationConfig(BaseModel):
+    epochs: int = 10
+    batch_size: int = 32
+    activate: bool = False
+    
 @app.get("/", response_class=HTMLResponse)
 async def root():
     try:
@@ -146,7 +219,7 @@ async def predict_digit(request: PredictionRequest):
         )
         
         image_path = save_prediction_image(image_np)
-        prediction_id = db_manager.add_prediction(
+        prediction_id = await db_call('add_prediction',
             user_id=request.user_id,
             predicted_digit=int(predicted_digit),
             confidence=float(confidence),
@@ -197,7 +270,7 @@ async def predict_from_upload(file: UploadFile = File(...),user_id: int = Form(1
             return_all=True
         )
         image_path = save_uploaded_file(file, contents)
-        prediction_id = db_manager.add_prediction(
+        prediction_id = await db_call('add_prediction',
             user_id=user_id,
             predicted_digit=int(predicted_digit),
             confidence=float(confidence),
@@ -226,27 +299,32 @@ async def predict_from_upload(file: UploadFile = File(...),user_id: int = Form(1
 @app.post("/api/predict-batch")
 async def predict_batch(files: List[UploadFile] = File(...), user_id: int = Form(1)):
     try:
-        results = []
+        images = []
+        processing_times = []
         
         for file in files:
             contents = await file.read()
             image = Image.open(io.BytesIO(contents))
             image_np = np.array(image)
         
-        processed_image, processing_time = image_preprocessor.preprocess_image(
+            processed_image, processing_time = image_preprocessor.preprocess_image(
                 image_np,
                 target_size=(28, 28)
-        )
-
-        processed_image = processed_image.reshape(1, 28, 28, 1)
-        predicted_digit, confidence, _ = model_manager.predict_digit(processed_image)
-            
-        results.append({
-            "filename": file.filename,
-            "predicted_digit": int(predicted_digit),
-            "confidence": float(confidence),
-            "processing_time": processing_time
-        })
+            )
+            images.append(processed_image.reshape(28, 28, 1))
+            processing_times.append(processing_time)
+        
+        predictions, escalated = model_manager.predict_batch(np.array(images))
+        
+        results = []
+        for file, probs, full_tier, processing_time in zip(files, predictions, escalated, processing_times):
+            results.append({
+                "filename": file.filename,
+                "predicted_digit": int(np.argmax(probs)),
+                "confidence": float(np.max(probs)),
+                "tier": "full" if full_tier else "fast",
+                "processing_time": processing_time
+            })
         
         return {
             "success": True,
@@ -261,28 +339,53 @@ async def predict_batch(files: List[UploadFile] = File(...), user_id: int = Form
 @app.post("/api/feedback")
 async def add_feedback(feedback: FeedbackRequest):
     try:
-        db_manager.add_feedback(
+        # Correctness is derived from the stored prediction, so omit correct_prediction
+        feedback_id = await db_call('add_feedback',
             prediction_id=feedback.prediction_id,
             user_id=feedback.user_id,
             actual_digit=feedback.actual_digit,
-            correct_prediction=(feedback.actual_digit == feedback.prediction_id),
             confidence_rating=feedback.confidence_rating,
             comments=feedback.comments
         )
+        if feedback_id is None:
+            raise HTTPException(status_code=404, detail="Prediction not found")
         
         return {
             "success": True,
             "message": "Feedback recorded successfully"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Feedback error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/feedback/batch")
+async def add_feedback_batch(batch: FeedbackBatchRequest):
+    if len(batch.items) > config.FEEDBACK_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {config.FEEDBACK_BATCH_MAX} feedback items per request")
+    try:
+        items = [item.dict() for item in batch.items]
+        result = await db_call('add_feedback_batch', items, promote_to_dataset=batch.promote_to_dataset)
+        
+        return {
+            "success": True,
+            "data": {
+                "accepted": result['accepted'],
+                "promoted": result['promoted'],
+                "rejected": [{"index": i, "prediction_id": items[i]['prediction_id']} for i in result['rejected']]
+            }
+        }
+        
+    except Exception as e:
+        logger.error(f"Batch feedback error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/analytics/system")
 async def get_system_analytics():
     try:
-        analytics = db_manager.get_system_analytics()
+        analytics = await db_call('get_system_analytics')
         return {
             "success": True,
             "data": analytics
@@ -295,7 +398,7 @@ async def get_system_analytics():
 @app.get("/api/analytics/user/{user_id}")
 async def get_user_analytics(user_id: int):
     try:
-        stats = db_manager.get_user_stats(user_id)
+        stats = await db_call('get_user_stats', user_id)
         
         if stats is None:
             return {
@@ -314,35 +417,42 @@ async def get_user_analytics(user_id: int):
 
 
 @app.get("/api/analytics/predictions")
-async def get_prediction_history(limit: int = 100, user_id: Optional[int] = None):
+async def get_prediction_history(limit: Optional[int] = None, user_id: Optional[int] = None, cursor: Optional[str] = None,
+                           digit: Optional[int] = None, input_type: Optional[str] = None,
+                           model_version: Optional[str] = None, since: Optional[datetime] = None,
+                           until: Optional[datetime] = None, format: str = 'json'):
+    filters = {
+        'user_id': user_id,
+        'digit': digit,
+        'input_type': input_type,
+        'model_version': model_version,
+        'since': since,
+        'until': until
+    }
     try:
-        from sqlalchemy import desc
-        from database import PredictionHistory
-        
-        query = db_manager.session.query(PredictionHistory)
-        
-        if user_id:
-            query = query.filter(PredictionHistory.user_id == user_id)
-        
-        predictions = query.order_by(desc(PredictionHistory.timestamp)).limit(limit).all()
-        
-        results = []
-        for pred in predictions:
-            results.append({
-                "id": pred.id,
-                "timestamp": pred.timestamp.isoformat(),
-                "predicted_digit": pred.predicted_digit,
-                "confidence": pred.confidence,
-                "user_input_type": pred.user_input_type,
-                "processing_time": pred.processing_time
-            })
+        if cursor:
+            decode_history_cursor(cursor)
+        if format == 'ndjson':
+            # Streams everything matching the filters unless a limit is passed explicitly
+            if use_async_db():
+                rows = async_db_manager.iter_prediction_history(cursor=cursor, limit=limit, **filters)
+                lines = (json.dumps(row) + "\n" async for row in rows)
+            else:
+                rows = db_manager.iter_prediction_history(cursor=cursor, limit=limit, **filters)
+                lines = (json.dumps(row) + "\n" for row in rows)
+            return StreamingResponse(lines, media_type="application/x-ndjson")
+        
+        results, next_cursor = await db_call('get_prediction_page', limit=limit or 100, cursor=cursor, **filters)
         
         return {
             "success": True,
             "count": len(results),
+            "next_cursor": next_cursor,
             "data": results
         }
         
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Prediction history error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -351,7 +461,7 @@ async def get_prediction_history(limit: int = 100, user_id: Optional[int] = None
 @app.post("/api/users")
 async def create_user(user: UserCreate):
     try:
-        user_id = db_manager.add_user(
+        user_id = await db_call('add_user',
             username=user.username,
             email=user.email
         )
@@ -370,21 +480,14 @@ async def create_user(user: UserCreate):
 @app.get("/api/users/{user_id}")
 async def get_user(user_id: int):
     try:
-        from database import User
-        user = db_manager.session.query(User).filter(User.id == user_id).first()
+        user = await db_call('get_user', user_id)
         
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
         return {
             "success": True,
-            "data": {
-                "id": user.id,
-                "username": user.username,
-                "email": user.email,
-                "created_at": user.created_at.isoformat(),
-                "is_active": user.is_active
-            }
+            "data": user
         }
         
     except HTTPException:
@@ -396,62 +499,230 @@ async def get_user(user_id: int):
 @app.post("/api/train")
 async def train_model(config_data: TrainingConfig):
     try:
-        config.EPOCHS = config_data.epochs
-        config.BATCH_SIZE = config_data.batch_size
-        trainer = AdvancedModelTrainer()
-        history = trainer.train_model(
-            use_hyperparameter_tuning=config_data.use_hyperparameter_tuning
-        )
-        (x_train, y_train), (x_test, y_test) = trainer.load_data(use_augmentation=False)
-        results = trainer.evaluate_model(x_test, y_test)
-        model_manager.load_model(config.MODEL_PATH)
+        job_id = training_jobs.submit({
+            "use_hyperparameter_tuning": config_data.use_hyperparameter_tuning,
+            "tuning_objective": config_data.tuning_objective,
+            "use_augmentation": config_data.use_augmentation,
+            "input_pipeline": config_data.input_pipeline,
+            "epochs": config_data.epochs,
+            "batch_size": config_data.batch_size
+        })
         
         return {
             "success": True,
-            "test_accuracy": float(results['test_accuracy']),
-            "test_loss": float(results['test_loss']),
-            "training_time": float(trainer.training_time),
-            "message": "Model trained successfully"
+            "job_id": job_id,
+            "status_url": f"/api/train/jobs/{job_id}",
+            "message": "Training job submitted"
         }
     
     except Exception as e:
         logger.error(f"Training error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/train/fine-tune")
+async def fine_tune_model(config_data: FineTuneConfig):
+    try:
+        job_id = training_jobs.submit({
+            "epochs": config_data.epochs,
+            "batch_size": config_data.batch_size
+        }, job_type='fine_tune')
+        
+        return {
+            "success": True,
+            "job_id": job_id,
+            "status_url": f"/api/train/jobs/{job_id}",
+            "message": "Fine-tuning job submitted"
+        }
+    
+    except Exception as e:
+        logger.error(f"Fine-tuning error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/train/distill")
+async def distill_model(config_data: DistillationConfig):
+    try:
+        job_id = training_jobs.submit({
+            "epochs": config_data.epochs,
+            "batch_size": config_data.batch_size,
+            "activate": config_data.activate
+        }, job_type='distill')
+        
+        return {
+            "success": True,
+            "job_id": job_id,
+            "status_url": f"/api/train/jobs/{job_id}",
+            "message": "Distillation job submitted"
+        }
+    
+    except Exception as e:
+        logger.error(f"Distillation error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/train/autotune")
+async def autotune_training():
+    job_id = training_jobs.submit({}, job_type='autotune')
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status_url": f"/api/train/jobs/{job_id}",
+        "message": "Threading autotune job submitted"
+    }
+
+@app.get("/api/train/jobs")
+async def list_training_jobs():
+    return {
+        "success": True,
+        "data": training_jobs.list()
+    }
+
+@app.get("/api/train/jobs/{job_id}")
+async def get_training_job(job_id: str):
+    job = training_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Training job not found")
+    return {
+        "success": True,
+        "data": job
+    }
+
+@app.post("/api/train/jobs/{job_id}/cancel")
+async def cancel_training_job(job_id: str):
+    if training_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Training job not found")
+    cancelled = training_jobs.cancel(job_id)
+    return {
+        "success": cancelled,
+        "message": "Cancellation requested" if cancelled else "Job already finished"
+    }
+
 @app.get("/api/model/status")
 async def get_model_status():
     return {
         "success": True,
         "model_loaded": model_manager.model is not None,
         "model_version": model_manager.model_version,
-        "model_path": config.MODEL_PATH
+        "model_path": model_manager.model_path
     }
 
-@app.get("/api/export/user/{user_id}")
-async def export_user_data(user_id: int, format: str = "json"):
+@app.get("/api/model/versions")
+def list_model_versions():
+    return {
+        "success": True,
+        "data": db_manager.list_model_versions()
+    }
+
+@app.post("/api/model/versions/{version}/activate")
+async def activate_model_version(version: str):
+    entry = await run_in_threadpool(db_manager.activate_model_version, version)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Model version not found")
+    await run_in_threadpool(model_manager.load_model, entry.model_path, version=entry.version)
+    return {
+        "success": model_manager.model is not None,
+        "model_version": model_manager.model_version,
+        "model_path": model_manager.model_path
+    }
+
+@app.get("/api/model/metrics")
+async def get_model_metrics(version: Optional[str] = None):
     try:
-        if format == "csv":
-            pred_df, feedback_df = db_manager.export_user_data(user_id, format='csv')
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            pred_file = f"data/exports/predictions_{user_id}_{timestamp}.csv"
-            feedback_file = f"data/exports/feedback_{user_id}_{timestamp}.csv"
-            
-            os.makedirs("data/exports", exist_ok=True)
-            pred_df.to_csv(pred_file, index=False)
-            feedback_df.to_csv(feedback_file, index=False)
+        version = version or model_manager.model_version
+        metrics = await run_in_threadpool(db_manager.get_model_performance, version)
+        
+        if metrics is None and version == model_manager.model_version and model_manager.model is not None:
+            def run():
+                trainer = AdvancedModelTrainer()
+                trainer.model = model_manager.model
+                _, (x_test, y_test) = trainer.load_data(use_augmentation=False)
+                trainer.save_evaluation(version, trainer.evaluate_model(x_test, y_test))
+                return db_manager.get_model_performance(version)
             
-            return {
-                "success": True,
-                "predictions_file": pred_file,
-                "feedback_file": feedback_file
-            }
-        else:
-            data = db_manager.export_user_data(user_id, format='json')
+            metrics = await run_in_threadpool(run)
+        
+        if metrics is None:
+            raise HTTPException(status_code=404, detail="No metrics recorded for this model version")
+        
+        return {
+            "success": True,
+            "data": metrics
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Model metrics error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/model/cascade")
+async def get_cascade_status():
+    return {
+        "success": True,
+        "data": model_manager.get_cascade_stats()
+    }
+
+@app.post("/api/model/cascade")
+async def configure_cascade(cascade: CascadeConfig):
+    if cascade.enabled is not None:
+        model_manager.cascade_enabled = cascade.enabled
+        if cascade.enabled and model_manager.fast_model is None:
+            load_cascade_fast_model()
+    if cascade.confidence_threshold is not None:
+        model_manager.confidence_threshold = cascade.confidence_threshold
+    if cascade.margin_threshold is not None:
+        model_manager.margin_threshold = cascade.margin_threshold
+    if cascade.reset_stats:
+        model_manager.reset_cascade_stats()
+    
+    return {
+        "success": True,
+        "data": model_manager.get_cascade_stats()
+    }
+
+@app.get("/api/model/cascade/evaluate")
+async def evaluate_cascade():
+    try:
+        if model_manager.model is None or model_manager.fast_model is None:
+            raise HTTPException(status_code=400, detail="Cascade requires both a full and a fast model")
+        
+        def run():
+            _, (x_test, y_test) = AdvancedModelTrainer().load_data(use_augmentation=False)
+            return model_manager.evaluate_cascade(np.asarray(x_test), np.asarray(y_test))
+        
+        return {
+            "success": True,
+            "data": await run_in_threadpool(run)
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Cascade evaluation error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/export/user/{user_id}")
+async def export_user_data(user_id: int, format: str = "json", table: str = "predictions", compress: bool = False):
+    try:
+        if format == "json":
+            data = await db_call('export_user_data', user_id, format='json')
             return {
                 "success": True,
                 "data": data
             }
+        
+        if use_async_db():
+            parts = astream_user_export(async_db_manager, user_id, table=table, format=format, compress=compress)
+        else:
+            parts = stream_user_export(db_manager, user_id, table=table, format=format, compress=compress)
+        media_type = "application/gzip" if compress else EXPORT_FORMATS[format][0]
+        filename = export_filename(user_id, table, format, compress)
+        return StreamingResponse(
+            parts,
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
             
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Export error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
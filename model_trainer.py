@@ -5,23 +5,367 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import confusion_matrix, classification_report
 import pandas as pd
 import os
+import sys
 import time
+import json
+import stat
+import pickle
+import random
+import shutil
+import uuid
+import hashlib
+import logging
+import contextlib
+import multiprocessing
 from datetime import datetime
 import keras_tuner as kt
-from utils import data_augmentor
+import cv2
+from utils import data_augmentor, AdvancedImagePreprocessor
+from dataset_cache import dataset_cache
+from packed_dataset import packed_dataset, pack_custom_dataset
 from database import db_manager
 from config import config
 
+logger = logging.getLogger(__name__)
+
+class TrainingProgressCallback(keras.callbacks.Callback):
+    """Reports epoch/batch progress to a queue and stops training once cancel_event is set."""
+    
+    def __init__(self, progress_queue, cancel_event=None, report_interval=1.0):
+        super().__init__()
+        self.progress_queue = progress_queue
+        self.cancel_event = cancel_event
+        self.report_interval = report_interval
+        self.last_report = 0
+        self.epoch = 0
+        self.cancelled = False
+    
+    @staticmethod
+    def _metrics(logs):
+        return {k: float(v) for k, v in (logs or {}).items()}
+    
+    def _check_cancel(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            self.cancelled = True
+            self.model.stop_training = True
+    
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.progress_queue.put({
+            'event': 'epoch_begin',
+            'epoch': epoch,
+            'total_epochs': self.params.get('epochs'),
+            'total_batches': self.params.get('steps')
+        })
+    
+    def on_train_batch_end(self, batch, logs=None):
+        self._check_cancel()
+        now = time.time()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.progress_queue.put({'event': 'batch', 'epoch': self.epoch, 'batch': batch, 'metrics': self._metrics(logs)})
+    
+    def on_epoch_end(self, epoch, logs=None):
+        self._check_cancel()
+        self.progress_queue.put({'event': 'epoch_end', 'epoch': epoch, 'metrics': self._metrics(logs)})
+
+def _peak_rss_mb():
+    try:
+        import resource
+        # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss / (1024 * 1024) if os.uname().sysname == 'Darwin' else peak_rss / 1024
+    except ImportError:
+        return float('nan')
+
+class TrainingProfilerCallback(keras.callbacks.Callback):
+    """Adds throughput, input wait vs compute time and peak RSS to each epoch's logs (and so to the history).
+
+    Keras fetches each batch inside the train function, so the model's train_step is wrapped to time the forward pass,
+    backward pass and update in the graph (compute_ms); the rest of each train-function call is input_wait_ms.
+    between_steps_ms is the callback and Python overhead between steps.
+    """
+    
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self.compute_seconds = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+    
+    def set_model(self, model):
+        super().set_model(model)
+        if getattr(model, 'profiled_by', None) is self:
+            return
+        base_step = type(model).train_step.__get__(model)
+        compute_seconds = self.compute_seconds
+        
+        def timed_train_step(data):
+            start = tf.timestamp()
+            # The batch only becomes available after the start stamp, so no compute can run ahead of it
+            with tf.control_dependencies([start]):
+                data = tf.nest.map_structure(tf.identity, data)
+            logs = base_step(data)
+            with tf.control_dependencies(tf.nest.flatten(logs)):
+                compute_seconds.assign_add(tf.timestamp() - start)
+            return logs
+        
+        model.train_step = timed_train_step
+        model.profiled_by = self
+        # A train function traced before the wrap would bypass it
+        model.train_function = None
+    
+    def on_epoch_begin(self, epoch, logs=None):
+        self.compute_seconds.assign(0.0)
+        self.epoch_start = time.perf_counter()
+        self.last_batch_end = self.epoch_start
+        self.between_steps = 0.0
+        self.train_step = 0.0
+        self.steps = 0
+    
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+        self.between_steps += self.batch_start - self.last_batch_end
+    
+    def on_train_batch_end(self, batch, logs=None):
+        self.last_batch_end = time.perf_counter()
+        self.train_step += self.last_batch_end - self.batch_start
+        self.steps += 1
+    
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None or not self.steps:
+            return
+        train_time = self.between_steps + self.train_step
+        logs['samples_per_sec'] = self.steps * self.batch_size / train_time if train_time else 0.0
+        logs['step_time_ms'] = 1000 * train_time / self.steps
+        compute = float(self.compute_seconds.numpy())
+        logs['train_step_ms'] = 1000 * self.train_step / self.steps
+        logs['compute_ms'] = 1000 * compute / self.steps
+        logs['input_wait_ms'] = 1000 * max(self.train_step - compute, 0.0) / self.steps
+        logs['between_steps_ms'] = 1000 * self.between_steps / self.steps
+        logs['epoch_time_s'] = time.perf_counter() - self.epoch_start
+        logs['peak_rss_mb'] = _peak_rss_mb()
+
+class ResumableCheckpointCallback(keras.callbacks.Callback):
+    """Periodically checkpoints weights, optimizer, epoch, RNG and callback state so an interrupted run can resume."""
+    
+    CALLBACK_STATE = ('wait', 'best', 'cooldown_counter', 'stopped_epoch', 'best_epoch', 'best_weights')
+    
+    def __init__(self, checkpoint_dir, watched_callbacks=(), every_epochs=None):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.watched_callbacks = list(watched_callbacks)
+        self.every_epochs = every_epochs or config.CHECKPOINT_EVERY_EPOCHS
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.history = {}
+        self.callback_state = None
+        self.manager = None
+    
+    def _build(self, model):
+        checkpoint = tf.train.Checkpoint(
+            model=model,
+            optimizer=model.optimizer,
+            epoch=self.epoch,
+            generator=tf.random.get_global_generator()
+        )
+        self.manager = tf.train.CheckpointManager(checkpoint, self.checkpoint_dir, max_to_keep=2)
+        return checkpoint
+    
+    def restore(self, model):
+        # Returns the epoch to resume from (0 for a fresh run); call before fit()
+        self.callback_state = None
+        checkpoint = self._build(model)
+        state_path = os.path.join(self.checkpoint_dir, 'state.pkl')
+        if self.manager.latest_checkpoint is None or not os.path.exists(state_path):
+            return 0
+        checkpoint.restore(self.manager.latest_checkpoint)
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+        np.random.set_state(state['numpy_rng'])
+        random.setstate(state['python_rng'])
+        self.history = state['history']
+        self.callback_state = state['callbacks']
+        print(f"Resuming training from epoch {int(self.epoch.numpy())} ({self.manager.latest_checkpoint})")
+        return int(self.epoch.numpy())
+    
+    def on_train_begin(self, logs=None):
+        # EarlyStopping / ReduceLROnPlateau reset their counters in their own on_train_begin, so the saved state is
+        # applied here; this callback must come after the watched ones in the callback list
+        for callback, saved in zip(self.watched_callbacks, self.callback_state or []):
+            for name, value in saved.items():
+                setattr(callback, name, value)
+    
+    def on_epoch_end(self, epoch, logs=None):
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(value))
+        if (epoch + 1) % self.every_epochs:
+            return
+        self.epoch.assign(epoch + 1)
+        self.manager.save(checkpoint_number=epoch + 1)
+        state = {
+            'numpy_rng': np.random.get_state(),
+            'python_rng': random.getstate(),
+            'history': self.history,
+            'callbacks': [
+                {name: getattr(callback, name) for name in self.CALLBACK_STATE if hasattr(callback, name)}
+                for callback in self.watched_callbacks
+            ]
+        }
+        tmp_path = os.path.join(self.checkpoint_dir, 'state.pkl.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(tmp_path, os.path.join(self.checkpoint_dir, 'state.pkl'))
+
+def new_version_name(prefix):
+    # Timestamps only have one-second resolution, so a random suffix keeps versions created in the same second apart
+    return f"{prefix}_{config.get_timestamp()}_{uuid.uuid4().hex[:6]}"
+
+def threading_config(intra_op_threads=None, inter_op_threads=None):
+    """Thread-pool sizes from the arguments, then config, then the autotune file, plus the autotuned batch size."""
+    tuned = {}
+    if os.path.exists(config.THREADING_AUTOTUNE_PATH):
+        with open(config.THREADING_AUTOTUNE_PATH) as f:
+            tuned = json.load(f)
+    return {
+        'intra_op_threads': intra_op_threads or config.INTRA_OP_THREADS or tuned.get('intra_op_threads'),
+        'inter_op_threads': inter_op_threads or config.INTER_OP_THREADS or tuned.get('inter_op_threads'),
+        'batch_size': tuned.get('batch_size')
+    }
+
+THREAD_ENV = {'intra_op_threads': 'TF_NUM_INTRAOP_THREADS', 'inter_op_threads': 'TF_NUM_INTEROP_THREADS'}
+
+@contextlib.contextmanager
+def threading_environment(intra_op_threads=None, inter_op_threads=None):
+    """Set TF_NUM_INTRAOP_THREADS / TF_NUM_INTEROP_THREADS for processes started inside the block.
+
+    tf.config.threading setters raise once the runtime is up, and importing utils loads the serving model, so a child
+    process gets its pool sizes from the environment, which TF reads when its runtime starts.
+    """
+    overrides = {THREAD_ENV['intra_op_threads']: intra_op_threads, THREAD_ENV['inter_op_threads']: inter_op_threads}
+    saved = {name: os.environ.get(name) for name in overrides}
+    try:
+        for name, value in overrides.items():
+            if value:
+                os.environ[name] = str(int(value))
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def start_with_threads(process, intra_op_threads=None, inter_op_threads=None):
+    """Start a spawned process whose TF runtime uses the given thread-pool sizes."""
+    with threading_environment(intra_op_threads, inter_op_threads):
+        process.start()
+    return process
+
+def apply_threading_config(intra_op_threads=None, inter_op_threads=None):
+    """Check the resolved thread-pool sizes are in effect in this process; returns the autotuned batch size, if any.
+
+    Sizes already passed through the environment are accepted; otherwise they are set with tf.config.threading, which
+    only works before the TF runtime starts. A size that cannot be applied raises RuntimeError.
+    """
+    settings = threading_config(intra_op_threads, inter_op_threads)
+    setters = {
+        'intra_op_threads': tf.config.threading.set_intra_op_parallelism_threads,
+        'inter_op_threads': tf.config.threading.set_inter_op_parallelism_threads
+    }
+    for name, setter in setters.items():
+        value = settings[name]
+        if not value or os.environ.get(THREAD_ENV[name]) == str(int(value)):
+            continue
+        try:
+            setter(int(value))
+        except RuntimeError as e:
+            logger.error(f"Cannot apply {name}={value}: TensorFlow is already initialized")
+            raise RuntimeError(f"Cannot apply {name}={value} after TensorFlow has initialized; start the process "
+                               f"with start_with_threads() or set {THREAD_ENV[name]}") from e
+    if settings['intra_op_threads'] or settings['inter_op_threads']:
+        logger.info(f"TensorFlow thread pools: intra_op={settings['intra_op_threads']} inter_op={settings['inter_op_threads']}")
+    return settings['batch_size']
+
+class LatencyAwareTuner(kt.RandomSearch):
+    """Scores each trial by validation accuracy, pushing trials that exceed the CPU latency budget below every feasible one."""
+    
+    def __init__(self, *args, latency_budgets_ms=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency_budgets_ms = latency_budgets_ms or config.LATENCY_BUDGETS_MS
+    
+    @staticmethod
+    def _check_cancel(callbacks):
+        # FatalError is the one exception keras_tuner lets out of search() instead of marking the trial failed
+        if any(getattr(callback, 'cancel_event', None) is not None and callback.cancel_event.is_set()
+               for callback in callbacks or []):
+            raise kt.errors.FatalError("Latency search cancelled")
+    
+    def run_trial(self, trial, x, y, validation_data, epochs, callbacks=None, **kwargs):
+        self._check_cancel(callbacks)
+        model = self.hypermodel.build(trial.hyperparameters)
+        history = model.fit(
+            x, y,
+            batch_size=config.BATCH_SIZE,
+            epochs=epochs,
+            validation_data=validation_data,
+            callbacks=callbacks,
+            verbose=0
+        )
+        self._check_cancel(callbacks)
+        val_accuracy = max(history.history['val_accuracy'])
+        latency = AdvancedModelTrainer.measure_inference_latency(model, batch_sizes=self.latency_budgets_ms.keys())
+        overshoot = max(latency[b]['p95_ms'] / budget for b, budget in self.latency_budgets_ms.items())
+        score = val_accuracy if overshoot <= 1 else val_accuracy - overshoot
+        
+        metrics = {
+            'score': score,
+            'val_accuracy': val_accuracy,
+            'params': float(model.count_params())
+        }
+        for batch_size, stats in latency.items():
+            metrics[f'p95_ms_batch_{batch_size}'] = stats['p95_ms']
+            metrics[f'p50_ms_batch_{batch_size}'] = stats['p50_ms']
+        return metrics
+
 class AdvancedModelTrainer:
     def __init__(self):
         self.model = None
+        self.model_version = None
+        self.model_path = None
         self.history = None
         self.training_time = 0
+        self.last_evaluation = None
     
-    def load_data(self, use_augmentation=True):
+    def load_data(self, use_augmentation=True, use_cache=True):
+        """MNIST as float32 NHWC with one-hot labels, optionally with materialised augmented copies of the training set.
+
+        Augmented data is only cached when AUGMENTATION_SEED is set; with a random seed every call draws fresh copies.
+        The augmented entry holds just the training arrays, the test split is shared with the base entry.
+        """
+        if use_augmentation:
+            (x_train, y_train_cat), (x_test, y_test_cat) = self.load_data(use_augmentation=False, use_cache=use_cache)
+            cache_params = {
+                'source': 'mnist',
+                'augmentation': True,
+                'copies': config.AUGMENTATION_COPIES,
+                'seed': config.AUGMENTATION_SEED
+            }
+            use_cache = use_cache and config.AUGMENTATION_SEED is not None
+            if use_cache:
+                cached = dataset_cache.load(cache_params)
+                if cached is not None:
+                    return cached[0], (x_test, y_test_cat)
+            x_train, y_train_cat = self.augment_copies(x_train, y_train_cat)
+            if use_cache:
+                return dataset_cache.store(cache_params, x_train, y_train_cat)[0], (x_test, y_test_cat)
+            return (x_train, y_train_cat), (x_test, y_test_cat)
+        
+        cache_params = {'source': 'mnist', 'augmentation': False, 'copies': 0, 'seed': None}
+        if use_cache:
+            cached = dataset_cache.load(cache_params)
+            if cached is not None:
+                return cached
+        
         (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
         x_train = x_train.astype('float32') / 255.0
         x_test = x_test.astype('float32') / 255.0
@@ -30,23 +374,20 @@ class AdvancedModelTrainer:
         y_train_cat = keras.utils.to_categorical(y_train, 10)
         y_test_cat = keras.utils.to_categorical(y_test, 10)
         
-        if use_augmentation:
-            x_train_augmented = []
-            y_train_augmented = []
-            
-            for i in range(len(x_train)):
-                x_train_augmented.append(x_train[i])
-                y_train_augmented.append(y_train_cat[i])
-                for _ in range(2):  
-                    augmented_img = data_augmentor.augment_image(x_train[i].reshape(28, 28))
-                    x_train_augmented.append(augmented_img.reshape(28, 28, 1))
-                    y_train_augmented.append(y_train_cat[i])
-            
-            x_train = np.array(x_train_augmented)
-            y_train_cat = np.array(y_train_augmented)
-        
+        if use_cache:
+            return dataset_cache.store(cache_params, x_train, y_train_cat, x_test, y_test_cat)
         return (x_train, y_train_cat), (x_test, y_test_cat)
     
+    def augment_copies(self, x_train, y_train):
+        """Originals followed by AUGMENTATION_COPIES augmented copies of each image, interleaved per source row."""
+        copies = config.AUGMENTATION_COPIES
+        augmented = np.empty((len(x_train), copies + 1, 28, 28, 1), dtype=np.float32)
+        augmented[:, 0] = x_train
+        seeds = np.random.SeedSequence(config.AUGMENTATION_SEED).spawn(copies)
+        for k in range(copies):
+            data_augmentor.augment_batch(x_train, out=augmented[:, k + 1], seed=seeds[k])
+        return augmented.reshape(-1, 28, 28, 1), np.repeat(y_train, copies + 1, axis=0)
+    
     def create_advanced_model(self, hp=None):
         if hp:
             filters_1 = hp.Int('filters_1', 32, 128, step=32)
@@ -92,124 +433,744 @@ class AdvancedModelTrainer:
         
         return model
     
-    def train_model(self, use_hyperparameter_tuning=False):
-        start_time = time.time()
-        (x_train, y_train), (x_test, y_test) = self.load_data(use_augmentation=True)
-        if use_hyperparameter_tuning:
-            tuner = kt.Hyperband(
-                self.create_advanced_model,
-                objective='val_accuracy',
-                max_epochs=50,
-                factor=3,
-                directory='models/model_history',
-                project_name='hyperparameter_tuning'
+    def build_input_pipeline(self, x_train, y_train, batch_size=None, seed=None):
+        """Stream (copies + 1) passes over the source images per epoch, augmenting batches in parallel map stages.
+
+        Augmentation is pure TF ops (DataAugmentor.augment_batch_tf), so map calls run concurrently without the GIL.
+        """
+        batch_size = batch_size or config.BATCH_SIZE
+        copies = config.AUGMENTATION_COPIES
+        augment_fraction = copies / (copies + 1)
+        seed = config.AUGMENTATION_SEED if seed is None else seed
+
+        def augment(images, labels, batch_seed):
+            return data_augmentor.augment_batch_tf(images, batch_seed, augment_fraction=augment_fraction), labels
+        
+        dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
+        dataset = dataset.repeat(copies + 1)
+        dataset = dataset.shuffle(config.SHUFFLE_BUFFER_SIZE, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+        dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.random(seed=seed).batch(2)))
+        dataset = dataset.map(lambda batch, batch_seed: augment(batch[0], batch[1], batch_seed),
+                              num_parallel_calls=tf.data.AUTOTUNE, deterministic=seed is not None)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+    
+    def build_generator_pipeline(self, x_train, y_train, batch_size=None):
+        datagen = keras.preprocessing.image.ImageDataGenerator(
+            rotation_range=10,
+            width_shift_range=0.1,
+            height_shift_range=0.1,
+            zoom_range=0.1,
+            shear_range=0.1,
+            fill_mode='nearest'
+        )
+        return datagen.flow(x_train, y_train, batch_size=batch_size or config.BATCH_SIZE)
+    
+    def create_searchable_model(self, hp):
+        """Like create_advanced_model, but depth (conv blocks, convs per block, dense layers) is searched as well as width."""
+        blocks = hp.Int('conv_blocks', 1, 3)
+        convs_per_block = hp.Int('convs_per_block', 1, 2)
+        dense_layers = hp.Int('dense_layers', 0, 2)
+        dropout_rate = hp.Float('dropout_rate', 0.1, 0.4, step=0.1)
+        
+        model = keras.Sequential([layers.Input(shape=(28, 28, 1))])
+        for block in range(blocks):
+            filters = hp.Int(f'filters_{block}', 8, 64, step=8)
+            for _ in range(convs_per_block):
+                model.add(layers.Conv2D(filters, (3, 3), padding='same', activation='relu'))
+                model.add(layers.BatchNormalization())
+            model.add(layers.MaxPooling2D((2, 2)))
+            model.add(layers.Dropout(dropout_rate))
+        model.add(layers.Flatten())
+        for i in range(dense_layers):
+            model.add(layers.Dense(hp.Int(f'dense_units_{i}', 32, 256, step=32), activation='relu'))
+            model.add(layers.Dropout(dropout_rate))
+        model.add(layers.Dense(10, activation='softmax'))
+        model.compile(
+            optimizer=keras.optimizers.Adam(learning_rate=hp.Choice('learning_rate', [1e-2, 1e-3, 1e-4])),
+            loss='categorical_crossentropy',
+            metrics=['accuracy', 'precision', 'recall']
+        )
+        
+        return model
+    
+    @staticmethod
+    def measure_inference_latency(model, batch_sizes=(1, 32), runs=50, warmup=5):
+        latency = {}
+        for batch_size in batch_sizes:
+            batch = np.random.rand(int(batch_size), 28, 28, 1).astype(np.float32)
+            for _ in range(warmup):
+                model(batch, training=False)
+            timings = []
+            for _ in range(runs):
+                start_time = time.perf_counter()
+                model(batch, training=False)
+                timings.append((time.perf_counter() - start_time) * 1000)
+            latency[int(batch_size)] = {
+                'p50_ms': float(np.percentile(timings, 50)),
+                'p95_ms': float(np.percentile(timings, 95)),
+                'per_image_ms': float(np.percentile(timings, 50) / batch_size)
+            }
+        return latency
+    
+    def search_latency_aware(self, max_trials=None, epochs=None, latency_budgets_ms=None, callbacks=None):
+        """Search depth/width for accuracy under the latency budgets; returns the tuner, or None if cancelled.
+
+        callbacks are passed to every trial's fit(), so a TrainingProgressCallback reports progress and its cancel_event
+        stops the search between and within trials.
+        """
+        tuner = LatencyAwareTuner(
+            self.create_searchable_model,
+            objective=kt.Objective('score', direction='max'),
+            max_trials=max_trials or config.LATENCY_SEARCH_TRIALS,
+            directory=config.MODEL_HISTORY_PATH,
+            project_name='latency_search',
+            overwrite=False,
+            latency_budgets_ms=latency_budgets_ms
+        )
+        x_train, y_train = self.tuning_subset()
+        _, (x_test, y_test) = self.load_data(use_augmentation=False)
+        try:
+            tuner.search(
+                x_train, y_train,
+                validation_data=(np.asarray(x_test), np.asarray(y_test)),
+                epochs=epochs or config.LATENCY_SEARCH_EPOCHS,
+                callbacks=list(callbacks or [])
             )
-            
-            stop_early = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=5)
-            tuner.search(x_train, y_train, epochs=50, validation_split=0.2, callbacks=[stop_early])
-            best_hps = tuner.get_best_hyperparameters(num_trials=1)[0]
-            self.model = tuner.hypermodel.build(best_hps)
+        except kt.errors.FatalError as e:
+            logger.info(str(e))
+            return None
+        return tuner
+    
+    def pareto_report(self, tuner, save_path=None):
+        """One row per completed trial with accuracy, size and latency metrics, flagged if it is on the Pareto front."""
+        rows = []
+        for trial in tuner.oracle.get_best_trials(num_trials=len(tuner.oracle.trials)):
+            row = {'trial_id': trial.trial_id, 'hyperparameters': trial.hyperparameters.values}
+            for name in trial.metrics.metrics:
+                row[name] = float(trial.metrics.get_last_value(name))
+            # Failed, invalid or interrupted trials have no metrics to compare
+            if 'val_accuracy' in row and 'params' in row:
+                rows.append(row)
+        
+        latency_keys = sorted(set.intersection(*(
+            {k for k in row if k.startswith('p95_ms_batch_')} for row in rows
+        ))) if rows else []
+        for row in rows:
+            # A trial is on the front if no other trial is at least as good on every axis and better on one
+            row['pareto_optimal'] = not any(
+                other is not row
+                and other['val_accuracy'] >= row['val_accuracy']
+                and other['params'] <= row['params']
+                and all(other[k] <= row[k] for k in latency_keys)
+                and (other['val_accuracy'] > row['val_accuracy'] or other['params'] < row['params']
+                     or any(other[k] < row[k] for k in latency_keys))
+                for other in rows
+            )
+        
+        save_path = save_path or os.path.join(config.MODEL_HISTORY_PATH, 'latency_search', 'pareto_report.csv')
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        frame = pd.DataFrame(rows)
+        if rows:
+            frame = frame.sort_values('val_accuracy', ascending=False)
+        frame.to_csv(save_path, index=False)
+        print(f"Pareto report written to {save_path} ({sum(r['pareto_optimal'] for r in rows)} of {len(rows)} trials on the front)")
+        return rows
+    
+    @staticmethod
+    def select_fastest(report, accuracy_bar, batch_size=1):
+        """The report row with the lowest p95 latency at batch_size among trials reaching accuracy_bar, or None."""
+        key = f'p95_ms_batch_{batch_size}'
+        eligible = [row for row in report if row['val_accuracy'] >= accuracy_bar and key in row]
+        return min(eligible, key=lambda row: row[key]) if eligible else None
+    
+    def instrumentation_callbacks(self, level=None):
+        # Profiler goes first so the metrics it adds to the epoch logs reach CSVLogger and History
+        level = level or config.TRAINING_INSTRUMENTATION
+        if level == 'none':
+            return []
+        callbacks = [TrainingProfilerCallback(config.BATCH_SIZE)]
+        if level == 'full':
+            callbacks.append(keras.callbacks.TensorBoard(
+                log_dir='models/tensorboard_logs',
+                histogram_freq=1,
+                profile_batch=(10, 20)
+            ))
+        else:
+            callbacks.append(keras.callbacks.TensorBoard(
+                log_dir='models/tensorboard_logs',
+                histogram_freq=0
+            ))
+        return callbacks
+    
+    def autotune_threading(self, candidates=None, steps=None):
+        """Benchmark thread-pool / batch-size combinations on short runs, each in a fresh process, and save the fastest."""
+        cores = os.cpu_count() or 1
+        if candidates is None:
+            candidates = [
+                {'intra_op_threads': intra, 'inter_op_threads': inter, 'batch_size': batch_size}
+                for intra in sorted({cores, max(1, cores // 2)})
+                for inter in (1, 2)
+                for batch_size in (32, 64, 128)
+            ]
+        steps = steps or config.THREADING_AUTOTUNE_STEPS
+        context = multiprocessing.get_context('spawn')
+        results = []
+        for candidate in candidates:
+            # The worker is started with the candidate's pool sizes in its environment; it raises if they did not apply
+            with threading_environment(candidate['intra_op_threads'], candidate['inter_op_threads']):
+                pool = context.Pool(1)
+            with pool:
+                samples_per_sec = pool.apply(_benchmark_training_config, (candidate, steps))
+            results.append({**candidate, 'samples_per_sec': samples_per_sec})
+            logger.info(f"intra={candidate['intra_op_threads']} inter={candidate['inter_op_threads']} "
+                        f"batch={candidate['batch_size']}: {samples_per_sec:.0f} samples/s")
+        
+        best = max(results, key=lambda r: r['samples_per_sec'])
+        os.makedirs(os.path.dirname(config.THREADING_AUTOTUNE_PATH), exist_ok=True)
+        with open(config.THREADING_AUTOTUNE_PATH, 'w') as f:
+            json.dump({**best, 'results': results, 'timestamp': datetime.utcnow().isoformat()}, f, indent=2)
+        return best
+    
+    def build_tuner(self):
+        # overwrite=False makes a restarted search reload the oracle state and continue
+        return kt.Hyperband(
+            self.create_advanced_model,
+            objective='val_accuracy',
+            max_epochs=config.TUNING_MAX_EPOCHS,
+            factor=3,
+            directory=config.MODEL_HISTORY_PATH,
+            project_name='hyperparameter_tuning',
+            overwrite=False
+        )
+    
+    def tuning_subset(self):
+        """Subsample the source images, then augment only the subsample so tuning sees the same distribution as training."""
+        (x_train, y_train), _ = self.load_data(use_augmentation=False)
+        rng = np.random.default_rng(config.TUNING_SEED)
+        size = int(len(x_train) * config.TUNING_SUBSAMPLE)
+        idx = np.sort(rng.permutation(len(x_train))[:size])
+        return self.augment_copies(np.asarray(x_train[idx]), np.asarray(y_train[idx]))
+    
+    def tune_hyperparameters(self, n_workers=None, cancel_event=None):
+        """Run the Hyperband search on a subsample, fanning trials out to worker processes via a local oracle.
+
+        Even a single worker runs in its own process, so its TF thread pools can be sized and a cancel can stop it.
+        """
+        n_workers = n_workers or config.TUNING_WORKERS
+        context = multiprocessing.get_context('spawn')
+        # The same pool sizes training uses (config, then autotune, then every core), split between the workers
+        settings = threading_config()
+        threads = max(1, (settings['intra_op_threads'] or os.cpu_count() or 1) // n_workers)
+        if n_workers <= 1:
+            processes = [context.Process(target=_run_tuner_process, args=(None,))]
+            start_with_threads(processes[0], threads, settings['inter_op_threads'])
+        else:
+            processes = [context.Process(target=_run_tuner_process, args=('chief',))]
+            processes += [context.Process(target=_run_tuner_process, args=(f'tuner{i}',)) for i in range(n_workers)]
+            start_with_threads(processes[0], 1)
+            for process in processes[1:]:
+                start_with_threads(process, threads, settings['inter_op_threads'])
+        
+        while any(process.is_alive() for process in processes):
+            if cancel_event is not None and cancel_event.is_set():
+                for process in processes:
+                    process.terminate()
+                return None
+            processes[0].join(timeout=1)
+            if not processes[0].is_alive():
+                for process in processes[1:]:
+                    process.join(timeout=config.TRAINING_CANCEL_GRACE_PERIOD)
+                    if process.is_alive():
+                        process.terminate()
+        
+        if processes[0].exitcode != 0:
+            raise RuntimeError(f"Hyperparameter search process exited with code {processes[0].exitcode}")
+        
+        best_hps = self.build_tuner().get_best_hyperparameters(num_trials=1)
+        return best_hps[0] if best_hps else None
+    
+    def train_model(self, use_hyperparameter_tuning=False, input_pipeline=None, extra_callbacks=None, tuning_objective='accuracy'):
+        start_time = time.time()
+        tuned_batch_size = apply_threading_config()
+        if tuned_batch_size and config.USE_AUTOTUNED_BATCH_SIZE:
+            config.BATCH_SIZE = tuned_batch_size
+        input_pipeline = input_pipeline or config.TRAINING_INPUT_PIPELINE
+        streaming = input_pipeline == 'tf_data'
+        (x_train, y_train), (x_test, y_test) = self.load_data(use_augmentation=not streaming)
+        if config.MIX_CUSTOM_DATASET_IN_TRAINING:
+            x_custom, y_custom, _ = self.load_custom_dataset()
+            x_train, y_train = self.mix_with_mnist(x_train, y_train, x_custom, y_custom)
+        if use_hyperparameter_tuning and tuning_objective == 'latency':
+            tuner = self.search_latency_aware(callbacks=extra_callbacks)
+            if tuner is None:
+                return None
+            selected = self.select_fastest(self.pareto_report(tuner), config.LATENCY_ACCURACY_BAR)
+            if selected is not None:
+                best_hps = tuner.oracle.get_trial(selected['trial_id']).hyperparameters
+                logger.info(f"Selected trial {selected['trial_id']}: val_accuracy {selected['val_accuracy']:.4f}, "
+                            f"p95 {selected['p95_ms_batch_1']:.2f} ms at batch 1")
+            else:
+                best_hps = next(iter(tuner.get_best_hyperparameters(num_trials=1)), None)
+                logger.warning(f"No trial reached val_accuracy {config.LATENCY_ACCURACY_BAR}; using the best-scoring trial")
+            if best_hps is None:
+                return None
+            self.model = self.create_searchable_model(best_hps)
+        elif use_hyperparameter_tuning:
+            cancel_events = [getattr(callback, 'cancel_event', None) for callback in extra_callbacks or []]
+            best_hps = self.tune_hyperparameters(cancel_event=next((e for e in cancel_events if e is not None), None))
+            if best_hps is None:
+                return None
+            self.model = self.create_advanced_model(best_hps)
         else:
             self.model = self.create_advanced_model()
         
+        # Runs with the same architecture and settings share a checkpoint directory, so a restart picks up where it stopped
+        run_key = hashlib.sha1(
+            f"{self.model.to_json()}|{config.EPOCHS}|{config.BATCH_SIZE}|{input_pipeline}".encode('utf-8')
+        ).hexdigest()[:12]
+        checkpoint_dir = os.path.join(config.CHECKPOINT_PATH, run_key)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        
+        early_stopping = keras.callbacks.EarlyStopping(
+            monitor='val_accuracy',
+            patience=15,
+            restore_best_weights=True,
+            mode='max'
+        )
+        reduce_lr = keras.callbacks.ReduceLROnPlateau(
+            monitor='val_loss',
+            factor=0.5,
+            patience=5,
+            min_lr=1e-7
+        )
+        checkpoint = ResumableCheckpointCallback(checkpoint_dir, watched_callbacks=[early_stopping, reduce_lr])
         callbacks = [
-            keras.callbacks.EarlyStopping(
-                monitor='val_accuracy',
-                patience=15,
-                restore_best_weights=True,
-                mode='max'
-            ),
-            keras.callbacks.ReduceLROnPlateau(
-                monitor='val_loss',
-                factor=0.5,
-                patience=5,
-                min_lr=1e-7
-            ),
+            early_stopping,
+            reduce_lr,
             keras.callbacks.ModelCheckpoint(
-                'models/best_model.h5',
+                os.path.join(checkpoint_dir, 'best_model.h5'),
                 monitor='val_accuracy',
                 save_best_only=True,
                 mode='max'
             ),
             keras.callbacks.CSVLogger('models/training_history.csv'),
-            keras.callbacks.TensorBoard(
-                log_dir='models/tensorboard_logs',
-                histogram_freq=1
-            )
+            checkpoint
         ]
+        callbacks = self.instrumentation_callbacks() + callbacks
+        callbacks.extend(extra_callbacks or [])
+        initial_epoch = checkpoint.restore(self.model)
+        for callback in callbacks:
+            if isinstance(callback, keras.callbacks.CSVLogger):
+                callback.append = initial_epoch > 0
         
-        datagen = keras.preprocessing.image.ImageDataGenerator(
-            rotation_range=10,
-            width_shift_range=0.1,
-            height_shift_range=0.1,
-            zoom_range=0.1,
-            shear_range=0.1,
-            fill_mode='nearest'
-        )
+        if streaming:
+            train_data = self.build_input_pipeline(x_train, y_train)
+        else:
+            train_data = self.build_generator_pipeline(x_train, y_train)
         
         self.history = self.model.fit(
-            datagen.flow(x_train, y_train, batch_size=config.BATCH_SIZE),
+            train_data,
             epochs=config.EPOCHS,
+            initial_epoch=initial_epoch,
             validation_data=(x_test, y_test),
             callbacks=callbacks,
             verbose=1
         )
+        # Report the whole run, including epochs completed before a resume
+        self.history.history = checkpoint.history
         
         self.training_time = time.time() - start_time
-        self.model.save(config.MODEL_PATH)
-        self._log_training_performance(x_test, y_test)
+        if any(getattr(callback, 'cancelled', False) for callback in callbacks):
+            return self.history
+        self.model_version = new_version_name('train')
+        evaluation = self.evaluate_model(x_test, y_test)
+        metrics = {
+            'test_accuracy': float(evaluation['test_accuracy']),
+            'test_loss': float(evaluation['test_loss']),
+            'validation_accuracy': max(self.history.history.get('val_accuracy', [0.0])),
+            'epochs_trained': len(self.history.history.get('loss', [])),
+            'training_time': self.training_time
+        }
+        version_path = self.save_versioned_artifact(self.model, self.model_version, metrics)
+        self.model_path = version_path
+        base = db_manager.get_active_model_version()
+        db_manager.register_model_version(
+            version=self.model_version,
+            model_path=version_path,
+            training_type='full',
+            parent_version=base.version if base else None,
+            feedback_watermark=base.feedback_watermark if base else 0,
+            custom_dataset_watermark=base.custom_dataset_watermark if base else 0,
+            metrics=metrics
+        )
+        self._log_training_performance(evaluation)
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
         
         return self.history
     
-    def _log_training_performance(self, x_test, y_test):
-        test_results = self.model.evaluate(x_test, y_test, verbose=0)
-        test_loss, test_accuracy = test_results[0], test_results[1]
-        val_accuracy = max(self.history.history['val_accuracy'])
+    def save_versioned_artifact(self, model, version, metrics):
+        # Versions are immutable: the model and its metrics are written once and made read-only
+        os.makedirs(config.MODEL_HISTORY_PATH, exist_ok=True)
+        version_path = os.path.join(config.MODEL_HISTORY_PATH, f"{version}.h5")
+        metadata_path = os.path.join(config.MODEL_HISTORY_PATH, f"{version}.json")
+        if os.path.exists(version_path):
+            raise FileExistsError(f"Model version {version} already exists")
+        model.save(version_path)
+        with open(metadata_path, 'w') as f:
+            json.dump({'version': version, 'created_at': datetime.utcnow().isoformat(), 'metrics': metrics}, f, indent=2)
+        for path in (version_path, metadata_path):
+            os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        return version_path
+    
+    def load_samples(self, samples):
+        """Preprocessed images and one-hot labels for the samples whose image loaded, plus the ids of those samples."""
+        images, labels, ids = [], [], []
+        for sample in samples:
+            image = cv2.imread(sample['image_path'], cv2.IMREAD_GRAYSCALE) if sample['image_path'] else None
+            if image is None:
+                continue
+            processed, _ = AdvancedImagePreprocessor.preprocess_image(image, target_size=(28, 28))
+            images.append(processed.reshape(28, 28, 1))
+            labels.append(sample['digit'])
+            ids.append(sample['id'])
+        if not images:
+            return np.empty((0, 28, 28, 1), dtype=np.float32), np.empty((0, 10), dtype=np.float32), ids
+        return np.array(images, dtype=np.float32), keras.utils.to_categorical(labels, 10), ids
+    
+    @staticmethod
+    def loaded_watermark(samples, loaded_ids, after_id):
+        """Highest id such that every sample up to it was loaded; a sample that failed to load is retried next time."""
+        loaded = set(loaded_ids)
+        watermark = after_id
+        for sample in sorted(samples, key=lambda s: s['id']):
+            if sample['id'] not in loaded:
+                logger.warning(f"Sample {sample['id']} could not be loaded; holding the watermark at {watermark}")
+                break
+            watermark = sample['id']
+        return watermark
+    
+    def load_custom_dataset(self, after_id=0, pack=True, manager=None, store=None):
+        """Verified custom samples from the packed shards as float arrays, plus their custom_dataset ids."""
+        store = store or packed_dataset
+        if pack:
+            pack_custom_dataset(manager or db_manager, store)
+        parts = store.load(after_id)
+        count = sum(len(images) for images, _, _ in parts)
+        x = np.empty((count, 28, 28, 1), dtype=np.float32)
+        labels = np.empty(count, dtype=np.uint8)
+        ids = np.empty(count, dtype=np.int64)
+        offset = 0
+        # The shard views are read straight from the page cache; the only copy is the uint8 -> float32 conversion
+        for images, shard_labels, shard_ids in parts:
+            end = offset + len(images)
+            np.divide(images, 255.0, out=x[offset:end, :, :, 0], dtype=np.float32)
+            labels[offset:end] = shard_labels
+            ids[offset:end] = shard_ids
+            offset = end
+        return x, keras.utils.to_categorical(labels, 10), ids
+    
+    @staticmethod
+    def mix_with_mnist(x_mnist, y_mnist, x_custom, y_custom, replay_size=None):
+        """Custom samples followed by MNIST (all of it, or a random replay_size subset)."""
+        if replay_size is not None:
+            replay_idx = np.sort(np.random.choice(len(x_mnist), replay_size, replace=False))
+            x_mnist, y_mnist = x_mnist[replay_idx], y_mnist[replay_idx]
+        if len(x_custom) == 0:
+            return x_mnist, y_mnist
+        return np.concatenate([x_custom, x_mnist]), np.concatenate([y_custom, y_mnist])
+    
+    def fine_tune(self, epochs=None, extra_callbacks=None):
+        """Fine-tune the active model on feedback/custom samples newer than its id watermarks, mixed with MNIST replay."""
+        start_time = time.time()
+        base = db_manager.get_active_model_version()
+        base_path = base.model_path if base else config.MODEL_PATH
+        feedback_after = base.feedback_watermark if base else 0
+        custom_after = base.custom_dataset_watermark if base else 0
         
-        performance_data = {
-            'timestamp': datetime.utcnow(),
-            'accuracy': test_accuracy,
-            'loss': test_loss,
-            'validation_accuracy': val_accuracy,
-            'validation_loss': min(self.history.history['val_loss']),
-            'training_time': self.training_time,
-            'model_architecture': str(self.model.summary()),
-            'hyperparameters': {
-                'batch_size': config.BATCH_SIZE,
-                'epochs': config.EPOCHS,
-                'optimizer': 'Adam'
-            }
+        samples = db_manager.get_new_training_samples(feedback_after, custom_after)
+        if not samples['feedback'] and not samples['custom_dataset']:
+            print("No new verified samples since the last model version")
+            return None
+        
+        # Custom dataset images come from the packed shards; only feedback images are still decoded one file at a time
+        x_feedback, y_feedback, feedback_ids = self.load_samples(samples['feedback'])
+        x_custom, y_custom, custom_ids = self.load_custom_dataset(after_id=custom_after)
+        x_new = np.concatenate([x_feedback, x_custom])
+        y_new = np.concatenate([y_feedback, y_custom])
+        if len(x_new) == 0:
+            print("New samples could not be loaded from disk")
+            return None
+        
+        (x_mnist, y_mnist), (x_test, y_test) = self.load_data(use_augmentation=False)
+        replay_size = min(len(x_mnist), max(config.FINE_TUNE_MIN_REPLAY, len(x_new) * config.FINE_TUNE_REPLAY_RATIO))
+        x_train, y_train = self.mix_with_mnist(x_mnist, y_mnist, x_new, y_new, replay_size)
+        
+        self.model = keras.models.load_model(base_path)
+        self.model.compile(
+            optimizer=keras.optimizers.Adam(learning_rate=config.FINE_TUNE_LEARNING_RATE),
+            loss='categorical_crossentropy',
+            metrics=['accuracy', 'precision', 'recall']
+        )
+        callbacks = list(extra_callbacks or [])
+        self.history = self.model.fit(
+            x_train, y_train,
+            batch_size=config.BATCH_SIZE,
+            epochs=epochs or config.FINE_TUNE_EPOCHS,
+            validation_data=(x_test, y_test),
+            shuffle=True,
+            callbacks=callbacks,
+            verbose=1
+        )
+        self.training_time = time.time() - start_time
+        if any(getattr(callback, 'cancelled', False) for callback in callbacks):
+            return None
+        
+        version = new_version_name('finetune')
+        self.model_version = version
+        evaluation = self.evaluate_model(x_test, y_test)
+        test_loss, test_accuracy = evaluation['test_loss'], evaluation['test_accuracy']
+        metrics = {
+            'test_accuracy': float(test_accuracy),
+            'test_loss': float(test_loss),
+            'new_samples': int(len(x_new)),
+            'replay_samples': int(replay_size),
+            'training_time': self.training_time
         }
+        version_path = self.save_versioned_artifact(self.model, version, metrics)
+        db_manager.register_model_version(
+            version=version,
+            model_path=version_path,
+            training_type='fine_tune',
+            parent_version=base.version if base else None,
+            feedback_watermark=self.loaded_watermark(samples['feedback'], feedback_ids, feedback_after),
+            # Never past a custom sample that is still unpacked, so it is trained on once its image can be read
+            custom_dataset_watermark=max(custom_after, min(int(custom_ids.max()), packed_dataset.read_index()['packed_through']))
+            if len(custom_ids) else custom_after,
+            metrics=metrics
+        )
+        self.save_evaluation(version, evaluation, history=self.history, training_type='fine_tune')
+        print(f"Fine-tuned {version} on {len(x_new)} new samples in {self.training_time:.2f} seconds")
+        print(f"Test Accuracy: {test_accuracy:.4f}")
+        
+        return {
+            'version': version,
+            'model_path': version_path,
+            'test_accuracy': float(test_accuracy),
+            'test_loss': float(test_loss),
+            'new_samples': int(len(x_new)),
+            'training_time': self.training_time
+        }
+    
+    def create_student_model(self, filters=(8, 16), dense_units=32):
+        # Outputs logits; distill() wraps it in a softmax for serving
+        model = keras.Sequential([layers.Input(shape=(28, 28, 1))])
+        for f in filters:
+            model.add(layers.Conv2D(f, (3, 3), padding='same', activation='relu'))
+            model.add(layers.MaxPooling2D((2, 2)))
+        model.add(layers.Flatten())
+        model.add(layers.Dense(dense_units, activation='relu'))
+        model.add(layers.Dense(10))
+        return model
+    
+    @staticmethod
+    def distillation_loss(temperature, alpha):
+        # The loss class exists under the same name in Keras 2 and 3; reduction is left to fit()
+        kl_divergence = keras.losses.KLDivergence(reduction='none')
+        
+        def loss(y_true, logits):
+            hard, soft = y_true[:, :10], y_true[:, 10:]
+            hard_loss = keras.losses.categorical_crossentropy(hard, logits, from_logits=True)
+            soft_loss = kl_divergence(soft, tf.nn.softmax(logits / temperature))
+            return alpha * hard_loss + (1 - alpha) * (temperature ** 2) * soft_loss
+        return loss
+    
+    def distill(self, teacher_path=None, epochs=None, temperature=None, alpha=None, activate=False, extra_callbacks=None):
+        """Train a small student on the teacher's temperature-softened outputs and register it as a model version."""
+        start_time = time.time()
+        temperature = temperature or config.DISTILLATION_TEMPERATURE
+        alpha = config.DISTILLATION_ALPHA if alpha is None else alpha
+        base = db_manager.get_active_model_version()
+        teacher_path = teacher_path or (base.model_path if base else config.MODEL_PATH)
+        teacher = keras.models.load_model(teacher_path)
+        
+        (x_train, y_train), (x_test, y_test) = self.load_data(use_augmentation=False)
+        # The teacher ends in a softmax, so log-probabilities stand in for its logits
+        teacher_probs = teacher.predict(x_train, batch_size=512, verbose=0)
+        soft_targets = tf.nn.softmax(np.log(np.clip(teacher_probs, 1e-8, 1.0)) / temperature).numpy()
+        targets = np.concatenate([np.asarray(y_train), soft_targets], axis=1)
+        
+        student = self.create_student_model()
+        student.compile(
+            optimizer=keras.optimizers.Adam(learning_rate=1e-3),
+            loss=self.distillation_loss(temperature, alpha)
+        )
+        callbacks = list(extra_callbacks or [])
+        student.fit(
+            x_train, targets,
+            batch_size=config.BATCH_SIZE,
+            epochs=epochs or config.DISTILLATION_EPOCHS,
+            shuffle=True,
+            callbacks=callbacks,
+            verbose=1
+        )
+        self.training_time = time.time() - start_time
+        if any(getattr(callback, 'cancelled', False) for callback in callbacks):
+            return None
+        
+        serving_model = keras.Sequential([student, layers.Softmax()])
+        serving_model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+        teacher_results = self.evaluate_model(x_test, y_test, model=teacher)
+        student_results = self.evaluate_model(x_test, y_test, model=serving_model)
+        teacher_latency = self.measure_inference_latency(teacher)
+        student_latency = self.measure_inference_latency(serving_model)
+        
+        version = new_version_name('student')
+        self.model_version = version
+        metrics = {
+            'test_accuracy': float(student_results['test_accuracy']),
+            'test_loss': float(student_results['test_loss']),
+            'teacher_test_accuracy': float(teacher_results['test_accuracy']),
+            'params': int(serving_model.count_params()),
+            'teacher_params': int(teacher.count_params()),
+            'per_image_ms': student_latency[1]['per_image_ms'],
+            'teacher_per_image_ms': teacher_latency[1]['per_image_ms'],
+            'training_time': self.training_time
+        }
+        version_path = self.save_versioned_artifact(serving_model, version, metrics)
+        db_manager.register_model_version(
+            version=version,
+            model_path=version_path,
+            training_type='distillation',
+            parent_version=base.version if base else None,
+            feedback_watermark=base.feedback_watermark if base else 0,
+            custom_dataset_watermark=base.custom_dataset_watermark if base else 0,
+            metrics=metrics,
+            activate=activate
+        )
+        self.save_evaluation(version, student_results, training_type='distillation', model=serving_model)
+        
+        self.model = serving_model
+        print(f"Student {version}: {metrics['params']} params, accuracy {metrics['test_accuracy']:.4f} "
+              f"(teacher {metrics['teacher_test_accuracy']:.4f}), "
+              f"{metrics['teacher_per_image_ms'] / metrics['per_image_ms']:.1f}x faster per image")
+        
+        return {'version': version, 'model_path': version_path, 'activated': activate, **metrics}
+    
+    def _log_training_performance(self, evaluation):
+        self.save_evaluation(self.model_version, evaluation, history=self.history, training_type='full')
+        val_accuracy = max(self.history.history['val_accuracy'])
         
         print(f"Training completed in {self.training_time:.2f} seconds")
-        print(f"Test Accuracy: {test_accuracy:.4f}")
+        print(f"Test Accuracy: {evaluation['test_accuracy']:.4f}")
         print(f"Validation Accuracy: {val_accuracy:.4f}")
+    
+    def save_evaluation(self, model_version, evaluation, history=None, training_type=None, model=None):
+        model = model or self.model
+        history = history.history if history is not None else {}
+        db_manager.save_model_performance(
+            model_version=model_version,
+            accuracy=evaluation['test_accuracy'],
+            loss=evaluation['test_loss'],
+            validation_accuracy=max(history['val_accuracy']) if history.get('val_accuracy') else None,
+            validation_loss=min(history['val_loss']) if history.get('val_loss') else None,
+            training_time=self.training_time,
+            model_architecture=model.to_json(),
+            hyperparameters={
+                'batch_size': config.BATCH_SIZE,
+                'epochs': len(history.get('loss', [])) or None,
+                'optimizer': 'Adam',
+                'training_type': training_type
+            },
+            evaluation={
+                'test_samples': int(evaluation['confusion_matrix'].sum()),
+                'confusion_matrix': evaluation['confusion_matrix'].tolist(),
+                'classification_report': evaluation['classification_report'],
+                'class_accuracy': {str(k): float(v) for k, v in evaluation['class_accuracy'].items()}
+            }
+        )
+        
+    @staticmethod
+    def _report_from_confusion_matrix(cm):
+        # Same layout as sklearn's classification_report(output_dict=True)
+        true_positives = np.diag(cm).astype(np.float64)
+        support = cm.sum(axis=1)
+        predicted = cm.sum(axis=0)
+        precision = np.divide(true_positives, predicted, out=np.zeros(len(cm)), where=predicted > 0)
+        recall = np.divide(true_positives, support, out=np.zeros(len(cm)), where=support > 0)
+        denominator = precision + recall
+        f1 = np.divide(2 * precision * recall, denominator, out=np.zeros(len(cm)), where=denominator > 0)
         
-    def evaluate_model(self, x_test, y_test):
-        test_loss, test_accuracy = self.model.evaluate(x_test, y_test, verbose=0)
-        y_pred = self.model.predict(x_test)
-        y_pred_classes = np.argmax(y_pred, axis=1)
+        report = {}
+        for i in range(len(cm)):
+            report[str(i)] = {
+                'precision': float(precision[i]),
+                'recall': float(recall[i]),
+                'f1-score': float(f1[i]),
+                'support': int(support[i])
+            }
+        total = int(support.sum())
+        report['accuracy'] = float(true_positives.sum() / total) if total else 0.0
+        report['macro avg'] = {
+            'precision': float(precision.mean()),
+            'recall': float(recall.mean()),
+            'f1-score': float(f1.mean()),
+            'support': total
+        }
+        weights = support / total if total else np.zeros(len(cm))
+        report['weighted avg'] = {
+            'precision': float((precision * weights).sum()),
+            'recall': float((recall * weights).sum()),
+            'f1-score': float((f1 * weights).sum()),
+            'support': total
+        }
+        return report
+    
+    def evaluate_model(self, x_test, y_test, model=None, batch_size=1024):
+        """Loss, accuracy, confusion matrix and per-class metrics from a single batched pass over the test set."""
+        model = model or self.model
+        n = len(x_test)
         y_true_classes = np.argmax(y_test, axis=1)
-        cm = confusion_matrix(y_true_classes, y_pred_classes)
-        report = classification_report(y_true_classes, y_pred_classes, output_dict=True)
-        class_accuracy = {}
-        for i in range(10):
-            class_mask = y_true_classes == i
-            if np.sum(class_mask) > 0:
-                class_accuracy[i] = np.mean(y_pred_classes[class_mask] == i)
+        y_pred_classes = np.empty(n, dtype=np.int64)
+        cm = np.zeros((10, 10), dtype=np.int64)
+        loss_sum = 0.0
+        
+        for start in range(0, n, batch_size):
+            stop = min(start + batch_size, n)
+            probs = np.asarray(model.predict_on_batch(np.asarray(x_test[start:stop])))
+            true = y_true_classes[start:stop]
+            pred = np.argmax(probs, axis=1)
+            loss_sum -= np.log(np.clip(probs[np.arange(len(true)), true], 1e-7, 1.0)).sum()
+            cm += np.bincount(true * 10 + pred, minlength=100).reshape(10, 10)
+            y_pred_classes[start:stop] = pred
+        
+        report = self._report_from_confusion_matrix(cm)
+        class_accuracy = {i: report[str(i)]['recall'] for i in range(10) if report[str(i)]['support'] > 0}
         
         evaluation_results = {
-            'test_accuracy': test_accuracy,
-            'test_loss': test_loss,
+            'test_accuracy': report['accuracy'],
+            'test_loss': float(loss_sum / n) if n else 0.0,
             'confusion_matrix': cm,
             'classification_report': report,
             'class_accuracy': class_accuracy,
             'predictions': y_pred_classes,
             'true_labels': y_true_classes
         }
+        self.last_evaluation = evaluation_results
         
         return evaluation_results
     
+    def benchmark_input_pipelines(self, steps=200, pipelines=('tf_data', 'generator')):
+        """Time each input pipeline in a fresh process so peak RSS is not shared between runs."""
+        context = multiprocessing.get_context('spawn')
+        results = {}
+        for pipeline in pipelines:
+            with context.Pool(1) as pool:
+                results[pipeline] = pool.apply(_benchmark_pipeline, (pipeline, steps))
+            print(f"{pipeline}: {results[pipeline]['steps_per_sec']:.1f} steps/s, "
+                  f"peak RSS {results[pipeline]['peak_rss_mb']:.0f} MB")
+        return results
+    
     def plot_training_history(self, save_path=None):
         fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(15, 10))
         ax1.plot(self.history.history['accuracy'], label='Training Accuracy')
@@ -253,7 +1214,64 @@ class AdvancedModelTrainer:
         
         return fig
     
+def _run_tuner_process(tuner_id):
+    if tuner_id is not None:
+        os.environ['KERASTUNER_TUNER_ID'] = tuner_id
+        os.environ['KERASTUNER_ORACLE_IP'] = config.TUNING_ORACLE_HOST
+        os.environ['KERASTUNER_ORACLE_PORT'] = str(config.TUNING_ORACLE_PORT)
+    
+    trainer = AdvancedModelTrainer()
+    tuner = trainer.build_tuner()
+    x_train, y_train = trainer.tuning_subset()
+    stop_early = keras.callbacks.EarlyStopping(monitor='val_loss', patience=5)
+    tuner.search(x_train, y_train, epochs=config.TUNING_MAX_EPOCHS, validation_split=0.2, callbacks=[stop_early])
+
+def _benchmark_training_config(candidate, steps):
+    apply_threading_config(candidate['intra_op_threads'], candidate['inter_op_threads'])
+    trainer = AdvancedModelTrainer()
+    (x_train, y_train), _ = trainer.load_data(use_augmentation=False)
+    batch_size = candidate['batch_size']
+    # One warm-up step is trained separately so graph tracing is not timed
+    size = batch_size * (steps + 1)
+    x_train, y_train = np.asarray(x_train[:size]), np.asarray(y_train[:size])
+    model = trainer.create_advanced_model()
+    profiler = TrainingProfilerCallback(batch_size)
+    model.fit(x_train[:batch_size], y_train[:batch_size], batch_size=batch_size, epochs=1, callbacks=[profiler], verbose=0)
+    history = model.fit(x_train[batch_size:], y_train[batch_size:], batch_size=batch_size, epochs=1,
+                        callbacks=[profiler], verbose=0)
+    return float(history.history['samples_per_sec'][0])
+
+def _benchmark_pipeline(pipeline, steps):
+    trainer = AdvancedModelTrainer()
+    start_time = time.time()
+    if pipeline == 'tf_data':
+        (x_train, y_train), _ = trainer.load_data(use_augmentation=False, use_cache=False)
+        iterator = iter(trainer.build_input_pipeline(x_train, y_train))
+    else:
+        (x_train, y_train), _ = trainer.load_data(use_augmentation=True, use_cache=False)
+        iterator = iter(trainer.build_generator_pipeline(x_train, y_train))
+    prepare_time = time.time() - start_time
+    
+    next(iterator)
+    start_time = time.time()
+    for _ in range(steps):
+        next(iterator)
+    elapsed = time.time() - start_time
+    
+    return {
+        'prepare_time': prepare_time,
+        'steps_per_sec': steps / elapsed,
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
 if __name__ == "__main__":
+    # Thread pools are sized when TF starts, which importing this module already did, so re-run with them in the env
+    settings = threading_config()
+    with threading_environment(settings['intra_op_threads'], settings['inter_op_threads']):
+        environment = dict(os.environ)
+    if any(environment.get(name) != os.environ.get(name) for name in THREAD_ENV.values()):
+        os.execve(sys.executable, [sys.executable] + sys.argv, environment)
+    
     trainer = AdvancedModelTrainer()
     history = trainer.train_model(use_hyperparameter_tuning=False)
     (x_train, y_train), (x_test, y_test) = trainer.load_data(use_augmentation=False)
@@ -6,6 +6,7 @@ import json
 import time
 import sys
 from io import BytesIO
+from datetime import datetime
 from PIL import Image, ImageDraw
 import numpy as np
 
@@ -199,6 +200,14 @@ def test_prediction_history():
             data = response.json()
             if data['success']:
                 print_success(f"Prediction history retrieved ({data['count']} records)")
+                if data['next_cursor']:
+                    next_page = requests.get(f"{BASE_URL}/api/analytics/predictions",
+                                             params={'limit': 10, 'cursor': data['next_cursor']}).json()
+                    seen = {row['id'] for row in data['data']}
+                    if any(row['id'] in seen for row in next_page['data']):
+                        print_error("Next page repeats rows from the first page")
+                        return False
+                    print_success(f"Next page retrieved ({next_page['count']} records)")
                 return True
             else:
                 print_error("Prediction history returned success=False")
@@ -284,6 +293,279 @@ def test_feedback():
         print_error(f"Feedback error: {str(e)}")
         return False
 
+def test_feedback_batch():
+    print_info("Testing batch feedback submission...")
+    try:
+        img_base64 = image_to_base64(create_test_digit_image(7))
+        pred_response = requests.post(
+            f"{BASE_URL}/api/predict",
+            json={
+                "image_data": f"data:image/png;base64,{img_base64}",
+                "user_id": TEST_USER_ID
+            }
+        )
+        
+        if pred_response.status_code != 200:
+            print_error("Could not create prediction for batch feedback test")
+            return False
+        
+        prediction_id = pred_response.json()['prediction_id']
+        response = requests.post(
+            f"{BASE_URL}/api/feedback/batch",
+            json={
+                "items": [
+                    {"prediction_id": prediction_id, "user_id": TEST_USER_ID, "actual_digit": 7},
+                    {"prediction_id": -1, "user_id": TEST_USER_ID, "actual_digit": 7}
+                ]
+            }
+        )
+        
+        if response.status_code == 200:
+            data = response.json()['data']
+            print_info(f"Accepted: {data['accepted']}, rejected: {len(data['rejected'])}")
+            if data['accepted'] == 1 and [r['index'] for r in data['rejected']] == [1]:
+                print_success("Batch feedback submitted successfully")
+                return True
+            print_error("Batch feedback did not reject the unknown prediction")
+            return False
+        else:
+            print_error(f"Batch feedback failed with status {response.status_code}")
+            return False
+    
+    except Exception as e:
+        print_error(f"Batch feedback error: {str(e)}")
+        return False
+
+def test_training_jobs():
+    print_info("Testing training job listing...")
+    try:
+        response = requests.get(f"{BASE_URL}/api/train/jobs")
+        
+        if response.status_code == 200:
+            data = response.json()
+            if data['success']:
+                print_success(f"Training jobs retrieved ({len(data['data'])} jobs)")
+                return True
+            else:
+                print_error("Training jobs returned success=False")
+                return False
+        else:
+            print_error(f"Training jobs failed with status {response.status_code}")
+            return False
+    except Exception as e:
+        print_error(f"Training jobs error: {str(e)}")
+        return False
+
+def test_query_plans():
+    print_info("Testing that hot analytics queries use indexes...")
+    try:
+        from database import db_manager, UserFeedback, _export_query, _user_digit_query
+        if not db_manager.db_url.startswith('sqlite'):
+            print_warning("Query plan check only runs against SQLite")
+            return True
+        
+        # The statements the app builds, compiled by SQLAlchemy, not hand-written copies of them
+        since = datetime(2000, 1, 1)
+        expected = [
+            (db_manager._history_query(user_id=TEST_USER_ID).limit(50), 'ix_prediction_history_user_timestamp'),
+            (db_manager._history_query().limit(50), 'ix_prediction_history_timestamp'),
+            (db_manager._history_query(since=since).limit(50), 'ix_prediction_history_timestamp'),
+            (_user_digit_query(TEST_USER_ID), 'sqlite_autoindex_analytics_rollups_1'),
+            (_export_query(UserFeedback, TEST_USER_ID, 500, since=since), 'ix_user_feedback_user_timestamp'),
+        ]
+        
+        for statement, index_name in expected:
+            plan = ' '.join(db_manager.explain_query_plan(statement))
+            if index_name not in plan:
+                print_error(f"Query does not use {index_name}: {plan}")
+                return False
+        
+        print_success(f"All hot queries use indexes (schema version {db_manager.schema_version()})")
+        return True
+    except Exception as e:
+        print_error(f"Query plan error: {str(e)}")
+        return False
+
+def test_packed_custom_dataset():
+    print_info("Testing packed custom dataset round trip...")
+    import os
+    import shutil
+    import tempfile
+    try:
+        from archive import ArchiveStore
+        from database import AdvancedDatabaseManager, User
+        from packed_dataset import PackedDatasetStore
+        from model_trainer import AdvancedModelTrainer
+        from utils import AdvancedImagePreprocessor
+        
+        root = tempfile.mkdtemp()
+        try:
+            manager = AdvancedDatabaseManager(f"sqlite:///{root}/test.db", archive=ArchiveStore(f"{root}/archive"), shard_urls=[])
+            with manager.engine.begin() as conn:
+                conn.execute(User.__table__.insert(), [{'id': TEST_USER_ID, 'username': 'packed_test_user'}])
+            
+            # Real PNG files promoted through feedback, as the API does it
+            digits = [3, 7, 1, 9, 0]
+            items, expected = [], []
+            for i, digit in enumerate(digits):
+                path = os.path.join(root, f"{i}.png")
+                img = create_test_digit_image(digit)
+                img.save(path)
+                processed, _ = AdvancedImagePreprocessor.preprocess_image(np.array(img), target_size=(28, 28))
+                expected.append(np.round(processed * 255).astype(np.uint8) / 255.0)
+                prediction_id = manager.add_prediction(TEST_USER_ID, digit, 0.9, path, 'test', f"{i}.png", 0.01, '28x28', 'test')
+                items.append({'prediction_id': prediction_id, 'user_id': TEST_USER_ID, 'actual_digit': digit})
+            manager.add_feedback_batch(items, promote_to_dataset=True)
+            
+            store = PackedDatasetStore(os.path.join(root, 'packed'), shard_size=2)
+            x, y, ids = AdvancedModelTrainer().load_custom_dataset(manager=manager, store=store)
+            
+            if len(x) != len(digits) or store.stats()['shards'] != 3:
+                print_error(f"Expected {len(digits)} samples in 3 shards, got {len(x)} in {store.stats()['shards']}")
+                return False
+            if list(np.argmax(y, axis=1)) != digits or list(ids) != sorted(ids):
+                print_error("Packed labels or ids do not match the promoted samples")
+                return False
+            if not np.allclose(x[..., 0], np.array(expected), atol=1e-6):
+                print_error("Packed images differ from the preprocessed PNGs")
+                return False
+            
+            x_after, _, _ = AdvancedModelTrainer().load_custom_dataset(after_id=int(ids[1]), manager=manager, store=store)
+            if len(x_after) != len(digits) - 2:
+                print_error(f"Expected {len(digits) - 2} samples after id {ids[1]}, got {len(x_after)}")
+                return False
+            
+            print_success(f"Packed {len(x)} PNG samples into {store.stats()['shards']} shards and loaded them back")
+            return True
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    except Exception as e:
+        print_error(f"Packed dataset error: {str(e)}")
+        return False
+
+def test_write_buffer_rejection():
+    print_info("Testing that a rejected buffered prediction does not stall flushes...")
+    import os
+    import shutil
+    import tempfile
+    try:
+        from archive import ArchiveStore
+        from config import config
+        from database import AdvancedDatabaseManager, PredictionWriteBuffer
+        
+        root = tempfile.mkdtemp()
+        put_timeout = config.WRITE_BEHIND_PUT_TIMEOUT
+        try:
+            manager = AdvancedDatabaseManager(f"sqlite:///{root}/test.db", archive=ArchiveStore(f"{root}/archive"), shard_urls=[])
+            buffer = PredictionWriteBuffer(manager, max_queue=1, spill_path=os.path.join(root, 'spill.jsonl'))
+            record = {'user_id': TEST_USER_ID, 'predicted_digit': 3, 'confidence': 0.9, 'image_path': None, 'user_input_type': 'test',
+                      'file_name': None, 'processing_time': 0.01, 'image_size': '28x28', 'model_version': 'test'}
+            
+            # Nothing drains the queue until start(), so the second submit times out and is rejected
+            config.WRITE_BEHIND_PUT_TIMEOUT = 0.2
+            buffer.submit(dict(record))
+            try:
+                buffer.submit(dict(record))
+                print_error("Second submit was accepted by a full queue")
+                return False
+            except RuntimeError:
+                pass
+            
+            buffer.start()
+            flushed = buffer.flush(timeout=2)
+            buffer.stop()
+            if not flushed or buffer.submitted != 1 or buffer.written != 1:
+                print_error(f"flush() returned {flushed} with submitted={buffer.submitted}, written={buffer.written}")
+                return False
+            
+            print_success("Rejected submit is not counted and flush() completes")
+            return True
+        finally:
+            config.WRITE_BEHIND_PUT_TIMEOUT = put_timeout
+            shutil.rmtree(root, ignore_errors=True)
+    except Exception as e:
+        print_error(f"Write buffer error: {str(e)}")
+        return False
+
+def test_distillation_step():
+    print_info("Testing one distillation training step...")
+    try:
+        import tensorflow as tf
+        from tensorflow import keras
+        from model_trainer import AdvancedModelTrainer
+        
+        rng = np.random.default_rng(0)
+        x = rng.random((32, 28, 28, 1), dtype=np.float32)
+        hard = keras.utils.to_categorical(rng.integers(0, 10, 32), 10)
+        soft = tf.nn.softmax(rng.normal(size=(32, 10)).astype(np.float32) / 4.0).numpy()
+        
+        student = AdvancedModelTrainer().create_student_model()
+        student.compile(optimizer=keras.optimizers.Adam(learning_rate=1e-3),
+                        loss=AdvancedModelTrainer.distillation_loss(4.0, 0.3))
+        loss = float(student.train_on_batch(x, np.concatenate([hard, soft], axis=1)))
+        if not np.isfinite(loss):
+            print_error(f"Distillation loss is not finite: {loss}")
+            return False
+        
+        print_success(f"Distillation step ran with loss {loss:.4f}")
+        return True
+    except Exception as e:
+        print_error(f"Distillation error: {str(e)}")
+        return False
+
+def test_packed_dataset_retry():
+    print_info("Testing that an unreadable custom dataset image is packed once it is fixed...")
+    import os
+    import shutil
+    import tempfile
+    try:
+        from archive import ArchiveStore
+        from database import AdvancedDatabaseManager, User
+        from packed_dataset import PackedDatasetStore, pack_custom_dataset
+        
+        root = tempfile.mkdtemp()
+        try:
+            manager = AdvancedDatabaseManager(f"sqlite:///{root}/test.db", archive=ArchiveStore(f"{root}/archive"), shard_urls=[])
+            with manager.engine.begin() as conn:
+                conn.execute(User.__table__.insert(), [{'id': TEST_USER_ID, 'username': 'packed_retry_user'}])
+            
+            items = []
+            for i, digit in enumerate([2, 4, 6]):
+                path = os.path.join(root, f"{i}.png")
+                if i == 1:
+                    with open(path, 'wb') as f:
+                        f.write(b'not a png')
+                else:
+                    create_test_digit_image(digit).save(path)
+                prediction_id = manager.add_prediction(TEST_USER_ID, digit, 0.9, path, 'test', f"{i}.png", 0.01, '28x28', 'test')
+                items.append({'prediction_id': prediction_id, 'user_id': TEST_USER_ID, 'actual_digit': digit})
+            manager.add_feedback_batch(items, promote_to_dataset=True)
+            ids = [sample['id'] for sample in manager.get_custom_dataset_samples()]
+            
+            store = PackedDatasetStore(os.path.join(root, 'packed'))
+            first = pack_custom_dataset(manager, store)
+            if first['packed'] != 2 or first['skipped'] != 1 or store.read_index()['packed_through'] != ids[0]:
+                print_error(f"First pack should hold at id {ids[0]}: {first}, packed_through={store.read_index()['packed_through']}")
+                return False
+            
+            create_test_digit_image(4).save(os.path.join(root, "1.png"))
+            second = pack_custom_dataset(manager, store)
+            loaded = sorted(int(i) for _, _, part_ids in store.load() for i in part_ids)
+            if second['packed'] != 1 or loaded != ids or store.read_index()['packed_through'] != ids[-1]:
+                print_error(f"Fixed image was not packed: {second}, loaded ids {loaded}")
+                return False
+            if [int(i) for _, _, part_ids in store.load(after_id=ids[0]) for i in part_ids] != [ids[2], ids[1]]:
+                print_error("Loading after the first id did not return the retried sample")
+                return False
+            
+            print_success("Unreadable image was skipped, then packed after it was fixed")
+            return True
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+    except Exception as e:
+        print_error(f"Packed dataset retry error: {str(e)}")
+        return False
+
 def run_all_tests():
     print("\n" + "="*60)
     print("  Handwriting Recognition API Test Suite")
@@ -298,6 +580,13 @@ def run_all_tests():
         ("Prediction History", test_prediction_history),
         ("User Creation", test_create_user),
         ("Feedback Submission", test_feedback),
+        ("Batch Feedback", test_feedback_batch),
+        ("Training Jobs", test_training_jobs),
+        ("Query Plans", test_query_plans),
+        ("Packed Custom Dataset", test_packed_custom_dataset),
+        ("Packed Dataset Retry", test_packed_dataset_retry),
+        ("Write Buffer Rejection", test_write_buffer_rejection),
+        ("Distillation Step", test_distillation_step),
     ]
     
     results = {}
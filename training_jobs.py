@@ -0,0 +1,217 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+from config import config
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+def _run_training_job(job_id, job_type, params, progress_queue, cancel_event):
+    # Runs in a child process so training never competes with the API's event loop or GIL
+    try:
+        from model_trainer import AdvancedModelTrainer, TrainingProgressCallback
+        config.EPOCHS = params.get('epochs', config.EPOCHS)
+        config.BATCH_SIZE = params.get('batch_size', config.BATCH_SIZE)
+        trainer = AdvancedModelTrainer()
+        progress = TrainingProgressCallback(progress_queue, cancel_event)
+        if job_type == 'autotune':
+            best = trainer.autotune_threading(steps=params.get('steps'))
+            progress_queue.put({'state': COMPLETED, 'result': {'skipped': True, 'autotune': best}})
+            return
+        if job_type in ('fine_tune', 'distill'):
+            if job_type == 'fine_tune':
+                result = trainer.fine_tune(epochs=params.get('epochs'), extra_callbacks=[progress])
+            else:
+                result = trainer.distill(epochs=params.get('epochs'), activate=params.get('activate', False),
+                                         extra_callbacks=[progress])
+            # A result means the version was saved and registered, even if a cancel arrived after fit() finished
+            if result is not None:
+                progress_queue.put({'state': COMPLETED, 'result': result})
+            elif cancel_event.is_set():
+                progress_queue.put({'state': CANCELLED})
+            else:
+                progress_queue.put({'state': COMPLETED, 'result': {'skipped': True, 'message': 'No new samples'}})
+            return
+        history = trainer.train_model(
+            use_hyperparameter_tuning=params.get('use_hyperparameter_tuning', False),
+            input_pipeline=params.get('input_pipeline'),
+            extra_callbacks=[progress],
+            tuning_objective=params.get('tuning_objective', 'accuracy')
+        )
+        if history is None or trainer.model_path is None:
+            progress_queue.put({'state': CANCELLED})
+            return
+        results = trainer.last_evaluation
+        progress_queue.put({
+            'state': COMPLETED,
+            'result': {
+                'version': trainer.model_version,
+                'test_accuracy': float(results['test_accuracy']),
+                'test_loss': float(results['test_loss']),
+                'training_time': float(trainer.training_time),
+                'model_path': trainer.model_path
+            }
+        })
+    except Exception as e:
+        progress_queue.put({'state': FAILED, 'error': str(e)})
+
+class TrainingJobManager:
+    def __init__(self, poll_interval=0.5):
+        self.poll_interval = poll_interval
+        self.context = multiprocessing.get_context('spawn')
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.on_complete = []
+        self.current = None
+        self._worker = None
+
+    def start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._dispatch_loop, name='training-jobs', daemon=True)
+            self._worker.start()
+
+    def submit(self, params, job_type='train'):
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'job_type': job_type,
+                'state': PENDING,
+                'params': params,
+                'submitted_at': datetime.utcnow().isoformat(),
+                'started_at': None,
+                'finished_at': None,
+                'epoch': None,
+                'total_epochs': params.get('epochs'),
+                'batch': None,
+                'metrics': {},
+                'history': [],
+                'result': None,
+                'error': None
+            }
+        self.pending.put(job_id)
+        self.start()
+        return job_id
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['state'] in FINISHED_STATES:
+                return False
+            if job['state'] == PENDING:
+                job['state'] = CANCELLED
+                job['finished_at'] = datetime.utcnow().isoformat()
+                return True
+            if self.current and self.current['job_id'] == job_id:
+                self.current['cancel_event'].set()
+        return True
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def _dispatch_loop(self):
+        while True:
+            job_id = self.pending.get()
+            job = self.get(job_id)
+            if job is None or job['state'] != PENDING:
+                continue
+            try:
+                self._run(job)
+            except Exception as e:
+                logger.error(f"Training job {job_id} crashed: {str(e)}")
+                self._update(job_id, state=FAILED, error=str(e), finished_at=datetime.utcnow().isoformat())
+
+    def _run(self, job):
+        job_id = job['job_id']
+        progress_queue = self.context.Queue()
+        cancel_event = self.context.Event()
+        process = self.context.Process(
+            target=_run_training_job,
+            args=(job_id, job['job_type'], job['params'], progress_queue, cancel_event)
+        )
+        with self.lock:
+            self.current = {'job_id': job_id, 'process': process, 'cancel_event': cancel_event}
+            self.jobs[job_id].update(state=RUNNING, started_at=datetime.utcnow().isoformat())
+        # TF thread pools can only be sized before the child's runtime starts, so they are passed in its environment
+        from model_trainer import threading_config, start_with_threads
+        threads = threading_config()
+        start_with_threads(process, threads['intra_op_threads'], threads['inter_op_threads'])
+        logger.info(f"Training job {job_id} started in process {process.pid}")
+
+        final = None
+        cancel_deadline = None
+        while final is None:
+            try:
+                message = progress_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if cancel_event.is_set() and cancel_deadline is None:
+                    cancel_deadline = time.time() + config.TRAINING_CANCEL_GRACE_PERIOD
+                if cancel_deadline and time.time() > cancel_deadline and process.is_alive():
+                    process.terminate()
+                    final = {'state': CANCELLED}
+                elif not process.is_alive() and progress_queue.empty():
+                    final = {'state': CANCELLED} if cancel_event.is_set() else {
+                        'state': FAILED, 'error': f"Training process exited with code {process.exitcode}"}
+                continue
+            if message.get('state') in FINISHED_STATES:
+                final = message
+            else:
+                self._apply_progress(job_id, message)
+
+        process.join(timeout=config.TRAINING_CANCEL_GRACE_PERIOD)
+        with self.lock:
+            self.current = None
+            self.jobs[job_id].update(
+                state=final['state'],
+                result=final.get('result'),
+                error=final.get('error'),
+                finished_at=datetime.utcnow().isoformat()
+            )
+        logger.info(f"Training job {job_id} finished: {final['state']}")
+        if final['state'] == COMPLETED:
+            for callback in self.on_complete:
+                try:
+                    callback(self.get(job_id))
+                except Exception as e:
+                    logger.error(f"Training job completion hook failed: {str(e)}")
+
+    def _apply_progress(self, job_id, message):
+        with self.lock:
+            job = self.jobs[job_id]
+            event = message.get('event')
+            if event == 'epoch_begin':
+                job['epoch'] = message['epoch']
+                job['batch'] = 0
+            elif event == 'batch':
+                job['batch'] = message['batch']
+                job['metrics'] = message['metrics']
+            elif event == 'epoch_end':
+                job['metrics'] = message['metrics']
+                job['history'].append({'epoch': message['epoch'], **message['metrics']})
+            if message.get('total_epochs'):
+                job['total_epochs'] = message['total_epochs']
+            if message.get('total_batches'):
+                job['total_batches'] = message['total_batches']
+
+training_jobs = TrainingJobManager()
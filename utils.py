@@ -1,16 +1,19 @@
 import numpy as np
 import cv2
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageOps, ImageEnhance, ImageFilter
 import tensorflow as tf
 from tensorflow import keras
 import os
 import time
+import threading
 from pdf2image import convert_from_path
 import tempfile
 import pytesseract
 from scipy import ndimage
 import imutils
 from config import config
+from event_sink import event_sink
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -31,7 +34,8 @@ class AdvancedImagePreprocessor:
             image = AdvancedImagePreprocessor._custom_preprocessing(image, target_size, enhancement_level)
         
         processing_time = time.time() - start_time
-        logger.info(f"Image preprocessing completed in {processing_time:.3f}s")
+        event_sink.emit('preprocess', module='preprocessing', duration_ms=processing_time * 1000,
+                        enhancement_level=enhancement_level)
         
         return image, processing_time
     
@@ -133,14 +137,25 @@ class AdvancedImagePreprocessor:
 class AdvancedModelManager:
     def __init__(self, model_path=None):
         self.model = None
+        self.model_path = None
         self.model_version = "v2.0"
         self.performance_history = []
+        self.fast_model = None
+        self.fast_model_version = None
+        self.cascade_enabled = config.CASCADE_ENABLED
+        self.confidence_threshold = config.CASCADE_CONFIDENCE_THRESHOLD
+        self.margin_threshold = config.CASCADE_MARGIN_THRESHOLD
+        self._stats_lock = threading.Lock()
+        self.reset_cascade_stats()
         self.load_model(model_path)
         
-    def load_model(self, model_path):
+    def load_model(self, model_path, version=None):
         try:
             if model_path and os.path.exists(model_path):
                 self.model = keras.models.load_model(model_path)
+                self.model_path = model_path
+                if version:
+                    self.model_version = version
                 logger.info(f"Model loaded successfully from {model_path}")
             else:
                 logger.warning("No model found. Please train a model first.")
@@ -149,6 +164,99 @@ class AdvancedModelManager:
             logger.error(f"Error loading model: {str(e)}")
             self.model = None
     
+    def load_fast_model(self, model_path, version=None):
+        try:
+            if model_path and os.path.exists(model_path):
+                self.fast_model = keras.models.load_model(model_path)
+                self.fast_model_version = version or os.path.basename(model_path)
+                logger.info(f"Cascade fast model loaded from {model_path}")
+            else:
+                logger.warning("No fast model found. Cascade inference disabled.")
+                self.fast_model = None
+        except Exception as e:
+            logger.error(f"Error loading fast model: {str(e)}")
+            self.fast_model = None
+    
+    def reset_cascade_stats(self):
+        with self._stats_lock:
+            self.cascade_stats = {
+                'requests': 0,
+                'escalations': 0,
+                'fast_time': 0.0,
+                'full_time': 0.0,
+                'fast_batches': 0,
+                'full_batches': 0
+            }
+    
+    def get_cascade_stats(self):
+        with self._stats_lock:
+            stats = dict(self.cascade_stats)
+        return {
+            'enabled': self.cascade_enabled and self.fast_model is not None,
+            'fast_model_version': self.fast_model_version,
+            'confidence_threshold': self.confidence_threshold,
+            'margin_threshold': self.margin_threshold,
+            'requests': stats['requests'],
+            'escalations': stats['escalations'],
+            'escalation_rate': stats['escalations'] / stats['requests'] if stats['requests'] else 0.0,
+            'fast_tier_avg_ms': 1000 * stats['fast_time'] / stats['fast_batches'] if stats['fast_batches'] else None,
+            'full_tier_avg_ms': 1000 * stats['full_time'] / stats['full_batches'] if stats['full_batches'] else None
+        }
+    
+    def _needs_escalation(self, predictions):
+        top2 = np.sort(predictions, axis=1)[:, -2:]
+        confidence = top2[:, 1]
+        margin = top2[:, 1] - top2[:, 0]
+        return (confidence < self.confidence_threshold) | (margin < self.margin_threshold)
+    
+    def predict_batch(self, images, record_stats=True):
+        # Returns the (N, 10) probabilities and a mask of the rows answered by the full model
+        images = np.asarray(images, dtype=np.float32).reshape(-1, 28, 28, 1)
+        if self.model is None or len(images) == 0:
+            # Same answer as predict_digit without a model: digit 0 with confidence 0.0
+            return np.zeros((len(images), 10), dtype=np.float32), np.ones(len(images), dtype=bool)
+        if not (self.cascade_enabled and self.fast_model is not None):
+            return self.model.predict(images, verbose=0), np.ones(len(images), dtype=bool)
+        
+        start_time = time.time()
+        predictions = self.fast_model.predict(images, verbose=0)
+        fast_time = time.time() - start_time
+        
+        escalated = self._needs_escalation(predictions)
+        full_time = 0.0
+        if escalated.any():
+            start_time = time.time()
+            predictions[escalated] = self.model.predict(images[escalated], verbose=0)
+            full_time = time.time() - start_time
+        
+        if record_stats:
+            with self._stats_lock:
+                self.cascade_stats['requests'] += len(images)
+                self.cascade_stats['escalations'] += int(escalated.sum())
+                self.cascade_stats['fast_time'] += fast_time
+                self.cascade_stats['fast_batches'] += 1
+                if escalated.any():
+                    self.cascade_stats['full_time'] += full_time
+                    self.cascade_stats['full_batches'] += 1
+        return predictions, escalated
+    
+    def evaluate_cascade(self, x_test, y_test):
+        y_true = np.argmax(y_test, axis=1)
+        start_time = time.time()
+        full_predictions = self.model.predict(x_test, verbose=0)
+        full_time = time.time() - start_time
+        start_time = time.time()
+        cascade_predictions, escalated = self.predict_batch(x_test, record_stats=False)
+        cascade_time = time.time() - start_time
+        
+        return {
+            'full_accuracy': float(np.mean(np.argmax(full_predictions, axis=1) == y_true)),
+            'cascade_accuracy': float(np.mean(np.argmax(cascade_predictions, axis=1) == y_true)),
+            'escalation_rate': float(np.mean(escalated)),
+            'full_ms_per_image': 1000 * full_time / len(x_test),
+            'cascade_ms_per_image': 1000 * cascade_time / len(x_test)
+        }
+    
     def predict_digit(self, image, return_all=False):
         if self.model is None:
             return 0, 0.0, {}
@@ -156,7 +264,7 @@ class AdvancedModelManager:
         start_time = time.time()
         if len(image.shape) == 3:
             image = image.reshape(1, 28, 28, 1)
-        predictions = self.model.predict(image, verbose=0)
+        predictions, escalated = self.predict_batch(image)
         predicted_digit = np.argmax(predictions[0])
         confidence = np.max(predictions[0])
         
@@ -167,6 +275,7 @@ class AdvancedModelManager:
             'confidence': confidence,
             'processing_time': processing_time,
             'all_predictions': predictions[0] if return_all else None,
+            'tier': 'full' if escalated[0] else 'fast',
             'timestamp': time.time()
         }
         
@@ -271,6 +380,167 @@ class DataAugmentor:
         indices = np.reshape(y + dy, (-1, 1)), np.reshape(x + dx, (-1, 1))
         return ndimage.map_coordinates(image, indices, order=1).reshape(shape)
 
+    @staticmethod
+    def augment_batch(images, augmentation_type='all', out=None, seed=None, n_workers=None,
+                      chunk_size=4096, max_angle=15, max_shift=2, alpha=34, sigma=4):
+        """Batched augment_image: every transform becomes a sampling grid fed to one bilinear sampler."""
+        images = np.asarray(images, dtype=np.float32)
+        n = images.shape[0]
+        height, width = images.shape[1], images.shape[2]
+        src = images.reshape(n, height, width)
+        if out is None:
+            out = np.empty_like(images)
+        dst = out[..., 0] if out.ndim == 4 else out
+
+        n_workers = n_workers or config.AUGMENTATION_WORKERS
+        # One generator per chunk, spawned from the seed, keeps results independent of thread scheduling
+        starts = list(range(0, n, chunk_size))
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        seeds = seed.spawn(len(starts))
+        params = dict(augmentation_type=augmentation_type, max_angle=max_angle,
+                      max_shift=max_shift, alpha=alpha, sigma=sigma)
+
+        def run(job):
+            start, child_seed = job
+            stop = min(start + chunk_size, n)
+            rng = np.random.default_rng(child_seed)
+            dst[start:stop] = DataAugmentor._augment_chunk(src[start:stop], rng, **params)
+
+        if n_workers > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(run, zip(starts, seeds)))
+        else:
+            for job in zip(starts, seeds):
+                run(job)
+        return out
+
+    @staticmethod
+    def _augment_chunk(images, rng, augmentation_type, max_angle, max_shift, alpha, sigma):
+        n, height, width = images.shape
+        kinds = ['rotation', 'translation', 'elastic']
+        if augmentation_type == 'all':
+            choice = rng.integers(0, len(kinds), size=n)
+        elif augmentation_type in kinds:
+            choice = np.full(n, kinds.index(augmentation_type))
+        else:
+            return images.copy()
+
+        grid_y, grid_x = np.meshgrid(np.arange(height, dtype=np.float32),
+                                     np.arange(width, dtype=np.float32), indexing='ij')
+        ys = np.broadcast_to(grid_y, (n, height, width)).copy()
+        xs = np.broadcast_to(grid_x, (n, height, width)).copy()
+
+        # Rotation about the image centre, matching ndimage.rotate(reshape=False)
+        rot = choice == 0
+        if rot.any():
+            theta = np.deg2rad(rng.uniform(-max_angle, max_angle, size=rot.sum())).astype(np.float32)
+            cy, cx = (height - 1) / 2.0, (width - 1) / 2.0
+            cos, sin = np.cos(theta)[:, None, None], np.sin(theta)[:, None, None]
+            oy, ox = grid_y - cy, grid_x - cx
+            ys[rot] = cos * oy - sin * ox + cy
+            xs[rot] = sin * oy + cos * ox + cx
+
+        # Translation, matching cv2.warpAffine with a pure shift matrix
+        shift = choice == 1
+        if shift.any():
+            offsets = rng.uniform(-max_shift, max_shift, size=(shift.sum(), 2)).astype(np.float32)
+            xs[shift] -= offsets[:, 0, None, None]
+            ys[shift] -= offsets[:, 1, None, None]
+
+        # Elastic: displacement fields for the whole chunk are drawn and smoothed in one pass
+        elastic = choice == 2
+        if elastic.any():
+            fields = rng.uniform(-1, 1, size=(2, elastic.sum(), height, width)).astype(np.float32)
+            fields = ndimage.gaussian_filter1d(fields, sigma, axis=2, mode='mirror')
+            fields = ndimage.gaussian_filter1d(fields, sigma, axis=3, mode='mirror') * alpha
+            ys[elastic] += fields[1]
+            xs[elastic] += fields[0]
+
+        return DataAugmentor._bilinear_sample(images, ys, xs, clamp=rot)
+
+    @staticmethod
+    def augment_batch_tf(images, seed, augment_fraction=1.0, max_angle=15, max_shift=2, alpha=34, sigma=4):
+        """augment_batch in TF ops, for tf.data map stages; seed is a shape [2] tensor for the stateless RNGs.
+
+        Rows are left unchanged with probability 1 - augment_fraction, the rest get one transform as in augment_batch.
+        """
+        images = tf.convert_to_tensor(images, dtype=tf.float32)
+        n, height, width = tf.shape(images)[0], tf.shape(images)[1], tf.shape(images)[2]
+        seeds = tf.random.experimental.stateless_split(tf.cast(seed, tf.int64), 6)
+        augment = tf.random.stateless_uniform([n], seeds[0]) < augment_fraction
+        choice = tf.where(augment, tf.random.stateless_uniform([n], seeds[1], maxval=3, dtype=tf.int32), -1)
+        choice = choice[:, None, None]
+
+        grid_y, grid_x = tf.meshgrid(tf.range(height, dtype=tf.float32), tf.range(width, dtype=tf.float32), indexing='ij')
+        cy = (tf.cast(height, tf.float32) - 1) / 2.0
+        cx = (tf.cast(width, tf.float32) - 1) / 2.0
+        theta = tf.random.stateless_uniform([n, 1, 1], seeds[2], -max_angle, max_angle) * (np.pi / 180.0)
+        oy, ox = grid_y - cy, grid_x - cx
+        offsets = tf.random.stateless_uniform([n, 2, 1, 1], seeds[3], -max_shift, max_shift)
+        fields = DataAugmentor._gaussian_smooth_tf(
+            tf.random.stateless_uniform([n, 2, images.shape[1], images.shape[2]], seeds[4], -1, 1), sigma
+        ) * alpha
+
+        ys = tf.where(choice == 0, tf.cos(theta) * oy - tf.sin(theta) * ox + cy,
+             tf.where(choice == 1, grid_y - offsets[:, 1],
+             tf.where(choice == 2, grid_y + fields[:, 1], grid_y)))
+        xs = tf.where(choice == 0, tf.sin(theta) * oy + tf.cos(theta) * ox + cx,
+             tf.where(choice == 1, grid_x - offsets[:, 0],
+             tf.where(choice == 2, grid_x + fields[:, 0], grid_x)))
+        return DataAugmentor._bilinear_sample_tf(images[..., 0], ys, xs, clamp=choice == 0)[..., None]
+
+    @staticmethod
+    def _gaussian_smooth_tf(fields, sigma):
+        # gaussian_filter1d(mode='mirror') is linear along each axis, so both passes are matmuls with fixed matrices
+        height, width = fields.shape[-2], fields.shape[-1]
+        smooth_y = tf.constant(ndimage.gaussian_filter1d(np.eye(height), sigma, axis=0, mode='mirror'), dtype=tf.float32)
+        smooth_x = tf.constant(ndimage.gaussian_filter1d(np.eye(width), sigma, axis=0, mode='mirror'), dtype=tf.float32)
+        return tf.linalg.matmul(tf.linalg.matmul(smooth_y, fields), smooth_x, transpose_b=True)
+
+    @staticmethod
+    def _bilinear_sample_tf(images, ys, xs, clamp):
+        n, height, width = tf.shape(images)[0], tf.shape(images)[1], tf.shape(images)[2]
+        ys = tf.where(clamp, tf.clip_by_value(ys, 0.0, tf.cast(height - 1, tf.float32)), ys)
+        xs = tf.where(clamp, tf.clip_by_value(xs, 0.0, tf.cast(width - 1, tf.float32)), xs)
+        y0, x0 = tf.floor(ys), tf.floor(xs)
+        wy, wx = ys - y0, xs - x0
+        y0, x0 = tf.cast(y0, tf.int32), tf.cast(x0, tf.int32)
+        # All four neighbours are gathered in one op: stacked along a leading axis in (y0,x0), (y0,x1), (y1,x0), (y1,x1) order
+        yi = tf.stack([y0, y0, y0 + 1, y0 + 1])
+        xi = tf.stack([x0, x0 + 1, x0, x0 + 1])
+        weights = tf.stack([(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx])
+        inside = (yi >= 0) & (yi < height) & (xi >= 0) & (xi < width)
+        base = tf.range(n)[:, None, None] * height * width
+        values = tf.gather(tf.reshape(images, [-1]),
+                           base + tf.clip_by_value(yi, 0, height - 1) * width + tf.clip_by_value(xi, 0, width - 1))
+        return tf.reduce_sum(tf.where(inside | clamp, values, 0.0) * weights, axis=0)
+
+    @staticmethod
+    def _bilinear_sample(images, ys, xs, clamp):
+        n, height, width = images.shape
+        # Rotation used mode='nearest'; clamping the coordinates reproduces it
+        ys[clamp] = np.clip(ys[clamp], 0, height - 1)
+        xs[clamp] = np.clip(xs[clamp], 0, width - 1)
+
+        y0 = np.floor(ys)
+        x0 = np.floor(xs)
+        wy = ys - y0
+        wx = xs - x0
+        y0 = y0.astype(np.int32)
+        x0 = x0.astype(np.int32)
+        batch = np.arange(n)[:, None, None]
+
+        result = np.zeros_like(images)
+        for dy, dx, weight in ((0, 0, (1 - wy) * (1 - wx)), (0, 1, (1 - wy) * wx),
+                               (1, 0, wy * (1 - wx)), (1, 1, wy * wx)):
+            yi = y0 + dy
+            xi = x0 + dx
+            inside = (yi >= 0) & (yi < height) & (xi >= 0) & (xi < width)
+            values = images[batch, np.clip(yi, 0, height - 1), np.clip(xi, 0, width - 1)]
+            result += np.where(inside | clamp[:, None, None], values, 0) * weight
+        return result
+
 model_manager = AdvancedModelManager(config.MODEL_PATH)
 image_preprocessor = AdvancedImagePreprocessor()
 ocr_processor = OCRProcessor()